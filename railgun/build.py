@@ -1,10 +1,13 @@
 """ Builder module. Can only be run from inside a Docker container.
 
-
+Run as 'python -m railgun.build [-C] [SERVICE]', it is the entry point of builder containers:
+it unpacks the build context tar stream read from stdin, runs the builder's /bin/compile hook
+(if any) with the context and a cache directory kept between builds, and builds the container.
 """
 from __future__ import print_function
 
-import os, sys
+import os, sys, shutil, subprocess, json, inspect
+import optparse
 import piperpc
 import docker
 import tarfile, gzip, tempfile
@@ -13,10 +16,85 @@ from . import spec, checkout
 if not os.path.exists("/.dockerenv"):
     raise ImportError("The build module can only be imported in a Docker container")
 
+# Passed on to builds when set in the builder container (see HostProvider.get_build_args)
+BUILD_ARGS = ("http_proxy", "HTTP_PROXY")
+
+BUILD_DIR = "/tmp/build"
+CACHE_ROOT = "/buildroot/cache"
+COMPILE_HOOK = "/bin/compile"
+
 def build_container(service, nocache=False):
     rootdir = service.get_directory()
     name = service.container_name()
     client = docker.Client(os.environ["DOCKER_SOCK"])
     print(os.environ["DOCKER_SOCK"])
-    for result in client.build(path=rootdir, tag=name, rm=True, nocache=nocache, stream=True):
+    buildargs = dict((arg, os.environ[arg]) for arg in BUILD_ARGS if os.environ.get(arg))
+    options = {}
+    # Labels to set on the image, such as the digest of the sources (see HostProvider._build_service_container)
+    labels = json.loads(os.environ.get("RAILGUN_LABELS") or "{}")
+    if labels:
+        if "labels" in inspect.getargspec(client.build).args:
+            options["labels"] = labels
+        else:
+            with open(os.path.join(rootdir, "Dockerfile"), "a") as f:
+                for label, value in sorted(labels.items()):
+                    f.write("\nLABEL %s=%s\n" % (label, json.dumps(value)))
+    for result in client.build(path=rootdir, tag=name, rm=True, nocache=nocache, stream=True, buildargs=buildargs or None, **options):
         print(result)
+
+def get_service(project, name=None):
+    "Returns the service of a project to build: the named one, or else the only one"
+    if name:
+        return project.get_service(name)
+    if len(project.services) != 1:
+        raise Exception("Must specify service")
+    return project.services[0]
+
+def extract(stream, dirname, verbose=False):
+    "Unpacks a (possibly compressed) tar stream into a directory, without seeking"
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for tarinfo in tar:
+            if verbose:
+                print(tarinfo.name)
+            tar.extract(tarinfo, dirname)
+
+def get_cache_dir(service, clear=False):
+    "Returns (and creates) the cache directory of a service, kept between builds and keyed by its qualified name"
+    dirname = os.path.join(CACHE_ROOT, service.qualified_name())
+    if clear and os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return dirname
+
+def run_compile_hook(builddir, cachedir):
+    "Runs the compile hook of the builder, if it has one"
+    if os.path.exists(COMPILE_HOOK):
+        print("Compiling %s %s" % (builddir, cachedir))
+        if subprocess.call([COMPILE_HOOK, builddir, cachedir]) != 0:
+            raise Exception("%s failed" % COMPILE_HOOK)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [-C] [SERVICE] < CONTEXT.tar")
+    parser.add_option("-C", "--clear-cache", action="store_true", help="Clear the cache directory of the service before building")
+    parser.add_option("-d", "--build-dir", default=BUILD_DIR, help="Unpack the build context to BUILD_DIR (default %s)" % BUILD_DIR)
+    parser.add_option("-v", "--verbose", action="store_true", help="List the files of the build context as they are unpacked")
+    parser.add_option("--no-cache", action="store_true", help="Disabled Docker caching")
+    opts, args = parser.parse_args(argv)
+    try:
+        if not os.path.isdir(opts.build_dir):
+            os.makedirs(opts.build_dir)
+        extract(sys.stdin, opts.build_dir, opts.verbose)
+        service = get_service(spec.Project(opts.build_dir), args[0] if args else os.environ.get("SERVICE"))
+        run_compile_hook(opts.build_dir, get_cache_dir(service, opts.clear_cache))
+        print("Building container")
+        service.build(write=True)
+        build_container(service, opts.no_cache)
+        print("Done!")
+        return 0
+    except:
+        print(sys.exc_info()[1], file=sys.stderr)
+        return 255
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"Location and atomic update of the files Railgun caches between commands, loading of cached YAML documents and file digests"
+import os, time, json, tempfile, hashlib, threading, copy
+import cPickle as pickle
+import yaml
+import logging
+log = logging.getLogger(__name__)
+
+# The libyaml-based loader is several times faster, when available
+_YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+def get_cache_dir(*parts):
+    """Returns (and creates) a directory for cached data: $RAILGUN_CACHE, or 'railgun' in
+    $XDG_CACHE_HOME (~/.cache by default), optionally joined with parts"""
+    base = os.environ.get("RAILGUN_CACHE")
+    if not base:
+        base = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "railgun")
+    dirname = os.path.join(base, *parts)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created concurrently
+            if not os.path.isdir(dirname): raise
+    return dirname
+
+def load_json(filename, default=None):
+    "Reads a cache file, returning default if it is missing or unreadable"
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def save_json(filename, data):
+    "Writes a cache file atomically, so that concurrent readers never see a partial file"
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        # The cache is only an optimization
+        log.debug("Could not write cache file %s" % filename)
+
+def load_yaml(filename):
+    """Parses a YAML file. Documents are memoized per path, modification time and size for the rest
+    of the command. If $RAILGUN_SPEC_CACHE is set, they are also kept in the cache directory."""
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    stamp = [st.st_mtime, st.st_size]
+    with _documents_lock:
+        cached = _documents.get(path)
+    if not cached or cached[0] != stamp:
+        cached = (stamp, _load_yaml_file(path, stamp))
+        with _documents_lock:
+            _documents[path] = cached
+    # Callers own the document they get
+    return copy.deepcopy(cached[1])
+
+def _load_yaml_file(path, stamp):
+    fn = None
+    if os.environ.get("RAILGUN_SPEC_CACHE"):
+        fn = os.path.join(get_cache_dir("specs"), hashlib.sha1(path).hexdigest())
+        try:
+            with open(fn, "rb") as f:
+                cached_stamp, doc = pickle.load(f)
+            if cached_stamp == stamp:
+                return doc
+        except Exception:
+            pass
+    with open(path) as f:
+        doc = yaml.load(f, Loader=_YamlLoader)
+    if fn:
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((stamp, doc), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, fn)
+        except (IOError, OSError, pickle.PicklingError):
+            log.debug("Could not write cache file %s" % fn)
+    return doc
+
+_file_digests = {}
+_file_digests_dirty = set()
+_file_digests_lock = threading.Lock()
+
+# Files modified this recently may change again without their modification time changing
+_RACY_SECONDS = 2
+
+def file_digest(path):
+    """Returns the SHA-1 of the contents of a file. Digests are remembered by path, size, modification time and
+    inode, and kept in the cache directory (see save_file_digests), so that unchanged files are not read again."""
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime, st.st_ino]
+    shard = hashlib.sha1(os.path.dirname(path)).hexdigest()[:2]
+    with _file_digests_lock:
+        entries = _file_digests.get(shard)
+        if entries is None:
+            entries = _file_digests[shard] = load_json(os.path.join(get_cache_dir("digests"), "%s.json" % shard), {})
+        entry = entries.get(path)
+    if entry and entry[0] == stamp:
+        return entry[1]
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(65536)
+            if not buf: break
+            sha.update(buf)
+    digest = sha.hexdigest()
+    if time.time() - st.st_mtime > _RACY_SECONDS:
+        with _file_digests_lock:
+            entries[path] = [stamp, digest]
+            _file_digests_dirty.add(shard)
+    return digest
+
+def save_file_digests():
+    "Writes the file digests computed since the last call to the cache directory"
+    with _file_digests_lock:
+        for shard in _file_digests_dirty:
+            save_json(os.path.join(get_cache_dir("digests"), "%s.json" % shard), _file_digests[shard])
+        _file_digests_dirty.clear()
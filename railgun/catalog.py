@@ -0,0 +1,190 @@
+"""
+Catalog of the services defined in a workspace: a directory tree holding many projects.
+
+The tree is scanned on several threads for 'services.yml' files and for directories holding
+only a Dockerfile. For each service, the catalog records its qualified names, namespace, type,
+builder and the endpoints it implements. The catalog is persisted in the cache directory and
+updated incrementally: only specs whose modification time changed are parsed again.
+
+The workspace used for resolving references is given to spec.Project (with -W), or else set by
+$RAILGUN_WORKSPACE (see get_workspace).
+"""
+import sys, os, hashlib, threading, Queue
+from . import cache
+import logging
+log = logging.getLogger(__name__)
+
+SPEC_FILE = "services.yml"
+DEFAULT_WORKERS = 8
+
+# Directories never holding projects: SCM metadata, and the build directories of projects
+_SKIP = (".git", ".hg", ".svn", ".bzr", "CVS")
+_BUILD_DIR = "build"
+
+def _describe(specfile):
+    "Parses a spec and returns the catalog records of its services"
+    from .spec import Project
+    proj = Project(os.path.dirname(specfile))
+    records = []
+    for svc in proj.services:
+        name, short = svc.qualified_name(), svc.qualified_name(True)
+        records.append({
+            "name": svc.name,
+            "qualified_name": name,
+            "short_name": short,
+            "namespace": name[len(short)+1:] or None,
+            "type": svc.type(),
+            "builder": None if proj.raw_docker else svc.get_builder(),
+            "implements": svc.get_implements(),
+        })
+    return records
+
+class Catalog(object):
+    "The services of the projects under a workspace root directory"
+    root = None
+    filename = None
+    def __init__(self, root, workers=DEFAULT_WORKERS):
+        self.root = os.path.realpath(root)
+        self.workers = max(1, workers)
+        self.filename = os.path.join(cache.get_cache_dir("catalog"), "%s.json" % hashlib.sha1(self.root).hexdigest())
+        self.entries = None
+        self.scanned = False
+        self._lock = threading.Lock()
+        # Built from the entries: all records, and the records by qualified name and by endpoint
+        self._records = None
+        self._by_name = None
+        self._by_endpoint = None
+
+    def update(self, rescan=False):
+        """Scans the workspace, parsing the specs that are new or changed since the last scan
+        (all of them with rescan). Returns the number of specs parsed."""
+        old = {} if rescan else cache.load_json(self.filename, {}).get("entries", {})
+        entries = {}
+        parsed = [0]
+        pending = Queue.Queue()
+        lock = threading.Lock()
+
+        def visit(dirname):
+            try:
+                names = os.listdir(dirname)
+            except OSError:
+                return
+            spec = None
+            if SPEC_FILE in names:
+                spec = SPEC_FILE
+            elif "Dockerfile" in names:
+                spec = "Dockerfile"
+            if spec:
+                specfile = os.path.join(dirname, spec)
+                rel = os.path.relpath(specfile, self.root)
+                entry = old.get(rel)
+                mtime = os.path.getmtime(specfile)
+                if not entry or entry["mtime"] != mtime:
+                    entry = {"mtime": mtime, "services": []}
+                    try:
+                        entry["services"] = _describe(specfile)
+                    except Exception:
+                        log.warn("Skipping %s: %s" % (specfile, sys.exc_info()[1]))
+                    with lock:
+                        parsed[0] += 1
+                with lock:
+                    entries[rel] = entry
+            for name in names:
+                if name in _SKIP or (spec and name == _BUILD_DIR):
+                    continue
+                path = os.path.join(dirname, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    pending.put(path)
+
+        def work():
+            while True:
+                dirname = pending.get()
+                if dirname is None:
+                    break
+                try:
+                    visit(dirname)
+                finally:
+                    pending.task_done()
+
+        pending.put(self.root)
+        for i in range(self.workers):
+            t = threading.Thread(target=work)
+            t.daemon = True
+            t.start()
+        pending.join()
+        for i in range(self.workers):
+            pending.put(None)
+        log.debug("Scanned %s: %d specs, %d parsed" % (self.root, len(entries), parsed[0]))
+        if parsed[0] or len(entries) != len(old):
+            cache.save_json(self.filename, {"root": self.root, "entries": entries})
+        with self._lock:
+            self._set_entries(entries)
+            self.scanned = True
+        return parsed[0]
+
+    def _set_entries(self, entries):
+        "Sets the catalog entries and indexes their records (with the lock held)"
+        self.entries = entries
+        self._records, self._by_name, self._by_endpoint = [], {}, {}
+        if entries is None:
+            return
+        for rel, entry in sorted(entries.items()):
+            for record in entry["services"]:
+                record = dict(record)
+                record["spec"] = os.path.join(self.root, rel)
+                self._records.append(record)
+                for name in set([record["qualified_name"], record["short_name"]]):
+                    self._by_name.setdefault(name, []).append(record)
+                for endpoint in record["implements"]:
+                    self._by_endpoint.setdefault(endpoint, []).append(record)
+
+    def _load(self):
+        "Loads the catalog as persisted by the last scan, or else scans the workspace"
+        with self._lock:
+            if self.entries is None:
+                self._set_entries(cache.load_json(self.filename, {}).get("entries"))
+            loaded = self.entries is not None
+        if not loaded:
+            self.update()
+
+    def services(self):
+        "Returns the catalog records of all services, each with the 'spec' file defining it"
+        self._load()
+        return list(self._records)
+
+    def find(self, reference):
+        "Returns the records of the services with the qualified name (with or without namespace)"
+        self._load()
+        return list(self._by_name.get(reference, []))
+
+    def implementing(self, endpoint):
+        "Returns the records of the services implementing an endpoint"
+        self._load()
+        return list(self._by_endpoint.get(endpoint, []))
+
+    def get_service(self, reference):
+        "Returns the service with the qualified name, or None. Raises ValueError if ambiguous."
+        from .spec import Project
+        found = self.find(reference)
+        if not found and not self.scanned:
+            # The persisted catalog may be out of date
+            self.update()
+            found = self.find(reference)
+        if len(found) > 1:
+            raise ValueError("Ambiguous service reference '%s', defined in %s" % (reference, ', '.join(r["spec"] for r in found)))
+        if not found:
+            return None
+        return Project(os.path.dirname(found[0]["spec"]), workspace=self.root).get_service(found[0]["name"])
+
+_workspaces = {}
+_workspaces_lock = threading.Lock()
+
+def get_workspace(root=None):
+    "Returns the catalog of the workspace under root, by default the one set by $RAILGUN_WORKSPACE, or None"
+    root = root or os.environ.get("RAILGUN_WORKSPACE")
+    if not root:
+        return None
+    with _workspaces_lock:
+        if not root in _workspaces:
+            _workspaces[root] = Catalog(root)
+        return _workspaces[root]
@@ -2,10 +2,22 @@
 from __future__ import print_function
 import sys, os
 import urlparse
-import urllib2
+import urllib2, httplib
 import subprocess
+import threading, hashlib, time
 import logging
 log = logging.getLogger(__name__)
+
+# Attributes selecting what to check out of a repository, see GitRepository
+SCM_OPTIONS = ("ref", "depth", "filter")
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def _lock(key):
+    "Returns a lock for the key (e.g. a mirror directory), for use when checking out from several threads"
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
     
 def _call(cmd, shell=False, cwd=None, env=None, dryrun=False, retcode=None, errlen=1, stdin=None):
     if dryrun:
@@ -58,9 +70,9 @@ def get_local_file(url, ref=None):
             return url
     elif u.scheme == "file":
         if ref:
-            return os.path.abspath(os.path.join(ref, url.path))
+            return os.path.abspath(os.path.join(ref, u.path))
         else:
-            return url.path
+            return u.path
     return None
     
 def is_url_or_file(string):
@@ -73,12 +85,129 @@ def is_url_or_file(string):
         return True
     return False
     
+def read_head(path):
+    "Returns the commit checked out in a git working directory (a clone or a worktree), or None"
+    gitdir = os.path.join(path, ".git")
+    try:
+        if os.path.isfile(gitdir):
+            # A worktree or submodule, pointing to its git directory
+            with open(gitdir) as f:
+                gitdir = os.path.join(path, f.read().split(":", 1)[1].strip())
+        with open(os.path.join(gitdir, "HEAD")) as f:
+            head = f.read().strip()
+    except (IOError, OSError, IndexError):
+        return None
+    if not head.startswith("ref:"):
+        return head
+    # On a branch: use git, which knows about packed and shared refs
+    return _eval(["git","rev-parse","HEAD"], cwd=path) or None
+
+_remote_heads = {}
+_remote_heads_lock = threading.Lock()
+
+def _ls_remote(url, ref):
+    "Returns the commit a ref (default HEAD) points to in a remote repository, or None"
+    out = _eval(["git","ls-remote",url,ref or "HEAD"])
+    heads = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            heads[parts[1]] = parts[0]
+    # Prefer the commit an annotated tag points to
+    for name, sha in sorted(heads.items()):
+        if name.endswith("^{}"):
+            return sha
+    for name in ("HEAD", ref, "refs/heads/%s" % ref, "refs/tags/%s" % ref):
+        if name in heads:
+            return heads[name]
+    return heads and sorted(heads.values())[0] or None
+
+def probe_remote_heads(repos, workers=8):
+    """Looks up the current commit of several remote repositories at once, for later calls to
+    get_remote_head. repos is a list of (url, ref) tuples, with ref None for the default branch."""
+    pending = list(set((GitRepository()._normalize_url(url), ref) for url, ref in repos))
+    pending = [ r for r in pending if not r in _remote_heads ]
+    def probe():
+        while True:
+            with _remote_heads_lock:
+                if not pending:
+                    return
+                url, ref = pending.pop()
+            head = _ls_remote(url, ref)
+            with _remote_heads_lock:
+                _remote_heads[(url, ref)] = head
+    threads = [ threading.Thread(target=probe) for i in range(min(workers, len(pending))) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    
+def prefetch(checkouts, workers=4):
+    """Runs checkouts concurrently, at most 'workers' at a time. checkouts is a list of (url, func)
+    where func() checks out the url; those of the same repository run one after the other (the
+    first clones, the others reuse the clone). Returns a list of (url, seconds, error), one per
+    repository, with error None on success."""
+    groups = {}
+    for url, func in checkouts:
+        key = url if url_is_local(url) else GitRepository()._normalize_url(url)
+        groups.setdefault(key, (url, []))[1].append(func)
+    pending = sorted(groups.values())
+    results = []
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                url, funcs = pending.pop(0)
+            start = time.time()
+            error = None
+            try:
+                for func in funcs:
+                    func()
+            except Exception:
+                error = sys.exc_info()[1]
+            with lock:
+                results.append((url, time.time() - start, error))
+    threads = [ threading.Thread(target=work) for i in range(min(workers, len(pending))) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return sorted(results)
+    
+def report_prefetch(results):
+    "Logs the outcome of prefetch. Errors are only logged: the checkout fails again when it is needed."
+    for url, elapsed, error in results:
+        if error:
+            log.warn("Failed to fetch %s: %s" % (url, error))
+        else:
+            log.info("Fetched %s in %.1fs" % (url, elapsed))
+    
+def get_remote_head(url, ref=None):
+    "Returns the current commit of a ref in a remote repository, or None if it could not be determined"
+    url = GitRepository()._normalize_url(url)
+    if not (url, ref) in _remote_heads:
+        probe_remote_heads([(url, ref)])
+    return _remote_heads[(url, ref)]
+
 class Repository(object):
     update_callback = None # func(returnpath, post_update, did_change)
     clone_callback = None # func(returnpath, post_update)
 
 class GitRepository(Repository):
-    "git repository support"
+    """git repository support.
+    
+    Repositories are cloned once into a shared bare mirror in the cache directory (see
+    get_mirror_dir), and checkouts are worktrees of the mirror, so they share its objects.
+    Updating fetches into the mirror once. The options are:
+        ref     The branch, tag or commit to check out (default: the remote's HEAD)
+        depth   Fetch only that many commits of history (shallow mirror)
+        filter  A partial clone filter for the mirror, such as 'blob:none'
+        mirror  False to clone each checkout separately, as a plain 'git clone'
+    """
+    def __init__(self, ref=None, depth=None, filter=None, mirror=True):
+        self.ref = ref
+        self.depth = depth
+        self.filter = filter
+        self.mirror = mirror
+        
     def checkout(self, url, local_path, subdir=None, dryrun=False, update_existing=False):
         url = self._normalize_url(url)
         destpath = os.path.join(local_path, self.get_destination_name(url))
@@ -86,34 +215,110 @@ class GitRepository(Repository):
         if subdir:
             returnpath = os.path.join(destpath, subdir)
         if os.path.exists(destpath):
-            if os.path.isdir(destpath) and os.path.isdir(os.path.join(destpath, ".git")):
+            if os.path.isdir(destpath) and os.path.exists(os.path.join(destpath, ".git")):
                 if update_existing:
-                    head = None
+                    head = read_head(destpath)
                     if self.update_callback:
-                        head = _eval(["git","rev-parse","HEAD"], cwd=destpath)
                         self.update_callback(returnpath, False, False)
-                    _call(["git","pull","--ff-only",url], cwd=destpath, dryrun=dryrun, retcode=0, errlen=2)
+                    if head and self._is_current(url, head):
+                        log.debug("%s is up to date (%s)" % (destpath, head[:12]))
+                        if self.update_callback:
+                            self.update_callback(returnpath, True, False)
+                        return destpath
+                    if os.path.isdir(os.path.join(destpath, ".git")):
+                        # A separate clone
+                        _call(["git","pull","--ff-only",url], cwd=destpath, dryrun=dryrun, retcode=0, errlen=2)
+                    else:
+                        mirror = self._update_mirror(url, dryrun, fetch=True)
+                        _call(["git","checkout","--detach",self._get_target(mirror, dryrun)], cwd=destpath, dryrun=dryrun, retcode=0, errlen=2)
                     if self.update_callback:
-                        head2 = _eval(["git","rev-parse","HEAD"], cwd=destpath)
-                        self.update_callback(returnpath, True, head != head2)
+                        self.update_callback(returnpath, True, dryrun or head != read_head(destpath))
             else:
                 raise IOError("Path '%s' already exists and is not a git repo" % destpath)
         else:
             if self.clone_callback: self.clone_callback(returnpath, False)
-            _call(["git","clone",url], cwd=local_path, dryrun=dryrun, retcode=0, errlen=2)
+            if self.mirror:
+                mirror = self._update_mirror(url, dryrun)
+                with _lock(mirror):
+                    # Forget worktrees whose directories were deleted
+                    _call(["git","worktree","prune"], cwd=mirror, dryrun=dryrun)
+                    _call(["git","worktree","add","--detach",destpath,self._get_target(mirror, dryrun)], cwd=mirror, dryrun=dryrun, retcode=0, errlen=3)
+            else:
+                cmd = ["git","clone"]
+                if self.depth: cmd.append("--depth=%d" % int(self.depth))
+                if self.filter: cmd.append("--filter=%s" % self.filter)
+                if self.ref: cmd += ["--branch", self.ref]
+                _call(cmd + [url], cwd=local_path, dryrun=dryrun, retcode=0, errlen=2)
             if not dryrun and not os.path.isdir(destpath):
                 raise IOError("Local git clone at '%s' vanished" % destpath)
             if self.clone_callback: self.clone_callback(returnpath, True)
         if not dryrun and subdir and not os.path.isdir(returnpath):
             raise IOError("Subdirectory '%s' does not exist in git repo" % subdir)
         return destpath
+        
+    def _is_current(self, url, head):
+        "Returns True if a checkout at commit head is what an update would check out"
+        if self.ref and len(self.ref) >= 7 and head.startswith(self.ref.lower()):
+            # Pinned to this commit
+            return True
+        return get_remote_head(url, self.ref) == head
+        
+    def prefetch(self, url, update=False):
+        "Clones the mirror of a repository if missing; with update, fetches into it if the remote changed"
+        url = self._normalize_url(url)
+        if not self.mirror:
+            return
+        if os.path.isdir(self.get_mirror_dir(url)) and update:
+            head = get_remote_head(url, self.ref)
+            self._update_mirror(url, fetch=not head or not self._has_ref(self.get_mirror_dir(url), head))
+        else:
+            self._update_mirror(url)
+        
+    def get_mirror_dir(self, url):
+        """Returns the directory of the shared mirror of a repository. Checkouts with different depth or filter
+        options get separate mirrors, as a shallow or partial mirror cannot serve the others."""
+        from .cache import get_cache_dir
+        url = self._normalize_url(url)
+        key = url.rstrip("/")
+        if self.depth or self.filter:
+            key += " depth=%s filter=%s" % (self.depth or "", self.filter or "")
+        key = hashlib.sha1(key).hexdigest()[:16]
+        return os.path.join(get_cache_dir("git"), "%s-%s.git" % (self.get_destination_name(url), key))
+        
+    def _update_mirror(self, url, dryrun=False, fetch=False):
+        "Creates the mirror of a repository if missing, or with fetch, updates it. Returns its directory."
+        mirror = self.get_mirror_dir(url)
+        with _lock(mirror):
+            if not os.path.isdir(mirror):
+                cmd = ["git","clone","--mirror"]
+                if self.depth: cmd.append("--depth=%d" % int(self.depth))
+                if self.filter: cmd.append("--filter=%s" % self.filter)
+                _call(cmd + [url, mirror], dryrun=dryrun, retcode=0, errlen=3)
+            elif fetch or (self.ref and not self._has_ref(mirror, self.ref)):
+                cmd = ["git","fetch","--prune"]
+                if self.depth: cmd.append("--depth=%d" % int(self.depth))
+                _call(cmd + ["origin"], cwd=mirror, dryrun=dryrun, retcode=0, errlen=2)
+        return mirror
+        
+    def _has_ref(self, mirror, ref):
+        with open(os.devnull, "w") as null:
+            return subprocess.call(["git","rev-parse","--verify","-q","%s^{commit}" % ref], cwd=mirror, stdout=null, stderr=null) == 0
+            
+    def _get_target(self, mirror, dryrun=False):
+        "Returns the commit to check out from the mirror (resolved there, as HEAD differs in worktrees)"
+        ref = self.ref or "HEAD"
+        if dryrun:
+            return ref
+        if not self._has_ref(mirror, ref):
+            raise IOError("Reference '%s' not found in repository" % ref)
+        return _eval(["git","rev-parse","%s^{commit}" % ref], cwd=mirror)
     
     def _normalize_url(self, url):
         if url.startswith("/"):
             return url
         url = urlparse.urlparse(url)
-        if not url.scheme: url.scheme = "https"
-        if url.scheme.startswith("git+"): url.scheme = url.scheme[4:]
+        if not url.scheme: url = url._replace(scheme="https")
+        if url.scheme.startswith("git+"): url = url._replace(scheme=url.scheme[4:])
         return url.geturl()
         
     def get_destination_name(self, url):
@@ -127,16 +332,17 @@ class MercurialRepository(Repository):
         
         raise NotImplementedError()
         
-def get_scm_provider(url):
+def get_scm_provider(url, **options):
+    "Returns the repository handler for an URL, or None. Options are passed to the handler (see GitRepository)."
     if url.startswith("/") or os.path.isdir(url):
         if os.path.isdir(os.path.join(url, ".git")):
-            return GitRepository()
+            return GitRepository(**options)
         elif os.path.isdir(os.path.join(url, ".hg")):
             return MercurialRepository()
     if isinstance(url, str) or isinstance(url, unicode):
         url = urlparse.urlparse(url)
     if url.scheme.startswith("git+") or url.path.strip("/").endswith(".git") or url.hostname and (url.hostname == "github.com" or url.hostname.endswith(".github.com")):
-        return GitRepository()
+        return GitRepository(**options)
     elif url.scheme.startswith("hg+") or url.path.strip("/").endswith(".hg") or url.hostname and (url.hostname == "bitbucket.org" or url.hostname.endswith(".bitbucket.org")):
         return MercurialRepository()
         
@@ -144,3 +350,213 @@ def is_scm_url(url):
     "Returns True if the URL is a SCM URL, False otherwise"
     return bool(get_scm_provider(url))
 
+    
+def is_download_url(url):
+    "Returns True if the URL is a HTTP(S) URL of a file to download (not a SCM repository)"
+    return urlparse.urlparse(url).scheme in ("http", "https") and not is_scm_url(url)
+    
+def get_download_provider(url):
+    "Returns the handler for a downloadable URL, or None"
+    if is_download_url(url):
+        return HttpResource()
+        
+# Downloaded files are kept in the cache directory, named by the SHA-256 of their contents
+DOWNLOAD_CACHE_SIZE = 1024 # MB, unless set by $RAILGUN_DOWNLOAD_CACHE_SIZE
+_validated = set()
+
+def _get_download_dir(*parts):
+    from .cache import get_cache_dir
+    return get_cache_dir("downloads", *parts)
+
+def download(url):
+    """Returns the path of a cached copy of a HTTP(S) URL, downloading it if needed. A cached copy is
+    revalidated once per command with a conditional request (ETag/Last-Modified), and used as is if
+    the server cannot be reached."""
+    try:
+        return fetch(url)[0]
+    except urllib2.HTTPError as e:
+        raise IOError("Failed to download %s: %s" % (url, e))
+    except (urllib2.URLError, httplib.HTTPException, IOError) as e:
+        raise IOError("Failed to download %s: %s" % (url, getattr(e, "reason", e)))
+        
+class NotCacheable(Exception):
+    "Raised by fetch for a response that may not be cached. The response, not yet read, is the 'response' attribute."
+    def __init__(self, url, response):
+        Exception.__init__(self, "Response from %s may not be cached" % url)
+        self.response = response
+
+# Not kept with cached responses, see RFC 2616 section 13.5.1
+HOP_HEADERS = ("connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "proxy-connection",
+    "te", "trailers", "transfer-encoding", "upgrade")
+
+def fetch(url, max_age=None, cacheable=None):
+    """Returns a tuple (path, meta, status) for a cached copy of a HTTP(S) URL (see download). meta holds
+    the end-to-end response headers ('headers', a list of (name, value)), and status is 'hit' (not
+    revalidated), 'revalidated', 'stale' (the server could not be reached) or 'miss' (downloaded).
+    With max_age, a cached copy is revalidated when it was last validated more than max_age seconds
+    ago, rather than once per command. If cacheable is given, it is called with the headers of a
+    downloaded response, and NotCacheable is raised if it returns False. HTTP errors are raised as
+    urllib2.HTTPError."""
+    from .cache import load_json, save_json
+    metafile = os.path.join(_get_download_dir("urls"), "%s.json" % hashlib.sha1(url).hexdigest())
+    with _lock(metafile):
+        meta = load_json(metafile, {})
+        path = meta.get("sha256") and os.path.join(_get_download_dir(), meta["sha256"])
+        if path and not os.path.exists(path):
+            # Evicted
+            meta, path = {}, None
+        if max_age is None:
+            fresh = url in _validated
+        else:
+            fresh = time.time() - meta.get("validated", 0) < max_age
+        if path and fresh:
+            _touch(path)
+            return path, meta, "hit"
+        req = urllib2.Request(url)
+        if path and meta.get("etag"):
+            req.add_header("If-None-Match", meta["etag"])
+        if path and meta.get("last_modified"):
+            req.add_header("If-Modified-Since", meta["last_modified"])
+        try:
+            resp = urllib2.urlopen(req)
+        except urllib2.HTTPError as e:
+            if e.code != 304 or not path:
+                raise
+            log.debug("Cached copy of %s is up to date" % url)
+            meta["validated"] = time.time()
+            save_json(metafile, meta)
+            _validated.add(url)
+            _touch(path)
+            return path, meta, "revalidated"
+        except (urllib2.URLError, httplib.HTTPException, IOError) as e:
+            if not path:
+                raise
+            log.warn("Using cached copy of %s: %s" % (url, getattr(e, "reason", e)))
+            _validated.add(url)
+            _touch(path)
+            return path, meta, "stale"
+        headers = resp.info()
+        if cacheable and not cacheable(headers):
+            raise NotCacheable(url, resp)
+        log.info("Downloading %s" % url)
+        path = _store(resp)
+        meta = {
+            "url": url,
+            "sha256": os.path.basename(path),
+            "etag": headers.getheader("ETag"),
+            "last_modified": headers.getheader("Last-Modified"),
+            "content_type": headers.getheader("Content-Type"),
+            "headers": [ (k, headers[k]) for k in headers.keys() if not k.lower() in HOP_HEADERS + ("content-length",) ],
+            "validated": time.time(),
+        }
+        save_json(metafile, meta)
+        _validated.add(url)
+        _evict(keep=path)
+        return path, meta, "miss"
+        
+def _store(resp):
+    "Writes a response to the download cache atomically, returning the path of the file"
+    import tempfile
+    dirname = _get_download_dir()
+    sha = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                buf = resp.read(1 << 16)
+                if not buf:
+                    break
+                sha.update(buf)
+                f.write(buf)
+        path = os.path.join(dirname, sha.hexdigest())
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        resp.close()
+    return path
+    
+def _touch(path):
+    "Marks a cached file as recently used"
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+        
+def _evict(keep=None):
+    "Removes the least recently used downloads until the cache fits in its size limit"
+    limit = int(os.environ.get("RAILGUN_DOWNLOAD_CACHE_SIZE", DOWNLOAD_CACHE_SIZE)) << 20
+    dirname = _get_download_dir()
+    files = []
+    for f in os.listdir(dirname):
+        path = os.path.join(dirname, f)
+        if len(f) == 64 and os.path.isfile(path):
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in sorted(files):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        log.debug("Evicting %s from the download cache" % path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+        
+def _check_members(tar, destpath, url):
+    "Raises IOError if extracting a tar archive into destpath would write, or link to, anything outside it"
+    root = os.path.realpath(destpath)
+    def inside(path, is_root=False):
+        path = os.path.realpath(os.path.join(root, path))
+        return path == root and is_root or path.startswith(root + os.sep)
+    for member in tar.getmembers():
+        if os.path.isabs(member.name) or not inside(member.name, member.isdir()):
+            raise IOError("Archive %s has a member outside its directory: %s" % (url, member.name))
+        if member.issym():
+            target = os.path.join(os.path.dirname(member.name), member.linkname)
+        elif member.islnk():
+            target = member.linkname
+        else:
+            continue
+        if os.path.isabs(member.linkname) or not inside(target, True):
+            raise IOError("Archive %s has a link outside its directory: %s -> %s" % (url, member.name, member.linkname))
+
+class HttpResource(Repository):
+    """A file downloaded over HTTP(S), through the download cache (see download). A tar archive
+    is checked out extracted, and any other file as the Dockerfile of the checkout."""
+    def checkout(self, url, local_path, subdir=None, dryrun=False, update_existing=False):
+        import tarfile, shutil
+        destpath = os.path.join(local_path, self.get_destination_name(url))
+        if dryrun:
+            print("(download %s to %s)" % (url, destpath))
+            return destpath
+        path = download(url)
+        marker = os.path.join(destpath, ".railgun-download")
+        if os.path.exists(marker) and open(marker).read() == os.path.basename(path):
+            return destpath
+        if os.path.exists(destpath):
+            shutil.rmtree(destpath)
+        os.makedirs(destpath)
+        if tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                _check_members(tar, destpath, url)
+                tar.extractall(destpath)
+        else:
+            shutil.copyfile(path, os.path.join(destpath, "Dockerfile"))
+        with open(marker, "w") as f:
+            f.write(os.path.basename(path))
+        return destpath
+        
+    def get_destination_name(self, url):
+        pth = os.path.basename(urlparse.urlparse(url).path.rstrip("/"))
+        for ext in (".tar.gz", ".tgz", ".tar.bz2", ".tar"):
+            if pth.endswith(ext):
+                pth = pth[:-len(ext)]
+        if not pth or pth == "Dockerfile":
+            pth = "download-%s" % hashlib.sha1(url).hexdigest()[:8]
+        return pth
@@ -0,0 +1,234 @@
+"""
+Distribution of built images from one host to others, so that each image is built only once.
+
+Images are streamed from 'docker save' on a source host to 'docker load' on the targets,
+through HostProvider.save_image and load_image. Alternatively, only the layers missing on each target are sent
+(see transfer_image_layers). Distribution proceeds as a relay tree: in each round, every host
+that already has the image serves up to 'fanout' new hosts at once, reading the image from
+the source only once per round. Hosts that received the image in one round are sources in the
+next, so the origin's uplink is not a bottleneck. Every target is verified to have the same
+image ID as the origin.
+"""
+import sys, os, time, threading, subprocess
+import tarfile, tempfile, json, hashlib
+import logging
+from .parallel import HostResult
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+def get_image_id(host, name):
+    "Returns the ID of an image on a host, or None if it does not exist"
+    image = host.get_image(name)
+    return image and image["id"]
+
+def transfer_image(name, source, targets, save_cmd=None):
+    """
+    Streams an image from 'docker save' on the source host to 'docker load' on each of the
+    targets simultaneously. Returns a dictionary {target: error}, with error None on success.
+    """
+    save = source.popen(save_cmd, stdout=subprocess.PIPE) if save_cmd else source.save_image(name)
+    loads = {}
+    errors = {}
+    for target in targets:
+        loads[target] = target.load_image()
+    sent = 0
+    for buf in iter(lambda: save.stdout.read(CHUNK_SIZE), ''):
+        sent += len(buf)
+        for target, proc in loads.items():
+            try:
+                proc.stdin.write(buf)
+            except IOError:
+                # The target gave up, keep serving the others
+                errors[target] = "'docker load' failed"
+                del loads[target]
+        if not loads:
+            break
+    save.stdout.close()
+    if save.wait():
+        error = "'docker save' of '%s' failed on %s" % (name, source.name)
+        for target in loads:
+            errors[target] = error
+    for target, proc in loads.items():
+        proc.stdin.close()
+        if proc.wait() and not target in errors:
+            errors[target] = "'docker load' failed"
+    for target in targets:
+        target.invalidate_inventory()
+        errors.setdefault(target, None)
+    log.debug("Sent %d bytes of image '%s' from %s to %s" % (sent, name, source.name, ', '.join(t.name for t in targets)))
+    return errors
+
+def get_layer_inventory(host):
+    """
+    Returns the layers present on a host, as a set of legacy image IDs and layer chain IDs,
+    using a single round-trip (with the docker CLI).
+    """
+    if host.get_transport() == "api":
+        client = host.get_docker_api().client
+        present = set(client.images(all=True, quiet=True))
+        for image_id in list(present):
+            present.update(_chain_ids((client.inspect_image(image_id).get("RootFS") or {}).get("Layers") or []))
+        return present
+    cmd = ("IDS=$(docker images -a -q --no-trunc | sort -u) ; echo $IDS ; echo -- ; "
+           "[ -z \"$IDS\" ] || docker inspect --format '{{json .RootFS.Layers}}' $IDS 2>/dev/null")
+    proc = host.popen(cmd, stdout=subprocess.PIPE)
+    out,_ = proc.communicate()
+    ids, _, layers = out.partition("--")
+    present = set(ids.split())
+    for line in layers.splitlines():
+        try:
+            diff_ids = json.loads(line)
+        except ValueError:
+            continue
+        present.update(_chain_ids(diff_ids or []))
+    return present
+
+def _chain_ids(diff_ids):
+    "Returns the chain IDs of each layer in a stack of layer diff IDs"
+    chain = None
+    chains = []
+    for diff_id in diff_ids:
+        if chain is None:
+            chain = diff_id
+        else:
+            chain = "sha256:" + hashlib.sha256("%s %s" % (chain, diff_id)).hexdigest()
+        chains.append(chain)
+    return chains
+
+def _layer_paths(tar):
+    """Returns a dictionary {path: layer ID or chain ID} of the layers in a 'docker save' archive, where path
+    is the directory of the layer (<id>/layer.tar layout) or its file (OCI layout, blobs/sha256/<digest>)"""
+    names = tar.getnames()
+    if "manifest.json" in names:
+        paths = {}
+        for image in json.load(tar.extractfile("manifest.json")):
+            config = json.load(tar.extractfile(image["Config"]))
+            chains = _chain_ids(config.get("rootfs", {}).get("diff_ids", []))
+            for layer, chain in zip(image["Layers"], chains):
+                if os.path.basename(layer) == "layer.tar":
+                    layer = os.path.dirname(layer)
+                paths[layer] = chain
+        return paths
+    # Legacy format, where each layer is an image whose ID is the directory name
+    return dict((n, n) for n in names if tar.getmember(n).isdir() and not "/" in n)
+
+def _is_under(name, paths):
+    "Returns True if an archive member is one of the paths, or in one of them"
+    while name:
+        if name in paths:
+            return True
+        name = os.path.dirname(name)
+    return False
+
+def transfer_image_layers(name, source, targets, save_cmd=None):
+    """
+    Like transfer_image, but sends each target only the layers it does not already have
+    (plus the image metadata). The image is spooled to a local temporary file first.
+    Returns a dictionary {target: error}, with error None on success.
+    """
+    save = source.popen(save_cmd, stdout=subprocess.PIPE) if save_cmd else source.save_image(name)
+    spool = tempfile.TemporaryFile()
+    for buf in iter(lambda: save.stdout.read(CHUNK_SIZE), ''):
+        spool.write(buf)
+    if save.wait():
+        error = "'docker save' of '%s' failed on %s" % (name, source.name)
+        return dict((t, error) for t in targets)
+    total = spool.tell()
+    spool.seek(0)
+    tar = tarfile.open(fileobj=spool)
+    layers = _layer_paths(tar)
+    members = tar.getmembers()
+    
+    errors = {}
+    for target in targets:
+        present = get_layer_inventory(target)
+        skip = set(p for p, layer in layers.items() if layer in present)
+        proc = target.load_image()
+        out = tarfile.open(fileobj=proc.stdin, mode="w|")
+        sent = 0
+        try:
+            for m in members:
+                if _is_under(m.name, skip):
+                    continue
+                out.addfile(m, tar.extractfile(m) if m.isreg() else None)
+                sent += m.size
+            out.close()
+            proc.stdin.close()
+        except IOError:
+            errors[target] = "'docker load' failed"
+        if proc.wait() and not target in errors:
+            errors[target] = "'docker load' failed"
+        target.invalidate_inventory()
+        errors.setdefault(target, None)
+        log.info("Sent %s to %s: %d of %d layers were already present, sent %d of %d bytes" % (name, target.name, len(skip), len(layers), sent, total))
+    tar.close()
+    spool.close()
+    return errors
+
+def sync_image(name, source, target):
+    "Copies an image from the source host to the target host, sending only the missing layers"
+    image_id = get_image_id(source, name)
+    if not image_id:
+        raise ValueError("Image '%s' does not exist on %s" % (name, source.name))
+    if get_image_id(target, name) == image_id:
+        log.info("Image '%s' is already on %s" % (name, target.name))
+        return
+    error = transfer_image_layers(name, source, [target])[target]
+    if error:
+        raise IOError(error)
+    if get_image_id(target, name) != image_id:
+        raise IOError("Image ID mismatch after transfer of '%s' to %s" % (name, target.name))
+    
+def distribute_image(name, origin, targets, fanout=2, callback=None, transfer=transfer_image):
+    """
+    Distributes an image from the origin host to the target hosts along a relay tree. Targets
+    that already have the image are skipped. Returns a list of HostResults, one per target;
+    the callback, if given, is called with each of them as it finishes.
+    """
+    image_id = get_image_id(origin, name)
+    if not image_id:
+        raise ValueError("Image '%s' does not exist on %s" % (name, origin.name))
+    results = dict((t, HostResult(t)) for t in targets)
+    def finish(target, error, start):
+        r = results[target]
+        r.elapsed = time.time() - start
+        r.ok = error is None
+        r.error = error
+        if callback: callback(r)
+
+    sources = [origin]
+    pending = []
+    for target in targets:
+        start = time.time()
+        if get_image_id(target, name) == image_id:
+            log.info("Image '%s' is already on %s" % (name, target.name))
+            finish(target, None, start)
+            sources.append(target)
+        else:
+            pending.append(target)
+
+    while pending:
+        batches = []
+        for source in sources:
+            if not pending: break
+            batches.append((source, pending[:fanout]))
+            pending = pending[fanout:]
+        def relay(source, batch):
+            start = time.time()
+            log.info("Sending image '%s' from %s to %s" % (name, source.name, ', '.join(t.name for t in batch)))
+            try:
+                errors = transfer(name, source, batch)
+            except Exception:
+                errors = dict((t, str(sys.exc_info()[1])) for t in batch)
+            for target in batch:
+                error = errors.get(target)
+                if error is None and get_image_id(target, name) != image_id:
+                    error = "Image ID mismatch after transfer"
+                finish(target, error, start)
+        threads = [ threading.Thread(target=relay, args=b) for b in batches ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        for source, batch in batches:
+            sources += [ t for t in batch if results[t].ok ]
+    return [ results[t] for t in targets ]
@@ -0,0 +1,173 @@
+"""
+Access to the Docker Engine API of hosts, as an alternative to running the docker CLI on them.
+
+Hosts with 'transport: api' are accessed through docker-py. The API endpoint is the host's
+'docker_url' if set (e.g. tcp://10.1.12.10:2376), and otherwise the host's Docker socket
+('docker_socket', default /var/run/docker.sock), forwarded to a local socket through SSH.
+The local host uses its socket directly.
+
+Builds that do not use a builder container, the image inventory and image transfers use the
+API. Builder containers and shell commands still run through HostProvider.popen.
+"""
+import sys, os, time, threading, subprocess, tempfile, shutil, atexit
+import docker
+from . import parallel
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+CHUNK_SIZE = 1 << 16
+TUNNEL_TIMEOUT = 30
+
+# docker-py 2.x renamed the low-level client
+_Client = getattr(docker, "APIClient", None) or docker.Client
+
+def _chunks(f):
+    "Reads a file in chunks, for sending as a chunked HTTP request body"
+    return iter(lambda: f.read(CHUNK_SIZE), '')
+
+def _supports(func, argument):
+    "Returns True if a docker-py method accepts an argument (which depends on the docker-py version)"
+    import inspect
+    return argument in inspect.getargspec(func).args
+
+class ApiProcess(object):
+    """
+    Runs an API call on a thread, behind the subset of the subprocess.Popen interface used for
+    docker CLI processes. With stdin, func receives an iterator over the data written to stdin.
+    With stdout, func receives a file to write the data to be read from stdout to.
+    """
+    def __init__(self, func, stdin=False, stdout=False):
+        self.stdin = self.stdout = None
+        self.returncode = None
+        self.error = None
+        self._pipes = []
+        args = []
+        if stdin:
+            r, w = os.pipe()
+            self.stdin = os.fdopen(w, "wb")
+            data = os.fdopen(r, "rb")
+            self._pipes.append(data)
+            args.append(_chunks(data))
+        if stdout:
+            r, w = os.pipe()
+            self.stdout = os.fdopen(r, "rb")
+            out = os.fdopen(w, "wb")
+            self._pipes.append(out)
+            args.append(out)
+        self._prefix = parallel.current_prefix()
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        parallel._context.prefix = self._prefix
+        try:
+            func(*args)
+            self.returncode = 0
+        except Exception:
+            self.error = sys.exc_info()[1]
+            log.error(str(self.error))
+            self.returncode = 1
+        finally:
+            # Writers get EPIPE and readers EOF, also if the call failed half-way
+            for f in self._pipes:
+                f.close()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        # Join in short steps, so that KeyboardInterrupt gets through
+        while self._thread.is_alive():
+            self._thread.join(0.5)
+        return self.returncode
+
+class DockerApi(object):
+    "A Docker Engine API connection to a host"
+    host = None
+    client = None
+    def __init__(self, host):
+        self.host = host
+        self._tunnel = None
+        self._tempdir = None
+        url = host.root.get("docker_url")
+        if not url:
+            ssh = host.get_ssh_command(multiplex=False)
+            if ssh is None:
+                url = "unix://%s" % host.root.get("docker_socket", DEFAULT_SOCKET)
+            else:
+                url = "unix://%s" % self._forward(ssh)
+        log.debug("Using Docker API of %s at %s" % (host.name, url))
+        self.client = _Client(base_url=url, version="auto")
+
+    def _forward(self, ssh):
+        "Forwards the host's Docker socket to a local socket for the rest of the command, returning its path"
+        self._tempdir = tempfile.mkdtemp(prefix="railgun-docker-")
+        local = os.path.join(self._tempdir, "docker.sock")
+        remote = self.host.root.get("docker_socket", DEFAULT_SOCKET)
+        cmd = ssh + ["-N", "-oExitOnForwardFailure=yes", "-L", "%s:%s" % (local, remote)]
+        self._tunnel = subprocess.Popen(cmd)
+        atexit.register(self.close)
+        deadline = time.time() + TUNNEL_TIMEOUT
+        while not os.path.exists(local):
+            if self._tunnel.poll() is not None or time.time() > deadline:
+                self.close()
+                raise IOError("Failed to forward the Docker socket of %s" % self.host.name)
+            time.sleep(0.1)
+        return local
+
+    def close(self):
+        if self._tunnel and self._tunnel.poll() is None:
+            self._tunnel.terminate()
+            self._tunnel.wait()
+        if self._tempdir:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
+
+    def images(self):
+        "Returns the tagged images, as listed by the API"
+        return self.client.images()
+
+    def build(self, tag, no_cache=False, build_args=None, labels=None):
+        "Starts a build, returning a process object whose stdin should receive the (possibly compressed) build context"
+        options = {}
+        if labels:
+            if _supports(self.client.build, "labels"):
+                options["labels"] = labels
+            else:
+                log.warn("docker-py %s cannot set image labels in builds, so %s will be rebuilt on every push" % (docker.version, tag))
+        def build(data):
+            # Without stream, docker-py returns (id, output) once the build is done
+            for msg in self.client.build(fileobj=data, custom_context=True, tag=tag, nocache=no_cache, rm=True, stream=True,
+                    decode=True, buildargs=build_args or None, **options):
+                if "error" in msg:
+                    raise IOError(msg["error"].strip())
+                if "stream" in msg:
+                    self._output(msg["stream"])
+                elif "status" in msg:
+                    log.debug("%s: %s" % (tag, msg["status"]))
+        return ApiProcess(build, stdin=True)
+
+    def save(self, name):
+        "Starts saving an image, returning a process object whose stdout is the image archive"
+        def save(out):
+            image = self.client.get_image(name)
+            if hasattr(image, "read"):
+                shutil.copyfileobj(image, out, CHUNK_SIZE)
+            else:
+                # docker-py 3 and later return the archive as a generator of chunks
+                for chunk in image:
+                    out.write(chunk)
+        return ApiProcess(save, stdout=True)
+
+    def load(self):
+        "Starts loading images, returning a process object whose stdin should receive an image archive"
+        return ApiProcess(self.client.load_image, stdin=True)
+
+    def _output(self, text):
+        prefix = self.host.output_prefix or ""
+        with parallel.output_lock:
+            for line in text.splitlines(True):
+                sys.stdout.write(prefix + line)
+            sys.stdout.flush()
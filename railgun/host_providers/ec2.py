@@ -1,31 +1,119 @@
 from __future__ import print_function
 from ..site import *
 from ..checkout import _call
+from .. import cache
+import copy, time, urlparse
 import boto
+import boto.ec2
+from boto.ec2.regioninfo import RegionInfo
+
+# Seconds cluster membership is used from the discovery cache before it is refreshed
+DEFAULT_DISCOVERY_TTL = 60
+# After this many TTLs, cached membership is too old to use while refreshing
+MAX_STALENESS = 10
+# Seconds to wait at exit for background refreshes to be saved
+REFRESH_GRACE = 5
+
+_refreshes = []
+
+def _wait_for_refreshes():
+    deadline = time.time() + REFRESH_GRACE
+    for t in _refreshes:
+        t.join(max(0, deadline - time.time()))
         
 class EC2HostProvider(HostProvider):
     "Manages hosts on AWS EC2 using the boto module"
     conn = None
     filters = None
+    hostname = None
+    default_compression = "auto"
     
     def __init__(self, name, cluster, root, qualifier, parent):
         super(EC2HostProvider, self).__init__(name, cluster, root, qualifier, parent)
         self.root = root
         if cluster:
-            self.conn = boto.connect_ec2()
             self.filters = root.get("matching")
             if not self.filters:
                 self.filters = {'tag:Name':self.name}
         else:
             raise ValueError("EC2 provider should specify clusters, not hosts!")
         self.site = parent
+        self._instances = None
+        
+    def _connect(self):
+        """Connects to EC2 on first use. The 'region' and 'endpoint' attributes select where to
+        connect; an endpoint URL such as http://localhost:5000 allows using a local stub."""
+        if self.conn is None:
+            endpoint = self.root.get("endpoint")
+            region = self.root.get("region")
+            if endpoint:
+                url = urlparse.urlparse(endpoint)
+                self.conn = boto.ec2.connection.EC2Connection(region=RegionInfo(name=region or "local", endpoint=url.hostname),
+                    is_secure=(url.scheme == "https"), port=url.port, path=url.path or "/")
+            elif region:
+                self.conn = boto.ec2.connect_to_region(region)
+            else:
+                self.conn = boto.connect_ec2()
+        return self.conn
         
     def _get_instances(self):
-        return self.conn.get_only_instances(filters=self.filters) 
+        return self._connect().get_only_instances(filters=self.filters) 
+        
+    def _discover(self):
+        "Asks EC2 for the cluster's instances and updates the discovery cache"
+        instances = [ (inst.id, inst.ip_address) for inst in self._get_instances() ]
+        cache.save_json(self._get_discovery_file(), {"time": time.time(), "instances": instances})
+        return instances
+        
+    def _get_discovery_file(self):
+        key = json.dumps([self.root.get("endpoint"), self.root.get("region"), self.filters], sort_keys=True)
+        return os.path.join(cache.get_cache_dir("ec2"), "%s.json" % hashlib.sha1(key).hexdigest())
+        
+    def _refresh_in_background(self):
+        def refresh():
+            try:
+                self._discover()
+            except Exception:
+                log.debug("Failed to refresh the instances of %s: %s" % (self.name, sys.exc_info()[1]))
+        t = threading.Thread(target=refresh)
+        t.daemon = True
+        t.start()
+        if not _refreshes:
+            atexit.register(_wait_for_refreshes)
+        _refreshes.append(t)
         
     def get_instances(self):
-        for inst in self._get_instances():
-            yield (inst.id, inst.ip_address)
+        """Yields (instance ID, IP address) for the cluster's instances. Membership is read from the
+        discovery cache if younger than 'discovery_ttl' seconds. Older results are still used, but
+        refreshed in the background; EC2 is only queried directly if they are missing, too old,
+        or refresh_discovery is set."""
+        if self._instances is None:
+            ttl = self.root.get("discovery_ttl", DEFAULT_DISCOVERY_TTL)
+            cached = cache.load_json(self._get_discovery_file(), {})
+            age = time.time() - cached.get("time", 0)
+            if self.refresh_discovery or not "instances" in cached or age > ttl * MAX_STALENESS:
+                self._instances = self._discover()
+            else:
+                self._instances = [ tuple(i) for i in cached["instances"] ]
+                if age > ttl:
+                    log.debug("Refreshing the instances of %s (cached %d seconds ago)" % (self.name, age))
+                    self._refresh_in_background()
+        for inst in self._instances:
+            yield inst
+            
+    def get_instance_providers(self):
+        "Returns a provider for each running instance in the cluster"
+        providers = []
+        for instance_id, ip in self.get_instances():
+            if not ip: continue
+            p = copy.copy(self)
+            p.name = "%s/%s" % (self.name, instance_id)
+            p.hostname = ip
+            if self.root.get("user"):
+                p.hostname = "%s@%s" % (self.root["user"], ip)
+            p._init_state()
+            providers.append(p)
+        return providers
         
     def update_host(self, dryrun, scm_update, reboot):
         code = self.exec_shell("docker 2> /dev/null")
@@ -50,15 +138,18 @@ class EC2HostProvider(HostProvider):
         else:
             quote = lambda s:"'" + s.replace("'", "'\\''") + "'"
             l = map(quote, list(args))
-        cmd = ["ssh", self.hostname]
+        # A shared connection keeps the compression it was opened with, so compressed sessions get their own
+        cmd = self.get_ssh_command(multiplex=not compress)
         if tty: cmd.append("-t")
         if compress: cmd.append("-C")
         cmd.append(' '.join(l))
-        return subprocess.Popen(cmd, bufsize=bufsize, stdin=stdin, stdout=stdout, stderr=stderr)
+        return self._spawn(cmd, tty=tty, bufsize=bufsize, stdin=stdin, stdout=stdout, stderr=stderr)
             
     def start_shell(self):
         "Starts an interactive shell on this host"
-        cmd = ["ssh", self.hostname]
-        _call(cmd)
+        _call(self.get_ssh_command())
+        
+    def get_ssh_command(self, multiplex=True):
+        return ["ssh", self.hostname] + (self.get_ssh_options() if multiplex else [])
         
 HostProvider = EC2HostProvider
\ No newline at end of file
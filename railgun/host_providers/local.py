@@ -22,12 +22,9 @@ class LocalHostProvider(HostProvider):
         
         The additional tty and compress options are ignored.
         """ 
-        return subprocess.Popen(args, bufsize=bufsize, cwd=cwd, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
-            
-    def exec_shell(self, cmd, args=[], tty=None, stdin=None):
-        "Executes a shell command on this host"
-        cmd = [cmd] + args
-        return _call(cmd, stdin=stdin)
+        # Command strings are shell command lines, as on the remote hosts
+        shell = isinstance(args, str) or isinstance(args, unicode)
+        return self._spawn(args, tty=tty, bufsize=bufsize, cwd=cwd, env=env, stdin=stdin, stdout=stdout, stderr=stderr, shell=shell)
             
     def start_shell(self):
         "Starts an interactive shell on this host"
@@ -4,6 +4,7 @@ from ..checkout import _call
 class RemoteHostProvider(HostProvider):
     "Manages a site's host over SSH"
     hostname = None
+    default_compression = "auto"
     def __init__(self, name, cluster, root, qualifier, parent):
         super(RemoteHostProvider, self).__init__(name, cluster, root, qualifier, parent)
         self.root = root
@@ -37,15 +38,18 @@ class RemoteHostProvider(HostProvider):
         else:
             quote = lambda s:"'" + s.replace("'", "'\\''") + "'"
             l = map(quote, list(args))
-        cmd = ["ssh", self.hostname]
+        # A shared connection keeps the compression it was opened with, so compressed sessions get their own
+        cmd = self.get_ssh_command(multiplex=not compress)
         if tty: cmd.append("-t")
         if compress: cmd.append("-C")
         cmd.append(' '.join(l))
-        return subprocess.Popen(cmd, bufsize=bufsize, stdin=stdin, stdout=stdout, stderr=stderr)
+        return self._spawn(cmd, tty=tty, bufsize=bufsize, stdin=stdin, stdout=stdout, stderr=stderr)
             
     def start_shell(self):
         "Starts an interactive shell on this host"
-        cmd = ["ssh", self.hostname]
-        _call(cmd)
+        _call(self.get_ssh_command())
+        
+    def get_ssh_command(self, multiplex=True):
+        return ["ssh", self.hostname] + (self.get_ssh_options() if multiplex else [])
         
 HostProvider = RemoteHostProvider
\ No newline at end of file
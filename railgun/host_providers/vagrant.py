@@ -1,9 +1,16 @@
 from ..site import *
+from .. import cache
+import glob
+
+# File next to the Vagrantfile caching the output of 'vagrant ssh-config'
+SSH_CONFIG_CACHE = ".railgun-ssh-config"
+_ssh_config_lock = threading.Lock()
 
 class VagrantHostProvider(HostProvider):
     "Manages a site's host as a Vagrant-managed VM"
     dirname = None
     ssh_config = None
+    ssh_config_verified = False
     def __init__(self, name, cluster, root, qualifier, parent):
         super(VagrantHostProvider, self).__init__(name, cluster, root, qualifier, parent)
         self.dirname = os.path.abspath(os.path.dirname(parent.filename))
@@ -20,18 +27,18 @@ class VagrantHostProvider(HostProvider):
         
     def update_host(self, dryrun, scm_update, reboot):
         "Updates or creates this virtual machine"
-        scm = checkout.get_scm_provider(self.root["url"])
+        scm = checkout.get_scm_provider(self.root["url"], **self._get_scm_options())
         if scm:
             def update_hook(repo, post, change):
                 if post and change:
                     if reboot:
-                        _call(["vagrant","reload"],cwd=repo,dryrun=dryrun)
+                        self._call_local(["vagrant","reload"],cwd=repo,dryrun=dryrun)
                     else:
-                        print("Not rebooting '%s'." % name)
-                    _call(["vagrant","up"],cwd=repo,dryrun=dryrun)
+                        print("Not rebooting '%s'." % self.name)
+                    self._call_local(["vagrant","up"],cwd=repo,dryrun=dryrun)
             def clone_hook(repo, post):
                 if post:
-                    _call(["vagrant","up"],cwd=repo,dryrun=dryrun)
+                    self._call_local(["vagrant","up"],cwd=repo,dryrun=dryrun)
             scm.update_callback = update_hook
             scm.clone_callback = clone_hook
             dest = scm.checkout(self.root["url"], self.dirname, self.subdir, dryrun=dryrun, update_existing=scm_update)
@@ -46,7 +53,7 @@ class VagrantHostProvider(HostProvider):
             if code == 255:
                 if self.exec_shell("exit 0") == 255:
                     log.info("Host '%s' does not seem to be up.%s" % (self.name, [" Starting it.", ""][dryrun]))
-                    _call(["vagrant","up"],cwd=dest,dryrun=dryrun)
+                    self._call_local(["vagrant","up"],cwd=dest,dryrun=dryrun)
                 else:
                     log.warn("Host '%s': Docker command gave exit code %d." % (self.name, code))
             elif code == 127:
@@ -59,6 +66,15 @@ class VagrantHostProvider(HostProvider):
         else:
             print("Download")
             
+    def get_scm_repositories(self):
+        if checkout.get_scm_provider(self.root["url"]):
+            return [(self.root["url"], self._get_scm_options())]
+        return []
+        
+    def _get_scm_options(self):
+        "Returns the SCM options (ref, depth, filter) of the host"
+        return dict((k, self.root[k]) for k in checkout.SCM_OPTIONS if k in self.root)
+        
     def start_shell(self):
         "Starts an interactive shell on this host"
         cmd = ["vagrant","ssh"]        
@@ -79,18 +95,60 @@ class VagrantHostProvider(HostProvider):
             quote = lambda s:"'" + s.replace("'", "'\\''") + "'"
             l = map(quote, list(args))
         ssh = self._get_vagrant_ssh_command(l, tty, compress=compress)
-        return subprocess.Popen(ssh, bufsize=bufsize, cwd=self.vagrantdir, stdin=stdin, stdout=stdout, stderr=stderr)
+        return self._spawn(ssh, tty=tty, bufsize=bufsize, cwd=self.vagrantdir, stdin=stdin, stdout=stdout, stderr=stderr)
+        
+    def _get_machine_state(self):
+        "Returns what identifies the current VM: the Vagrantfile's modification time and the machine IDs"
+        vagrantfile = os.path.join(self.vagrantdir, self.root.get("vagrantfile", "Vagrantfile"))
+        state = [os.path.getmtime(vagrantfile) if os.path.exists(vagrantfile) else None]
+        for fn in sorted(glob.glob(os.path.join(self.vagrantdir, ".vagrant", "machines", "*", "*", "id"))):
+            with open(fn) as f:
+                state.append([os.path.relpath(fn, self.vagrantdir), f.read().strip()])
+        return state
         
-    def _get_vagrant_ssh_command(self, args, tty, compress=False):
+    def _read_ssh_config(self):
+        "Runs 'vagrant ssh-config' and stores the result in the cache file"
+        config,_ = subprocess.Popen(["vagrant","ssh-config"], cwd=self.vagrantdir, stdout=subprocess.PIPE).communicate()
+        parse = lambda x:x.strip().split(None, 2)
+        self.ssh_config = map(lambda t: "-o%s=%s" % (t[0], t[1]),(x for x in map(parse,config.split("\n")[1:]) if x))
+        cache.save_json(os.path.join(self.vagrantdir, SSH_CONFIG_CACHE), {"state": self._get_machine_state(), "options": self.ssh_config})
+        self.ssh_config_verified = True
+        
+    def _load_ssh_config(self):
+        """Sets ssh_config from the cache file if the VM has not changed since it was written, and checks
+        that it works. Otherwise, or if it fails, reads the configuration from Vagrant (which is slow)."""
+        cached = cache.load_json(os.path.join(self.vagrantdir, SSH_CONFIG_CACHE), {})
+        if cached.get("state") != self._get_machine_state() or not cached.get("options"):
+            log.debug("Reading SSH configuration of %s from Vagrant" % self.name)
+            self._read_ssh_config()
+            return
+        self.ssh_config = [ str(o) for o in cached["options"] ]
+        # Connecting also starts the shared connection (if enabled), so this is almost free
+        with open(os.devnull, "w") as null:
+            code = subprocess.call(self._ssh_command(["true"], False), cwd=self.vagrantdir, stdout=null, stderr=null)
+        if code == 255:
+            log.debug("Cached SSH configuration of %s failed, reading it from Vagrant" % self.name)
+            self._read_ssh_config()
+        self.ssh_config_verified = True
+        
+    def _get_vagrant_ssh_command(self, args, tty, compress=False, multiplex=True):
         # Vagrant-ssh messes up signal handling, so we use regular SSH with vagrant config
 
         # Read and parse Vagrant machine's SSH configuration
-        if not self.ssh_config:
-            config,_ = subprocess.Popen(["vagrant","ssh-config"], cwd=self.vagrantdir, stdout=subprocess.PIPE).communicate()
-            parse = lambda x:x.strip().split(None, 2)
-            self.ssh_config = map(lambda t: "-o%s=%s" % (t[0], t[1]),(x for x in map(parse,config.split("\n")[1:]) if x))
+        if not self.ssh_config_verified:
+            with _ssh_config_lock:
+                if not self.ssh_config_verified:
+                    self._load_ssh_config()
+        return self._ssh_command(args, tty, compress, multiplex)
+        
+    def get_ssh_command(self, multiplex=True):
+        return self._get_vagrant_ssh_command([], False, multiplex=multiplex)
+        
+    def _ssh_command(self, args, tty, compress=False, multiplex=True):
         # Run SSH with no configuration file to avoid conflicts with ~/.ssh/config
         cmd = ["ssh", "default", "-F/dev/null"] + self.ssh_config
+        # A shared connection keeps the compression it was opened with, so compressed sessions get their own
+        if multiplex and not compress: cmd += self.get_ssh_options()
         if tty: cmd.append("-t")
         else: cmd.append("-T")
         if compress: cmd.append("-C")
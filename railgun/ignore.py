@@ -0,0 +1,114 @@
+"""
+Exclusion of files from build contexts, using .railgunignore files.
+
+The patterns follow the .dockerignore syntax: one pattern per line, matched against the
+path relative to the build context root. '*' and '?' do not match '/', '**' matches any
+number of directories and a leading '!' re-includes paths excluded by earlier patterns.
+The last matching pattern wins. A path is also excluded if one of its parent directories is.
+"""
+import os, re
+import logging
+log = logging.getLogger(__name__)
+
+IGNORE_FILE = ".railgunignore"
+
+# SCM metadata is never needed to build a container
+DEFAULT_PATTERNS = ["**/.git", "**/.hg", "**/.svn", "**/.bzr", "**/CVS"]
+
+def _translate(pattern):
+    "Translates a dockerignore pattern to a regular expression"
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i+3] == '**/':
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+            elif pattern[i:i+2] == '**':
+                res.append('.*')
+                i += 2
+                continue
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j < 0:
+                res.append('\\[')
+            else:
+                cls = pattern[i+1:j]
+                if cls.startswith('!') or cls.startswith('^'):
+                    cls = '^' + cls[1:]
+                res.append('[%s]' % cls.replace('\\', '\\\\'))
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(res) + '$')
+
+class IgnoreRules(object):
+    "A list of dockerignore-compatible exclusion patterns"
+    rules = None
+    has_exceptions = False
+    def __init__(self, patterns=(), defaults=True):
+        self.rules = []
+        if defaults:
+            patterns = DEFAULT_PATTERNS + list(patterns)
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            exception = pattern.startswith('!')
+            if exception:
+                pattern = pattern[1:].strip()
+                self.has_exceptions = True
+            pattern = os.path.normpath(pattern).lstrip('/')
+            if pattern in ('', '.'):
+                continue
+            self.rules.append((_translate(pattern), exception))
+
+    @classmethod
+    def load(cls, rootdir, defaults=True):
+        "Reads the ignore file of a build context root directory, if any"
+        fn = os.path.join(rootdir, IGNORE_FILE)
+        patterns = []
+        if os.path.isfile(fn):
+            log.debug("Using ignore patterns from %s" % fn)
+            with open(fn) as f:
+                patterns = f.read().splitlines()
+        return cls(patterns, defaults)
+
+    def excluded(self, path):
+        "Returns True if a path relative to the build context root should be left out"
+        path = os.path.normpath(path)
+        parts = path.split(os.sep)
+        prefixes = [ '/'.join(parts[:i]) for i in range(1, len(parts) + 1) ]
+        excluded = False
+        for regex, exception in self.rules:
+            if excluded == (not exception):
+                # The rule cannot change the outcome
+                continue
+            for prefix in prefixes:
+                if regex.match(prefix):
+                    excluded = not exception
+                    break
+        return excluded
+
+def tree_size(path):
+    "Returns the number of files and total size of a file or directory tree, without following links"
+    if not os.path.isdir(path) or os.path.islink(path):
+        return 1, os.lstat(path).st_size
+    count, size = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+                count += 1
+            except OSError:
+                pass
+    return count, size
@@ -0,0 +1,93 @@
+"""
+Index of the services defined in a directory of specs, such as the built-in builders.
+
+The index maps the qualified names of the services (with and without namespace) to the spec
+defining them, so that resolving a logical reference does not require parsing every spec in
+the directory. It is persisted in the cache directory and kept up to date using the
+modification times of the specs: only new or modified specs are parsed again.
+"""
+import sys, os, hashlib, threading
+from . import cache
+import logging
+log = logging.getLogger(__name__)
+
+SPEC_FILES = ("services.yml", "Dockerfile")
+
+def _stamp(path):
+    "Returns the latest modification time of a spec file or directory"
+    paths = [path]
+    if os.path.isdir(path):
+        paths += [ os.path.join(path, f) for f in SPEC_FILES ]
+    return max(os.stat(p).st_mtime for p in paths if os.path.exists(p))
+
+class SpecIndex(object):
+    "Resolves qualified service names to the services defined in a directory of specs"
+    dirname = None
+    filename = None
+    def __init__(self, dirname, load):
+        "load(path) parses the spec at path into a Project"
+        self.dirname = os.path.abspath(dirname)
+        self.load = load
+        self.filename = os.path.join(cache.get_cache_dir("index"), "%s.json" % hashlib.sha1(self.dirname).hexdigest())
+        self._names = None
+        self._projects = {}
+        self._lock = threading.Lock()
+
+    def _update(self):
+        "Reads the index and re-parses the specs that changed since it was written"
+        entries = cache.load_json(self.filename, {}).get("entries", {})
+        current = {}
+        changed = False
+        for f in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, f)
+            try:
+                stamp = _stamp(path)
+            except (OSError, ValueError):
+                continue
+            entry = entries.get(f)
+            if not entry or entry["stamp"] != stamp:
+                entry = {"stamp": stamp, "services": {}}
+                try:
+                    proj = self._project(path)
+                except:
+                    log.debug("Not indexing %s: %s" % (path, sys.exc_info()[1]))
+                else:
+                    for svc in proj.services:
+                        entry["services"][svc.qualified_name()] = svc.name
+                        entry["services"].setdefault(svc.qualified_name(True), svc.name)
+                changed = True
+            current[f] = entry
+        if changed or len(current) != len(entries):
+            log.debug("Updating index of %s" % self.dirname)
+            cache.save_json(self.filename, {"dirname": self.dirname, "entries": current})
+        self._names = {}
+        for f in sorted(current):
+            for name, svc in current[f]["services"].items():
+                self._names.setdefault(name, (os.path.join(self.dirname, f), svc))
+
+    def _project(self, path):
+        proj = self._projects.get(path)
+        if proj is None:
+            proj = self._projects[path] = self.load(path)
+        return proj
+
+    def names(self):
+        "Returns the qualified names of the indexed services"
+        with self._lock:
+            if self._names is None:
+                self._update()
+            return sorted(self._names)
+
+    def lookup(self, reference):
+        "Returns the service with the qualified name, or None"
+        with self._lock:
+            if self._names is None:
+                self._update()
+            found = self._names.get(reference)
+            if not found:
+                return None
+            path, name = found
+            for svc in self._project(path).services:
+                if svc.name == name:
+                    return svc
+            return None
@@ -0,0 +1,273 @@
+"""
+Runs an operation on several hosts concurrently, on a bounded number of worker threads.
+
+Each host gets an optional deadline. When it passes, the local processes started on behalf of
+the host (SSH sessions etc.) are killed, so that the operation fails promptly. Log messages
+emitted while working on a host are prefixed with the host name.
+
+run_dag similarly runs an operation on the nodes of a dependency graph, such as the services
+of a project, starting each node as soon as its prerequisites are done.
+"""
+from __future__ import print_function
+import sys, time, threading, traceback, contextlib
+from collections import defaultdict
+import logging
+log = logging.getLogger(__name__)
+
+_context = threading.local()
+output_lock = threading.Lock()
+
+def current_prefix():
+    "Returns the name of the host the current thread is working on, if any"
+    return getattr(_context, "prefix", None)
+
+class _PrefixFilter(logging.Filter):
+    "Records the prefix of the emitting thread on log records, as their host_prefix attribute"
+    def filter(self, record):
+        if not hasattr(record, "host_prefix"):
+            record.host_prefix = current_prefix()
+        return True
+
+class _PrefixFormatter(logging.Formatter):
+    "Formats records with another formatter, their message prefixed with their host_prefix"
+    def __init__(self, formatter):
+        logging.Formatter.__init__(self)
+        self.formatter = formatter or logging._defaultFormatter
+
+    def format(self, record):
+        prefix = getattr(record, "host_prefix", None)
+        if prefix:
+            # The record is shared by all handlers, format a copy
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = "[%s] %s" % (prefix, record.getMessage())
+            record.args = ()
+        return self.formatter.format(record)
+
+_filter = _PrefixFilter()
+_filter_users = [0]
+_filter_lock = threading.Lock()
+
+@contextlib.contextmanager
+def prefixed_logging():
+    "Prefixes log messages with the name of what the emitting thread works on, while active"
+    with _filter_lock:
+        if not _filter_users[0]:
+            for h in logging.getLogger().handlers:
+                h.addFilter(_filter)
+                h.setFormatter(_PrefixFormatter(h.formatter))
+        _filter_users[0] += 1
+    try:
+        yield
+    finally:
+        with _filter_lock:
+            _filter_users[0] -= 1
+            if not _filter_users[0]:
+                for h in logging.getLogger().handlers:
+                    h.removeFilter(_filter)
+                    if isinstance(h.formatter, _PrefixFormatter):
+                        h.setFormatter(h.formatter.formatter)
+
+class HostResult(object):
+    "The outcome of an operation on one host"
+    host = None
+    ok = False
+    timed_out = False
+    cancelled = False
+    error = None
+    elapsed = 0.0
+    def __init__(self, host):
+        self.host = host
+
+    def status(self):
+        if self.ok: return "ok"
+        if self.timed_out: return "TIMEOUT"
+        if self.cancelled: return "CANCELLED"
+        return "FAILED"
+
+class HostRunner(object):
+    """
+    Calls func(host) for each host, at most 'workers' at a time. If timeout is set, it is the
+    maximum number of seconds allowed per host. The callback, if given, is called with the
+    HostResult as each host finishes. cancel() stops hosts that have not started, and aborts
+    those that are running.
+    """
+    def __init__(self, workers=4, timeout=None, callback=None):
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.callback = callback
+        self.cancelled = threading.Event()
+        self._running = []
+        self._lock = threading.Lock()
+
+    def run(self, hosts, func):
+        "Runs the operation on all hosts and returns the list of HostResults, in host order"
+        results = [ HostResult(host) for host in hosts ]
+        slots = threading.Semaphore(self.workers)
+        with prefixed_logging():
+            try:
+                runners = []
+                for result in results:
+                    t = threading.Thread(target=self._supervise, args=(result, func, slots))
+                    t.daemon = True
+                    t.start()
+                    runners.append(t)
+                for t in runners:
+                    # Join in short steps, so that KeyboardInterrupt gets through
+                    while t.is_alive():
+                        t.join(0.5)
+            except KeyboardInterrupt:
+                self.cancel()
+                raise
+        return results
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            for host in self._running:
+                host.abort()
+
+    def _supervise(self, result, func, slots):
+        with slots:
+            if self.cancelled.is_set():
+                result.cancelled = True
+                self._finished(result)
+                return
+            with self._lock:
+                self._running.append(result.host)
+            start = time.time()
+            worker = threading.Thread(target=self._work, args=(result, func))
+            worker.daemon = True
+            worker.start()
+            worker.join(self.timeout)
+            if worker.is_alive():
+                result.timed_out = True
+                result.error = "Timed out after %d seconds" % self.timeout
+                result.host.abort()
+                # Give the operation a moment to notice that its processes are gone
+                worker.join(5)
+            result.elapsed = time.time() - start
+            with self._lock:
+                self._running.remove(result.host)
+            if self.cancelled.is_set() and not result.ok:
+                result.cancelled = True
+            self._finished(result)
+
+    def _work(self, result, func):
+        _context.prefix = result.host.name
+        result.host.output_prefix = "[%s] " % result.host.name
+        try:
+            func(result.host)
+            if not result.timed_out:
+                result.ok = True
+        except:
+            if not result.timed_out:
+                result.error = sys.exc_info()[1]
+            log.debug(traceback.format_exc())
+        finally:
+            _context.prefix = None
+
+    def _finished(self, result):
+        if self.callback:
+            self.callback(result)
+
+def run_on_hosts(hosts, func, workers=4, timeout=None, callback=None):
+    "Convenience wrapper around HostRunner.run"
+    return HostRunner(workers, timeout, callback).run(hosts, func)
+
+def run_dag(deps, func, workers=4, label=str):
+    """
+    Calls func(node) for each node of a dependency graph {node: [prerequisite nodes]}, at most
+    'workers' at a time. Each node starts as soon as all its prerequisites have succeeded.
+    Returns a dictionary {node: error} of the nodes that failed, or were skipped because a
+    prerequisite failed.
+    """
+    remaining = dict((node, set(d)) for node, d in deps.items())
+    dependents = defaultdict(set)
+    for node, d in deps.items():
+        for prerequisite in d:
+            dependents[prerequisite].add(node)
+    errors = {}
+    ready = sorted(node for node, d in remaining.items() if not d)
+    running = [0]
+    cond = threading.Condition()
+    outer = current_prefix()
+
+    def skip(node, reason):
+        for dependent in dependents[node]:
+            if dependent in remaining:
+                del remaining[dependent]
+                errors[dependent] = reason
+                skip(dependent, reason)
+
+    def work(node):
+        name = label(node)
+        _context.prefix = outer and "%s/%s" % (outer, name) or name
+        error = None
+        try:
+            func(node)
+        except:
+            error = sys.exc_info()[1]
+            log.debug(traceback.format_exc())
+        finally:
+            _context.prefix = outer
+        with cond:
+            running[0] -= 1
+            if error is not None:
+                errors[node] = error
+                skip(node, "Prerequisite '%s' failed" % name)
+            else:
+                for dependent in dependents[node]:
+                    if dependent in remaining:
+                        remaining[dependent].discard(node)
+                        if not remaining[dependent]:
+                            ready.append(dependent)
+            cond.notify_all()
+
+    def schedule():
+        with cond:
+            while ready or running[0]:
+                while ready and running[0] < workers:
+                    node = ready.pop(0)
+                    del remaining[node]
+                    running[0] += 1
+                    t = threading.Thread(target=work, args=(node,))
+                    t.daemon = True
+                    t.start()
+                # Woken up as each node finishes
+                cond.wait()
+
+    with prefixed_logging():
+        scheduler = threading.Thread(target=schedule)
+        scheduler.daemon = True
+        scheduler.start()
+        if isinstance(threading.current_thread(), threading._MainThread):
+            # Join in short steps, so that KeyboardInterrupt gets through
+            while scheduler.is_alive():
+                scheduler.join(0.5)
+        else:
+            scheduler.join()
+    for node in remaining:
+        errors[node] = "Unresolvable dependencies"
+    return errors
+
+def _format_result(r):
+    line = "  %-24s %-9s %7.1fs" % (r.host.name, r.status(), r.elapsed)
+    if r.error:
+        line += "  %s" % r.error
+    return line
+
+def print_result(result, stream=None):
+    "Prints the outcome of a host, e.g. as a HostRunner callback to report progress"
+    with output_lock:
+        print(_format_result(result), file=stream or sys.stdout)
+
+def print_summary(results, title="Summary", stream=None):
+    "Prints the outcome of each host. Returns True if all succeeded."
+    stream = stream or sys.stdout
+    with output_lock:
+        print("%s:" % title, file=stream)
+        for r in results:
+            print(_format_result(r), file=stream)
+        ok = len([ r for r in results if r.ok ])
+        print("%d of %d hosts succeeded" % (ok, len(results)), file=stream)
+    return ok == len(results)
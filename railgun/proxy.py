@@ -0,0 +1,310 @@
+"""
+A caching HTTP proxy for the hosts of a site, so that files downloaded during builds (packages,
+archives etc.) are fetched from the Internet once and then served to every host.
+
+The proxy runs on one host of the site, or on the operator's machine, with 'railgun proxy'.
+Hosts whose 'proxy' attribute (or that of the site) is set pass it to their builds as the
+http_proxy build argument (see HostProvider.get_proxy).
+
+Plain HTTP GET requests are answered from the download cache (see checkout.fetch), which is
+shared with Railgun's own downloads. Cached files are revalidated with a conditional request
+when they were last validated more than max_age seconds ago. Requests carrying credentials,
+cookies or ranges, and responses marked private or not to be stored, are forwarded without
+caching, as are other methods. HTTPS (CONNECT) requests are tunneled, to port 443 only.
+Only clients in the allowed networks (by default loopback and private addresses) are served.
+The statistics of a running proxy are served as JSON at STATS_PATH.
+
+The http_proxy build argument only applies to RUN instructions: files added from URLs by ADD
+are downloaded by the Docker daemon itself, and base images are pulled over HTTPS, so neither
+goes through the proxy.
+"""
+from __future__ import print_function
+import sys, os, time, threading, socket, select, json, shutil, struct
+import urlparse, urllib2, httplib
+import BaseHTTPServer, SocketServer
+from . import checkout
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 3142
+DEFAULT_MAX_AGE = 60
+STATS_PATH = "/railgun-proxy/stats"
+CHUNK_SIZE = 1 << 16
+
+# Clients served unless others are allowed: loopback and private networks
+DEFAULT_ALLOW = ("127.0.0.0/8", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16")
+# Ports CONNECT may tunnel to
+CONNECT_PORTS = (443,)
+
+# Not passed on when forwarding
+_HOP_HEADERS = checkout.HOP_HEADERS
+# Requests whose answer may depend on the client, which are not answered from the cache
+_PRIVATE_REQUEST_HEADERS = ("authorization", "cookie", "range", "if-range")
+
+def _is_cacheable_request(headers):
+    if any(headers.get(h) for h in _PRIVATE_REQUEST_HEADERS):
+        return False
+    directives = (headers.get("Cache-Control") or "").lower() + " " + (headers.get("Pragma") or "").lower()
+    return not "no-store" in directives and not "no-cache" in directives
+
+def _is_cacheable_response(headers):
+    directives = (headers.get("Cache-Control") or "").lower()
+    if "no-store" in directives or "private" in directives:
+        return False
+    if headers.get("Set-Cookie"):
+        return False
+    # Responses are cached once per URL, whatever the request headers
+    vary = [ v.strip().lower() for v in (headers.get("Vary") or "").split(",") if v.strip() ]
+    return not [ v for v in vary if v != "accept-encoding" ]
+
+def _parse_network(network):
+    "Returns (address, mask) as integers for an IPv4 network such as 10.0.0.0/8"
+    address, _, bits = network.partition("/")
+    bits = int(bits or 32)
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    return struct.unpack("!I", socket.inet_aton(address))[0] & mask, mask
+
+class ProxyStats(object):
+    "Counts the requests served by a proxy, and the bytes served from its cache"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.forwarded = 0
+        self.tunneled = 0
+        self.errors = 0
+        self.bytes_served = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+
+    def record(self, kind, size=0):
+        "Records a request: kind is a checkout.fetch status, or 'forwarded', 'tunneled' or 'error'"
+        with self._lock:
+            self.requests += 1
+            if kind == "miss":
+                self.misses += 1
+                self.bytes_fetched += size
+            elif kind in ("hit", "revalidated", "stale"):
+                self.hits += 1
+                self.bytes_saved += size
+            elif kind == "forwarded":
+                self.forwarded += 1
+            elif kind == "tunneled":
+                self.tunneled += 1
+            else:
+                self.errors += 1
+            self.bytes_served += size
+
+    def as_dict(self):
+        with self._lock:
+            cacheable = self.hits + self.misses
+            return {
+                "uptime": time.time() - self.started,
+                "requests": self.requests,
+                "hits": self.hits,
+                "misses": self.misses,
+                "forwarded": self.forwarded,
+                "tunneled": self.tunneled,
+                "errors": self.errors,
+                "hit_rate": float(self.hits) / cacheable if cacheable else 0.0,
+                "bytes_served": self.bytes_served,
+                "bytes_saved": self.bytes_saved,
+                "bytes_fetched": self.bytes_fetched,
+            }
+
+def format_stats(stats):
+    "Formats proxy statistics (as returned by ProxyStats.as_dict) for printing"
+    return ("%(requests)d requests: %(hits)d cache hits, %(misses)d misses (hit rate %(hit_rate_pct).0f%%), "
+        "%(forwarded)d forwarded, %(tunneled)d tunneled, %(errors)d failed. "
+        "Served %(served)s, of which %(saved)s from the cache; fetched %(fetched)s" % dict(stats,
+            hit_rate_pct=stats["hit_rate"] * 100, served=_size(stats["bytes_served"]),
+            saved=_size(stats["bytes_saved"]), fetched=_size(stats["bytes_fetched"])))
+
+def _size(n):
+    for unit in ("bytes", "KiB", "MiB"):
+        if n < 1024:
+            return "%.0f %s" % (n, unit) if unit == "bytes" else "%.1f %s" % (n, unit)
+        n /= 1024.0
+    return "%.1f GiB" % n
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        if self.path.startswith("/"):
+            return self._local()
+        if not self.path.startswith("http://") or not _is_cacheable_request(self.headers):
+            # Requests that may get a client-specific answer are not cached
+            return self._forward()
+        try:
+            path, meta, status = checkout.fetch(self.path, max_age=self.server.max_age, cacheable=_is_cacheable_response)
+        except checkout.NotCacheable as e:
+            size = self._relay(e.response.getcode(), e.response.info(), e.response)
+            e.response.close()
+            self.server.stats.record("forwarded", size)
+            return
+        except urllib2.HTTPError as e:
+            # Relay the error
+            self.server.stats.record("forwarded")
+            self._relay(e.code, e.info(), e)
+            return
+        except Exception:
+            self.server.stats.record("error")
+            self.send_error(502, str(sys.exc_info()[1]))
+            return
+        size = os.path.getsize(path)
+        log.debug("%s %s" % (status.upper(), self.path))
+        self.send_response(200)
+        headers = meta.get("headers")
+        if headers is None:
+            # Cached by an earlier version, which kept fewer headers
+            headers = [ (header, meta[key]) for header, key in (("Content-Type", "content_type"), ("ETag", "etag"),
+                ("Last-Modified", "last_modified")) if meta.get(key) ]
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(size))
+        self.send_header("X-Cache", "MISS" if status == "miss" else "HIT")
+        self.end_headers()
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+        self.server.stats.record(status, size)
+
+    def do_HEAD(self):
+        self._forward()
+
+    def do_POST(self):
+        self._forward()
+
+    do_PUT = do_DELETE = do_OPTIONS = do_PATCH = do_POST
+
+    def do_CONNECT(self):
+        "Tunnels a connection (used for HTTPS), without caching"
+        host, _, port = self.path.partition(":")
+        try:
+            port = int(port or 443)
+            if not port in CONNECT_PORTS:
+                self.server.stats.record("error")
+                self.send_error(403, "Tunneling to port %d is not allowed" % port)
+                return
+            upstream = socket.create_connection((host, port))
+        except (socket.error, ValueError):
+            self.server.stats.record("error")
+            self.send_error(502, str(sys.exc_info()[1]))
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        size = 0
+        try:
+            sockets = [self.connection, upstream]
+            while True:
+                readable, _, failed = select.select(sockets, [], sockets, 60)
+                if failed or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(CHUNK_SIZE)
+                    if not data:
+                        return
+                    if s is upstream:
+                        self.connection.sendall(data)
+                        size += len(data)
+                    else:
+                        upstream.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            upstream.close()
+            self.server.stats.record("tunneled", size)
+
+    def _local(self):
+        "Answers requests to the proxy itself"
+        if self.path != STATS_PATH:
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.stats.as_dict())
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _forward(self):
+        "Forwards a request upstream without caching"
+        url = urlparse.urlparse(self.path)
+        if url.scheme != "http" or not url.hostname:
+            self.send_error(400, "Not a proxy request")
+            return
+        body = None
+        if self.headers.get("Content-Length"):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        headers = dict((k, v) for k, v in self.headers.items() if not k.lower() in _HOP_HEADERS)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        try:
+            conn = httplib.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+            conn.request(self.command, path, body, headers)
+            resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            self.server.stats.record("error")
+            self.send_error(502, str(sys.exc_info()[1]))
+            return
+        size = self._relay(resp.status, resp.msg, resp, self.command != "HEAD")
+        conn.close()
+        self.server.stats.record("forwarded", size)
+
+    def _relay(self, code, headers, body, send_body=True):
+        "Sends a response received from upstream, returning the number of bytes of body sent"
+        self.send_response(code)
+        for k in headers.keys():
+            if not k.lower() in _HOP_HEADERS:
+                for value in headers.getheaders(k):
+                    self.send_header(k, value)
+        self.end_headers()
+        size = 0
+        if send_body:
+            for data in iter(lambda: body.read(CHUNK_SIZE), ''):
+                self.wfile.write(data)
+                size += len(data)
+        return size
+
+    def log_message(self, format, *args):
+        log.debug("%s %s" % (self.client_address[0], format % args))
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "The caching proxy, serving each request on a thread"
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address="", port=DEFAULT_PORT, max_age=DEFAULT_MAX_AGE, allow=DEFAULT_ALLOW):
+        "allow lists the IPv4 networks (such as 10.1.12.0/24) of the clients served"
+        self.allow = [ _parse_network(n) for n in allow ]
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), ProxyHandler)
+        self.max_age = max_age
+        self.stats = ProxyStats()
+
+    def verify_request(self, request, client_address):
+        try:
+            address = struct.unpack("!I", socket.inet_aton(client_address[0]))[0]
+        except socket.error:
+            return False
+        if any(address & mask == network for network, mask in self.allow):
+            return True
+        log.warn("Refused connection from %s" % client_address[0])
+        return False
+
+    def get_url(self):
+        "Returns the URL of the proxy, as reachable from the local machine"
+        address, port = self.server_address[:2]
+        return "http://%s:%d" % (address if address not in ("", "0.0.0.0") else "127.0.0.1", port)
+
+    def start(self):
+        "Serves requests on a background thread, until shutdown() is called"
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return t
+
+def get_stats(url):
+    "Returns the statistics of a running proxy, given its URL"
+    return json.load(urllib2.urlopen(url.rstrip("/") + STATS_PATH))
@@ -2,13 +2,62 @@
 Manages a site.
 """
 from __future__ import print_function
-import yaml
-import sys, os, subprocess, tempfile, logging
+import sys, os, subprocess, tempfile, logging, posixpath, threading, json
+import atexit, shutil, hashlib, pipes, re
 import docker
-from . import checkout
+from . import checkout, parallel, docker_api, cache, sync
 _call = checkout._call
 log = logging.getLogger(__name__)
 
+# Build context stream compression methods, with the command that decompresses them on the host
+STREAM_DECOMPRESSORS = {"gzip": "gzip -dc", "bzip2": "bzip2 -dc"}
+STREAM_COMPRESSION_PREFERENCE = ("gzip", "bzip2")
+
+# Push modes: stream the whole context on every push, or synchronize a staged copy on the host
+PUSH_MODES = ("stream", "sync")
+# Relative to the home directory of the user on the host
+DEFAULT_STAGING_DIR = "~/.cache/railgun/staging"
+
+# Number of hosts updated at a time by SiteSpec.update
+DEFAULT_UPDATE_WORKERS = 8
+
+# How Docker is operated on a host: the docker CLI run through popen, or the Engine API (see docker_api)
+TRANSPORTS = ("cli", "api")
+
+# Lists the ID, tags and labels of every tagged image on a host, one image per line
+INVENTORY_CMD = ("IDS=$(docker images -q --no-trunc | sort -u) ; "
+    "[ -z \"$IDS\" ] || docker inspect --format '{{.Id}} {{json .RepoTags}} {{json .Config.Labels}}' $IDS 2>/dev/null")
+
+# An image ID, possibly abbreviated, as accepted by get_image
+_SHORT_ID = re.compile("^(sha256:)?[0-9a-f]{12,64}$")
+
+# Seconds an idle shared SSH connection is kept open (only while the command runs)
+DEFAULT_SSH_PERSIST = 60
+
+_control_dir = []
+_control_paths = []
+_control_lock = threading.Lock()
+
+def _get_control_path(name):
+    "Returns the socket path of the shared SSH connection to a host, for closing at exit"
+    with _control_lock:
+        if not _control_dir:
+            _control_dir.append(tempfile.mkdtemp(prefix="railgun-ssh-"))
+            atexit.register(_close_control_masters)
+        # Keep the path short, sockets paths are limited to ~100 characters
+        path = os.path.join(_control_dir[0], hashlib.sha1(name).hexdigest()[:16])
+        if not path in _control_paths:
+            _control_paths.append(path)
+        return path
+        
+def _close_control_masters():
+    "Closes the shared SSH connections opened by this command"
+    for path in _control_paths:
+        if os.path.exists(path):
+            with open(os.devnull, "w") as null:
+                subprocess.call(["ssh", "-F/dev/null", "-oControlPath=%s" % path, "-O", "exit", "_"], stdout=null, stderr=null)
+    shutil.rmtree(_control_dir[0], ignore_errors=True)
+
 class SiteSpec(object):
     root = None
     filename = None
@@ -25,7 +74,7 @@ class SiteSpec(object):
                 raise ValueError("File '%s' does not exist" % source)
         self.filename = source
         
-        d = yaml.load(file(source))
+        d = cache.load_yaml(source)
         
         if not isinstance(d, dict) or len(d) != 1 or not "site" in d:
             self._fail("Expected 'site' root element")
@@ -48,10 +97,31 @@ class SiteSpec(object):
         return providers
     
         
-    def update(self, hosts=None, dryrun=False, scm_update=False, reboot=False):
+    def update(self, hosts=None, dryrun=False, scm_update=False, reboot=False, workers=DEFAULT_UPDATE_WORKERS, timeout=None, callback=None):
+        """Updates the hosts (all by default) and cluster instances concurrently, at most 'workers' at a time,
+        allowing each at most 'timeout' seconds. Returns a list of parallel.HostResults; the callback, if
+        given, is called with each as the host finishes."""
         log.debug("%s site update of %s" % (["Performing","Simulating"][dryrun], self.filename))
+        instances = []
+        repos = []
         for provider in self.get_providers(hosts):
-            provider.update_host(dryrun=dryrun, scm_update=scm_update, reboot=reboot)
+            instances += provider.get_instance_providers()
+            repos += provider.get_scm_repositories()
+        if scm_update and repos:
+            # Find out which repositories changed upstream all at once, so that only those are pulled
+            checkout.probe_remote_heads([ (url, options.get("ref")) for url, options in repos ], workers)
+        if not dryrun:
+            # Clone or fetch the repositories of all hosts before updating any
+            fetches = []
+            for url, options in repos:
+                # With the options the host checks out with, as they select what the mirror holds
+                scm = checkout.get_scm_provider(url, **options)
+                if hasattr(scm, "prefetch"):
+                    fetches.append((url, lambda scm=scm, url=url: scm.prefetch(url, update=scm_update)))
+            checkout.report_prefetch(checkout.prefetch(fetches, workers))
+        def update(host):
+            host.update_host(dryrun=dryrun, scm_update=scm_update, reboot=reboot)
+        return parallel.run_on_hosts(instances, update, workers=workers, timeout=timeout, callback=callback)
         
     def hosts(self):
         "The hosts defined in this site specification"
@@ -116,6 +186,14 @@ class SiteSpec(object):
             mod = load_provider(typ.split('.'))
         p = mod.HostProvider(alias, cluster, h, "", self)
         return p
+        
+    def local_provider(self):
+        "Returns a provider for the local machine, whether or not the site defines it"
+        for alias, h in self.hosts().items():
+            if h.get("type") == "local":
+                return self.provider(alias)
+        from .host_providers import local
+        return local.HostProvider("local", False, {"type": "local"}, "", self)
             
     def _fail(self, message):
         if self.filename:
@@ -128,12 +206,52 @@ class HostProvider(object):
     name = None
     tempdir = None
     cluster = None
+    default_compression = None
+    _compression = None
+    push_mode = None
+    output_prefix = None
+    refresh_discovery = False # Bypass cached membership of clusters
     def __init__(self, name, cluster, root, qualifier, parent):
         self.name = name
         self.root = root
         self.site = parent
         self.tempdir = "$(mktemp -d /tmp/tarXXXXXX.$$)"
         self.cluster = cluster
+        self._init_state()
+        
+    def _init_state(self):
+        "Initializes the state kept for the duration of a command (also used when copying providers)"
+        self._processes = []
+        self._compression = None
+        self._pushes = {}
+        self._push_errors = {}
+        self._push_lock = threading.Lock()
+        self._inventory = None
+        self._inventory_lock = threading.Lock()
+        self._docker_api = None
+        self._docker_api_lock = threading.Lock()
+        self._control_master_lock = threading.Lock()
+        
+    def claim_push(self, name):
+        """Registers that a container is pushed to this host by the current command. Returns a tuple
+        (owner, event): the first caller is the owner, and must call push_done when finished. Others
+        should wait for the event and then check push_error."""
+        with self._push_lock:
+            event = self._pushes.get(name)
+            if event:
+                return False, event
+            event = self._pushes[name] = threading.Event()
+            return True, event
+            
+    def push_done(self, name, error=None):
+        with self._push_lock:
+            if error is not None:
+                self._push_errors[name] = error
+            self._pushes[name].set()
+            
+    def push_error(self, name):
+        "Returns the error of a failed push of a container during the current command, if any"
+        return self._push_errors.get(name)
         
     def get_service_instances(self, servicename=None):
         "Get service instances (of the given service if specified). Returns a dictionary of {instancename:dict}"
@@ -167,9 +285,106 @@ class HostProvider(object):
             self._fail("Invalid 'services' element")
         return d
         
+    def get_ssh_options(self):
+        """Returns the SSH client options for connecting to this host. Unless the host sets
+        ssh_multiplex to false, all sessions to the host share one connection, which is kept
+        open for ssh_persist seconds of inactivity and closed when the command exits. Sessions requesting
+        compression (popen's compress option) do not share it, as compression is set when it opens."""
+        if not self.root.get("ssh_multiplex", True):
+            return []
+        return ["-oControlMaster=auto",
+                "-oControlPath=%s" % _get_control_path(self.name),
+                "-oControlPersist=%s" % self.root.get("ssh_persist", DEFAULT_SSH_PERSIST)]
+        
     def should_download_remote_files(self):
-        "Return True if the host can download remote files, set to False if host has limited Internet access, for example"
-        return True
+        """Return True if the host can download remote files, set to False if host has limited Internet access, for example.
+        Set by the 'download_remote_files' host attribute."""
+        return bool(self.root.get("download_remote_files", True))
+        
+    def get_proxy(self):
+        """Returns the URL of the HTTP proxy builds on this host use for downloads (see proxy), or None. Set by the
+        'proxy' attribute of the host or else of the site; a host can opt out with 'proxy: false'."""
+        proxy = self.root.get("proxy")
+        if proxy is None and self.site and self.site.root:
+            proxy = self.site.root.get("proxy")
+        return proxy or None
+        
+    def get_build_args(self):
+        "Returns the build arguments passed to builds on this host: the proxy settings, if any"
+        proxy = self.get_proxy()
+        if not proxy:
+            return {}
+        # Docker predefines these build arguments, so Dockerfiles need not declare them
+        return {"http_proxy": proxy, "HTTP_PROXY": proxy}
+            
+    def get_stream_compression(self):
+        """Negotiates how build context streams are compressed when sent to this host. Returns a tuple
+        (method, level), where method is 'gzip', 'bzip2', 'ssh' (SSH transport compression) or None.
+        The 'compression' and 'compression_level' host attributes select the method ('auto' picks the
+        best one available) and level. If the host lacks the decompressor, another method is used."""
+        if self._compression is None:
+            method = self.root.get("compression", self.default_compression)
+            level = int(self.root.get("compression_level", 6))
+            if not 0 <= level <= 9:
+                self._fail("Invalid compression level %d for host '%s'" % (level, self.name))
+            if method in (None, False, "none", "ssh"):
+                self._compression = (method or None, level)
+                return self._compression
+            if method == "auto":
+                candidates = STREAM_COMPRESSION_PREFERENCE
+            elif method in STREAM_DECOMPRESSORS:
+                candidates = (method,) + tuple(m for m in STREAM_COMPRESSION_PREFERENCE if m != method)
+            else:
+                self._fail("Unsupported compression '%s' for host '%s'" % (method, self.name))
+            
+            # Ask the host which decompressors it has, in a single round-trip
+            probe = "for c in %s; do command -v $c > /dev/null 2>&1 && echo $c; done" % ' '.join(candidates)
+            proc = self.popen(probe, stdout=subprocess.PIPE)
+            available = proc.communicate()[0].split()
+            chosen = None
+            for m in candidates:
+                if m in available:
+                    chosen = m
+                    break
+            if method != "auto" and chosen != method:
+                log.info("Host '%s' cannot decompress %s, using %s" % (self.name, method, chosen or "no compression"))
+            log.debug("Using %s build context compression (level %d) for %s" % (chosen, level, self.name))
+            self._compression = (chosen, level)
+        return self._compression
+            
+    def get_push_mode(self):
+        "Returns how build contexts are sent to this host, 'stream' or 'sync' (from the 'push' host attribute)"
+        mode = self.push_mode or self.root.get("push", "stream")
+        if not mode in PUSH_MODES:
+            self._fail("Invalid push mode '%s' for host '%s'" % (mode, self.name))
+        return mode
+        
+    def get_transport(self):
+        "Returns how Docker is operated on this host, 'cli' or 'api' (from the 'transport' host attribute)"
+        transport = self.root.get("transport", "cli")
+        if not transport in TRANSPORTS:
+            self._fail("Invalid transport '%s' for host '%s'" % (transport, self.name))
+        return transport
+        
+    def get_docker_api(self):
+        "Returns the Docker API connection of this host, connecting on first use"
+        with self._docker_api_lock:
+            if self._docker_api is None:
+                self._docker_api = docker_api.DockerApi(self)
+            return self._docker_api
+            
+    def get_scm_repositories(self):
+        "Returns the SCM repositories this host is set up from, as a list of (url, options) tuples, see checkout.SCM_OPTIONS"
+        return []
+        
+    def get_ssh_command(self, multiplex=True):
+        "Returns the SSH client command line (without remote command) reaching this host, or None if not accessed over SSH"
+        return None
+        
+    def get_staging_dir(self, name):
+        """Returns the directory on this host holding the staged build context of a container. It may start
+        with ~/ for the home directory of the user on the host, see sync.quote_path."""
+        return posixpath.join(self.root.get("staging_dir", DEFAULT_STAGING_DIR), name)
             
     def exec_shell(self, cmd, args=None, tty=None, stdin=None):
         "Executes a shell command on this host"
@@ -189,38 +404,192 @@ class HostProvider(object):
         to emulate Popen. Not all of Popen's options are supported.""" 
         raise NotImplementedError("popen")
         
+    def _spawn(self, cmd, tty=False, **kwargs):
+        """Starts a local process (typically an SSH client) on behalf of this host. If output_prefix is
+        set, output not otherwise redirected is prefixed with it, line by line."""
+        pumps = []
+        if self.output_prefix and not tty:
+            for name in ("stdout", "stderr"):
+                if kwargs.get(name) is None:
+                    kwargs[name] = subprocess.PIPE
+                    pumps.append(name)
+        if pumps and "-oControlMaster=auto" in cmd:
+            # A session becoming the master of the shared connection would leave it running with our
+            # pipes, and the output threads would never see their end: open the master separately
+            self._open_control_master(cmd, kwargs.get("cwd"))
+            cmd = [ "-oControlMaster=no" if arg == "-oControlMaster=auto" else arg for arg in cmd ]
+        proc = subprocess.Popen(cmd, **kwargs)
+        for name in pumps:
+            t = threading.Thread(target=_prefix_output, args=(getattr(proc, name), getattr(sys, name), self.output_prefix))
+            t.daemon = True
+            t.start()
+            # Keep communicate() from competing with the thread
+            setattr(proc, name, None)
+        self._processes = [ p for p in self._processes if p.poll() is None ] + [proc]
+        return proc
+        
+    def _open_control_master(self, cmd, cwd=None):
+        "Starts the shared SSH connection of an SSH command line (if not running), with its output discarded"
+        path = [ arg[len("-oControlPath="):] for arg in cmd if arg.startswith("-oControlPath=") ]
+        ssh = self.get_ssh_command()
+        if not path or not ssh:
+            return
+        with self._control_master_lock:
+            if os.path.exists(path[0]):
+                return
+            with open(os.devnull, "r+") as null:
+                # Sessions fall back to their own connection if this fails
+                subprocess.call(ssh + ["-fN"], cwd=cwd, stdin=null, stdout=null, stderr=null)
+        
+    def _call_local(self, cmd, cwd=None, dryrun=False):
+        "Runs a local command (such as 'vagrant up') on behalf of this host, so that abort() stops it"
+        if dryrun:
+            print("(in %s)" % cwd)
+            print(' '.join(cmd))
+            return 0
+        return self._spawn(cmd, cwd=cwd).wait()
+        
+    def abort(self):
+        "Kills all processes still running on behalf of this host"
+        for proc in self._processes:
+            if proc.poll() is None:
+                log.debug("Killing process %d for %s" % (proc.pid, self.name))
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+        
+    def get_instance_providers(self):
+        "Returns a provider for each host instance managed by this provider (several for clusters)"
+        return [self]
+        
+    def get_inventory(self):
+        """Returns the images on this host as a dictionary {tag: {"id":..., "labels":{...}}}. The images
+        are listed once per command, until invalidate_inventory is called."""
+        with self._inventory_lock:
+            if self._inventory is None:
+                inventory = {}
+                for image_id, tags, labels in self._list_images():
+                    image = {"id": image_id, "labels": labels or {}}
+                    for tag in tags or []:
+                        inventory[tag] = image
+                    inventory[image_id] = image
+                log.debug("%d images on %s" % (len(set(i["id"] for i in inventory.values())), self.name))
+                self._inventory = inventory
+            return self._inventory
+            
+    def _list_images(self):
+        "Yields (ID, tags, labels) for each tagged image on this host"
+        if self.get_transport() == "api":
+            for image in self.get_docker_api().images():
+                yield image["Id"], image.get("RepoTags"), image.get("Labels")
+            return
+        proc = self.popen(INVENTORY_CMD, stdout=subprocess.PIPE)
+        out,_ = proc.communicate()
+        if proc.returncode:
+            raise IOError("Failed to list the images on %s. See errors above." % self.name)
+        for line in out.splitlines():
+            try:
+                image_id, tags, labels = line.split(' ', 2)
+                yield image_id, json.loads(tags), json.loads(labels)
+            except ValueError:
+                continue
+                
+    def save_image(self, name):
+        "Starts saving an image, returning a process object whose stdout is the image archive"
+        if self.get_transport() == "api":
+            return self.get_docker_api().save(name)
+        return self.popen("docker save '%s'" % name, stdout=subprocess.PIPE)
+        
+    def load_image(self):
+        "Starts loading images, returning a process object whose stdin should receive an image archive"
+        if self.get_transport() == "api":
+            return self.get_docker_api().load()
+        return self.popen("docker load", stdin=subprocess.PIPE)
+        
+    def invalidate_inventory(self):
+        "Discards the cached image inventory, after images were built or loaded on this host"
+        with self._inventory_lock:
+            self._inventory = None
+            
+    def get_image(self, name):
+        "Returns the inventory entry of an image by name, tag or ID, or None if it is missing"
+        inventory = self.get_inventory()
+        image = inventory.get(name)
+        if image is None and not ':' in name.split('/')[-1]:
+            image = inventory.get(name + ":latest")
+        if image is None and _SHORT_ID.match(name):
+            # Abbreviated image IDs, never tags
+            name = name if name.startswith("sha256:") else "sha256:" + name
+            for i in inventory.values():
+                image_id = i["id"] if i["id"].startswith("sha256:") else "sha256:" + i["id"]
+                if image_id.startswith(name):
+                    return i
+        return image
+        
     def check_container_exists(self, name):
-        cmd = "docker history %s > /dev/null 2>/dev/null" % name
-        if self.exec_shell(cmd) == 0:
+        if self.get_image(name):
             log.debug("Site container '%s' exists on %s" % (name, self.name))
             return True
         else:
             log.debug("Site container '%s' missing on %s" % (name, self.name))
             return False
+            
+    def get_image_label(self, name, label):
+        "Returns the value of a label of a container image on this host, or None if the image or label is missing"
+        image = self.get_image(name)
+        if image:
+            return image["labels"].get(label) or None
+        return None
         
-    def _build_service_container(self, builder, name, no_cache=False):
-        "Invokes a builder and returns a process object whose stdin should receive a tar stream of the project to build"      
+    def _build_service_container(self, builder, name, no_cache=False, compression=None, staged=None, labels=None):
+        """Invokes a builder and returns a process object whose stdin should receive a tar stream of the project to build.
+        The stream is expected to be compressed with the given method (see get_stream_compression).
+        If staged is set, the project is instead built from that staging directory on the host and stdin is unused.
+        The labels, if given, are set on the image built."""
         if not builder:
             raise ValueError("Empty builder attribute in service '%s'" % name)
         cmd = []
-        if builder == 'builder.none':
+        decompress = ""
+        if compression in STREAM_DECOMPRESSORS:
+            decompress = "%s | " % STREAM_DECOMPRESSORS[compression]
+        if staged:
+            staged = sync.quote_path(staged)
+        opts = ["-rm=true"]
+        if no_cache:
+            opts.append("--no-cache")
+        build_args = self.get_build_args()
+        for arg, value in sorted(build_args.items()):
+            opts.append("--build-arg '%s=%s'" % (arg, value.replace("'", "'\\''")))
+        for label, value in sorted((labels or {}).items()):
+            opts.append("--label %s" % pipes.quote("%s=%s" % (label, value)))
+        if builder == 'builder.none' and not staged and self.get_transport() == "api":
+            # The Engine API reads the build context (compressed or not) directly
+            return self.get_docker_api().build(name, no_cache=no_cache, build_args=build_args, labels=labels)
+        if builder == 'builder.none' and staged:
+            # Build directly from the staged copy of the project
+            cmd.append("docker build %s -t '%s' %s" % (' '.join(opts), name, staged))
+        elif builder == 'builder.none':
             # No builder container - use raw (used for bootstrapping and plain Dockerfiles)
             # In this case, just untar to a temp directory and run 'docker build'
-            opts = ["-rm=true"]
-            if no_cache:
-                opts.append("--no-cache")
             cmd += [ "TDIR=%s" % self.tempdir,
-                    "tar -xmC $TDIR",
+                    "%star -xmC $TDIR" % decompress,
                     "docker build %s -t '%s' $TDIR" % (' '.join(opts), name),
                     "EXITCODE=$?",
                     "rm -rf $TDIR",
                     "exit $EXITCODE"
                   ]
         else:
-            cmd.append("docker run -i -rm=true -v /var/run/:/host/var/run -e DOCKER_SOCK=unix:///host/var/run/docker.sock '%s' build" % builder)
+            if staged:
+                decompress = "tar -cC %s . | " % staged
+            env = ''.join(" -e '%s=%s'" % (arg, value.replace("'", "'\\''")) for arg, value in sorted(build_args.items()))
+            if labels:
+                # The builder sets them on the image (see build.build_container)
+                env += " -e %s" % pipes.quote("RAILGUN_LABELS=%s" % json.dumps(labels))
+            cmd.append(decompress + "docker run -i -rm=true -v /var/run/:/host/var/run -e DOCKER_SOCK=unix:///host/var/run/docker.sock%s '%s' build" % (env, builder))
         
         log.debug('Executing:\n  ' + '\n  '.join(cmd))
-        return self.popen(' ; '.join(cmd), stdin=subprocess.PIPE)
+        return self.popen(' ; '.join(cmd), stdin=subprocess.PIPE, compress=(compression == "ssh"))
         
     def get_node_ip(self):
         return "-"
@@ -233,3 +602,10 @@ class HostProvider(object):
         
     def __repr__(self):
         return "%s (%s)" % (self.name, type(self).__name__)
+        
+def _prefix_output(pipe, out, prefix):
+    for line in iter(pipe.readline, ''):
+        with parallel.output_lock:
+            out.write(prefix + line)
+            out.flush()
+    pipe.close()
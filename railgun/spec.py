@@ -1,15 +1,23 @@
 from __future__ import print_function
 import yaml
-import sys, os, time
-import shlex, shutil
-import tarfile, gzip, StringIO
-from . import checkout
+import sys, os, time, threading
+import shlex, shutil, copy
+import tarfile, gzip, StringIO, hashlib
+import zlib, bz2
+from . import checkout, sync, parallel, index, cache, catalog
+from .ignore import IgnoreRules, tree_size
 from xmlrpclib import Binary
 import logging
 log = logging.getLogger(__name__)
 
 VALID_TYPES = {"abstract", "shared", "builder", "default"}
 
+# Image label holding the content digest of the sources a container was built from
+DIGEST_LABEL = "railgun.digest"
+
+# Directory of the build context holding downloaded files, for hosts that cannot download them
+DOWNLOADS_DIR = ".railgun-downloads"
+
 # Allow specfiles to know where the metadata is located
 if not "RAILGUN_PACKAGE" in os.environ:
     os.environ["RAILGUN_PACKAGE"] = os.path.dirname(__file__)
@@ -22,11 +30,43 @@ if not "RAILGUN_FILES" in os.environ:
         if os.path.isdir(f):
             os.environ["RAILGUN_FILES"] = os.path.abspath(f)
     
+# Locks for checkout destinations, for use when pushing to several hosts at once
+_lock = checkout._lock
+# Guards the indexes and endpoint registries created on first use
+_locks_lock = threading.Lock()
+    
 def get_builders_dir():
     return os.path.join(os.path.dirname(__file__), '..', 'meta', 'builders')
     
 def get_services_dir():
     return os.path.join(os.path.dirname(__file__), '..', 'meta', 'services')
+    
+_indexes = {}
+
+def get_index(dirname):
+    "Returns the shared index of the services defined in a directory of specs"
+    dirname = os.path.abspath(dirname)
+    with _locks_lock:
+        if not dirname in _indexes:
+            _indexes[dirname] = index.SpecIndex(dirname, Project)
+        return _indexes[dirname]
+        
+def find_builtin_service(reference):
+    "Returns the built-in builder or service with the qualified name, or None"
+    if reference.startswith("builder."):
+        pfxdir = get_builders_dir()
+    else:
+        pfxdir = get_services_dir()
+    if not os.path.isdir(pfxdir):
+        return None
+    return get_index(pfxdir).lookup(reference)
+    
+def find_workspace_service(reference, workspace=None):
+    "Returns the service with the qualified name from the catalog of the workspace (by default $RAILGUN_WORKSPACE), or None"
+    workspace = catalog.get_workspace(workspace)
+    if workspace:
+        return workspace.get_service(reference)
+    return None
 
 
 class Project(object):
@@ -35,8 +75,12 @@ class Project(object):
     filename = None
     raw_docker = False
     name = None
-    def __init__(self, source=None):
+    workspace = None
+    _registry = None
+    def __init__(self, source=None, workspace=None):
+        "workspace is the root directory of the workspace services are also resolved from, by default $RAILGUN_WORKSPACE"
         self.services = []
+        self.workspace = workspace
         if not source: source = "."
         if os.path.isdir(source):
             self.name = os.path.basename(source)
@@ -64,7 +108,7 @@ class Project(object):
         else:
             # A services.yml-based spec
             self.filename = source
-            self.root = yaml.load(file(source))
+            self.root = cache.load_yaml(source)
             if not isinstance(self.root, dict):
                 self._fail("Invalid specfile, expected objects at root level")
             
@@ -73,14 +117,102 @@ class Project(object):
             
         self.validate()
         
-    def push_to(self, host, push_dependencies=False, force_update=False, no_cache=False):
-        for service in self.services:
-            service.push_to(host, force_update=force_update, no_cache=no_cache)
+    def push_to(self, host, push_dependencies=False, force_update=False, no_cache=False, max_builds=1):
+        """Pushes all services to the host. With max_builds > 1, services and their prerequisites are
+        built concurrently, in dependency order."""
+        if max_builds <= 1:
+            for service in self.services:
+                service.push_to(host, None, push_dependencies, force_update=force_update, no_cache=no_cache)
+            return
+        graph = self.get_build_graph(dependencies=push_dependencies)
+        def push(key):
+            graph[key][0].push_to(host, None, push_dependencies, force_update=force_update, no_cache=no_cache)
+        errors = parallel.run_dag(dict((k, deps) for k, (s, deps) in graph.items()), push, 
+            workers=max_builds, label=lambda k: graph[k][0].qualified_name())
+        if errors:
+            for key, error in sorted(errors.items()):
+                log.error("%s: %s" % (graph[key][0].qualified_name(), error))
+            raise Exception("Failed to push %d of %d services" % (len(errors), len(graph)))
+        
+    def get_build_graph(self, services=None, dependencies=True):
+        """Returns the dependency graph of the services (all by default) and their prerequisites, as a
+        dictionary {key: (service, [keys of prerequisites])}, see Service.key. Without dependencies, only
+        builders are prerequisites, as when pushing without -r."""
+        graph = {}
+        def visit(service, stack):
+            key = service.key()
+            if key in stack:
+                raise ValueError("Cyclic dependency towards '%s'" % service.qualified_name())
+            if not key in graph:
+                deps = [ visit(d, stack + [key]) for d in service.get_prerequisites(dependencies) ]
+                graph[key] = (service, deps)
+            return key
+        for service in services or self.services:
+            visit(service, [])
+        return graph
+        
+    def get_checkouts(self, services=None, dependencies=True):
+        """Returns the repositories and files the services (all by default) check out when built, as a list of
+        (service, url): container URLs, and builders and services required by URL. The services of the project
+        they depend on by name are included, and with dependencies, those implementing the endpoints they require."""
+        rootdir = os.path.dirname(self.filename)
+        registry = self.get_endpoint_registry()
+        selected = []
+        pending = list(services or self.services)
+        while pending:
+            service = pending.pop(0)
+            if service in selected:
+                continue
+            selected.append(service)
+            builder = service.get_builder()
+            pending += [ s for s in self.services if builder in (s.qualified_name(), s.qualified_name(True)) ]
+            if dependencies:
+                for endpoint in service.get_requires():
+                    if not checkout.is_url_or_file(endpoint):
+                        pending += registry.get_project_providers(endpoint)
+        checkouts = []
+        for service in selected:
+            urls = [ service.get_container_url(), service.get_builder() ] + service.get_requires()
+            for url in urls:
+                if url and checkout.get_local_file(url, rootdir) is None and (checkout.is_scm_url(url) or checkout.is_download_url(url)):
+                    checkouts.append((service, url))
+        return checkouts
+        
+    def prefetch(self, workers=4, update=False, services=None, dependencies=True):
+        """Clones (or with update, fetches) the repositories the services (all by default) check out, concurrently
+        and before building, logging the time taken per repository. See get_checkouts."""
+        selected = self.get_checkouts(services, dependencies)
+        checkouts = [ (url, lambda s=service, u=url: s.checkout(u, update_existing=update)) for service, url in selected ]
+        if update:
+            # Find out which repositories changed upstream all at once, so that only those are fetched
+            repos = []
+            for service, url in selected:
+                scm = checkout.get_scm_provider(url, **service.get_checkout_options(url))
+                if isinstance(scm, checkout.GitRepository):
+                    repos.append((url, scm.ref))
+            if repos:
+                checkout.probe_remote_heads(repos)
+        if checkouts:
+            checkout.report_prefetch(checkout.prefetch(checkouts, workers))
+        
+    def get_endpoint_registry(self):
+        "Returns the registry of the endpoints implemented by the services of this project and the workspace"
+        with _locks_lock:
+            if self._registry is None:
+                self._registry = EndpointRegistry(self.services, catalog.get_workspace(self.workspace))
+            return self._registry
         
     def get_service(self, svc):
+        "Returns a service of the project by name or qualified name, or else a built-in service"
         for service in self.services:
             if service.name == svc:
                 return service
+        for service in self.services:
+            if service.qualified_name() == svc or service.qualified_name(True) == svc:
+                return service
+        service = find_builtin_service(svc) or find_workspace_service(svc, self.workspace)
+        if service:
+            return service
         raise KeyError("Service '%s' not defined" % svc)
         
     def __repr__(self):
@@ -141,10 +273,24 @@ class Service(object):
             builder = "builder.%s" % builder
         return builder
         
-    def update_dependencies(self, host, dependencies=False, force_update=False):
-        if dependencies:
-            # TODO
-            pass
+    def update_dependencies(self, host, dependencies=False, force_update=False, no_cache=False):
+        "Pushes the providers of the endpoints this service requires, recursively, unless the host already has them"
+        if not dependencies:
+            return
+        available = None
+        if not force_update:
+            available = lambda service: host.check_container_exists(service.container_name())
+        for service in self.project.get_endpoint_registry().resolve(self, available):
+            log.info("Pushing '%s', required by '%s'" % (service.qualified_name(), self.qualified_name()))
+            service.push_to(host, None, False, force_update=force_update, no_cache=no_cache)
+            
+    def get_builder_version(self, host, builder):
+        """Returns what identifies the image of a builder on the host, so that services are rebuilt when their
+        builder changes: the digest of its sources, or else its image ID. None for builder.none or a missing image."""
+        image = host.get_image(builder) if builder != 'builder.none' else None
+        if not image:
+            return None
+        return image["labels"].get(DIGEST_LABEL) or image["id"]
             
     def update_prerequisite(self, reference, host, dependencies=False, force_update=True, no_cache=False, stack=None):
         if reference in ("builder.none",):
@@ -152,7 +298,23 @@ class Service(object):
         if stack is None:
             stack = [(os.path.realpath(self.project.filename),self.name)]
         log.info("Updating prerequisite '%s'" % reference)
-        service = None
+        service = self.resolve_reference(reference)
+        if service:
+            ent = (os.path.realpath(service.project.filename), service.name)
+            if ent in stack:
+                raise Exception("Cyclic dependency towards '%s'" % (ent,))
+            stack.append(ent)
+            # Pushing is cheap if the host already has the same digest
+            service.push_to(host, None, dependencies, force_update=force_update, no_cache=no_cache, stack=stack)
+            reference = service.qualified_name()
+        elif force_update or not host.check_container_exists(reference):
+            raise Exception("Reference to service '%s' could not be resolved." % reference)
+        return reference
+        
+    def resolve_reference(self, reference):
+        "Returns the service a builder or dependency reference (URL, file or logical name) refers to, or None if unknown"
+        if reference in ("builder.none",):
+            return None
         if checkout.is_url_or_file(reference):
             dest = self.checkout(reference)
             log.info("Checked out dependency URL %s to %s" % (reference, dest))
@@ -160,53 +322,79 @@ class Service(object):
             # Explicit reference name
             if '#' in reference:
                 svc = reference.split('#')[-1]
-            proj = Project(dest)
+            proj = Project(dest, workspace=self.project.workspace)
             if svc:
-                service = proj.get_service(svc)
-            else:
-                if len(proj.services) != 1:
-                    raise ValueError("Ambiguous service reference in '%s'" % reference)
-                service = proj.services[0]
-            ent = (os.path.realpath(proj.filename), service.name)
-            if ent in stack:
-                raise Exception("Cyclic dependency towards '%s'" % ent)
-            stack.append(ent)
-            service.push_to(host, None, dependencies, force_update=force_update, no_cache=no_cache, stack=stack)
-            reference = service.qualified_name()
-        else:
-            log.debug("Checking service by logical name '%s'" % reference)
-        
-        if force_update or not host.check_container_exists(reference):
-            log.info("Updating dependency/builder container '%s'" % reference)
-            if not service:
-                # Try to locate service source
-                # First in project
-                for svc in self.project.services:
-                    if svc.qualified_name() == reference or svc.qualified_name(False) == reference:
-                        service = svc
-                        break
-                # Then in builtins
-                if reference.startswith("builder."):
-                    pfxdir = get_builders_dir()
-                else:
-                    pfxdir = get_services_dir()
-                for f in os.listdir(pfxdir):
-                    if service: break
-                    try:
-                        proj = Project(os.path.join(pfxdir, f))
-                    except:
-                        continue
-                    for svc in self.project.services:
-                        if svc.qualified_name() == reference or svc.qualified_name(False) == reference:
-                            service = svc
-                            break
-                if not service:
-                    raise Exception("Reference to service '%s' could not be resolved." % reference)
-                    
-            
-        return reference
+                return proj.get_service(svc)
+            if len(proj.services) != 1:
+                raise ValueError("Ambiguous service reference in '%s'" % reference)
+            return proj.services[0]
+        log.debug("Checking service by logical name '%s'" % reference)
+        return self.find_service(reference)
+        
+    def get_requires(self):
+        "Returns the names of the endpoints this service requires"
+        requires = self.__root.get("requires") or []
+        if isinstance(requires, str) or isinstance(requires, unicode):
+            return [requires]
+        return list(requires)
+        
+    def get_implements(self):
+        "Returns the names of the endpoints this service implements"
+        implements = self.__root.get("implements") or []
+        if isinstance(implements, str) or isinstance(implements, unicode):
+            return [implements]
+        return list(implements)
+        
+    def get_prerequisites(self, dependencies=True):
+        """Returns the services to push before this one: its builder and, with dependencies, services referenced
+        by URL in 'requires' and the services of the project implementing the endpoints it requires"""
+        prerequisites = []
+        builder = self.resolve_reference(self.get_builder())
+        if builder:
+            prerequisites.append(builder)
+        if not dependencies:
+            return prerequisites
+        registry = self.project.get_endpoint_registry()
+        for endpoint in self.get_requires():
+            if checkout.is_url_or_file(endpoint):
+                prerequisites.append(self.resolve_reference(endpoint))
+                continue
+            for svc in registry.get_project_providers(endpoint):
+                if svc is not self and svc.project is self.project:
+                    prerequisites.append(svc)
+        return prerequisites
+        
+    def key(self):
+        "Returns a key identifying this service by specfile and name"
+        return (os.path.realpath(self.project.filename), self.name)
+        
+    def find_service(self, reference):
+        "Locates the source of a service by logical name, in this project, among the built-in services or in the workspace"
+        # First in project
+        for svc in self.project.services:
+            if svc.qualified_name() == reference or svc.qualified_name(True) == reference:
+                return svc
+        # Then in builtins, and finally in the workspace
+        return find_builtin_service(reference) or find_workspace_service(reference, self.project.workspace)
             
     def push_to(self, host, name=None, push_dependencies=False, force_update=False, no_cache=False, stack=None):
+        "Builds this service on the host, unless the current command already did"
+        container = self.container_name()
+        owner, done = host.claim_push(container)
+        if not owner:
+            done.wait()
+            error = host.push_error(container)
+            if error:
+                raise Exception("Push of '%s' failed: %s" % (container, error))
+            return
+        try:
+            self._push_to(host, name, push_dependencies, force_update, no_cache, stack)
+        except:
+            host.push_done(container, sys.exc_info()[1])
+            raise
+        host.push_done(container)
+        
+    def _push_to(self, host, name, push_dependencies, force_update, no_cache, stack):
         if name is None:
             services = host.get_service_instances(self.name)
             if not services:
@@ -214,33 +402,47 @@ class Service(object):
         else:
             services = [name]
         
-        builder = self.update_prerequisite(self.get_builder(), host, True, force_update, no_cache=no_cache)
-            
-        log.debug("Will build %s using builder '%s'" % (', '.join(services), builder))
-        proc = host._build_service_container(builder, self.container_name(), no_cache=no_cache)
+        builder = self.update_prerequisite(self.get_builder(), host, True, force_update, no_cache=no_cache, stack=stack)
+        self.update_dependencies(host, push_dependencies, force_update, no_cache=no_cache)
         
         # Should we download remote files, or should we let the target do it?
         remote = host.should_download_remote_files()
+        # Files the host cannot download itself are sent as part of the build context
+        inline = not remote
         if builder == 'builder.none':
             # Bootstrap builder cannot download files
             remote = False
         
-        # Wrap the pipe, since tarfile insists on calling 'tell'
-        class TarPipeWrapper(object):
-            fo = None
-            def __init__(self, fo):
-                self.fo = fo
-            def tell(self):
-                return 0
-            def write(self, *a, **kw):
-                self.fo.write(*a, **kw)
+        # Skip the transfer and the build if the host already has an image of the same sources
+        digest = self.digest(builder, remote=remote, inline=inline, builder_version=self.get_builder_version(host, builder))
+        if not force_update and host.get_image_label(self.container_name(), DIGEST_LABEL) == digest:
+            log.info("Container '%s' is up to date on %s (%s)" % (self.container_name(), host.name, digest[:12]))
+            return
+            
+        log.debug("Will build %s using builder '%s'" % (', '.join(services), builder))
+        # Also set by the builder, for contexts without a generated Dockerfile carrying it
+        labels = {DIGEST_LABEL: digest}
+        compression, level = host.get_stream_compression()
+        if host.get_push_mode() == "sync":
+            # Update the host's staged copy of the context and build from it
+            staged = host.get_staging_dir(self.container_name())
+            self.stage(host, staged, remote=remote, digest=digest, compress=bool(compression), inline=inline)
+            proc = host._build_service_container(builder, self.container_name(), no_cache=no_cache, staged=staged, labels=labels)
+        else:
+            proc = host._build_service_container(builder, self.container_name(), no_cache=no_cache, compression=compression, labels=labels)
             
-        # Package to process input
-        self.package(TarPipeWrapper(proc.stdin), remote=remote)
+            # Package to process input
+            # With SSH transport compression, the stream itself is sent as is
+            stream = CompressedStream(proc.stdin, None if compression == "ssh" else compression, level)
+            self.package(stream, remote=remote, digest=digest, inline=inline)
+            stream.close()
+            if stream.method:
+                log.info("Sent %d bytes of build context for '%s' as %d bytes (%s, %.1fx)" % (stream.bytes_in, self.name, stream.bytes_out, stream.method, stream.ratio()))
         
         last=""
         proc.stdin.close()
         proc.wait()
+        host.invalidate_inventory()
         if proc.returncode:
             raise Exception("Container build failed. See error messages above")
         
@@ -254,7 +456,11 @@ class Service(object):
         dirname = os.path.join(os.path.dirname(self.project.filename), 
             "build", self.project.name, self.name)
         if create and not os.path.isdir(dirname):
-            os.makedirs(dirname)
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created concurrently
+                if not os.path.isdir(dirname): raise
         return dirname
         
     def is_pure_container(self):
@@ -301,6 +507,28 @@ class Service(object):
                 if not fna.startswith('../') and os.path.exists(fna):
                     yield fna
             
+    def _inline_downloads(self, dockerfile, packaging):
+        """Downloads the files added from HTTP(S) URLs by the Dockerfile through the download cache, adds them to
+        the build context and rewrites the instructions to copy them from there"""
+        for line in dockerfile:
+            args = shlex.split(line)
+            if args[0].lower() == 'add':
+                srcs = [ a for a in args[1:-1] if not a.startswith('--') ]
+                if srcs and all(checkout.is_download_url(a) for a in srcs):
+                    options = [ a for a in args[1:-1] if a.startswith('--') ]
+                    files = []
+                    for url in srcs:
+                        path = checkout.download(url)
+                        # Keep the file name, which Docker takes from the URL
+                        name = os.path.basename(url.split('?')[0].rstrip('/')) or "download"
+                        arcname = "%s/%s/%s" % (DOWNLOADS_DIR, os.path.basename(path)[:16], name)
+                        packaging.addmap(path, arcname)
+                        files.append(arcname)
+                    # COPY, since ADD would extract local archives, unlike downloaded ones
+                    yield ' '.join(["COPY"] + options + files + [args[-1]])
+                    continue
+            yield line
+            
     def get_additional_dockerfile_instructions(self):
         if self.project.raw_docker:
             return
@@ -308,6 +536,17 @@ class Service(object):
             yield ''
         return
             
+    def get_container_url(self):
+        "Returns the URL of the container sources, if any"
+        return (self.__root.get("container") or {}).get("url")
+        
+    def get_checkout_options(self, url):
+        "Returns the SCM options (ref, depth, filter) for checking out an URL: those of the 'container' section if it is its URL"
+        container = self.__root.get("container") or {}
+        if container.get("url") != url:
+            return {}
+        return dict((k, container[k]) for k in checkout.SCM_OPTIONS if k in container)
+        
     def checkout(self, url, update_existing=False):
         "Checks out an URL into the build directory for further processing"
         rootdir = os.path.dirname(self.project.filename)
@@ -315,48 +554,88 @@ class Service(object):
         if pth:
             return pth
         else:
-            scm = checkout.get_scm_provider(url)
+            scm = checkout.get_scm_provider(url, **self.get_checkout_options(url)) or checkout.get_download_provider(url)
             if scm:
-                dest = scm.get_destination_name(url)
-                scm.checkout(url, self.get_build_dir(), update_existing=update_existing)
-                return os.path.join(self.get_build_dir(), dest)
+                dest = os.path.join(self.get_build_dir(), scm.get_destination_name(url))
+                with _lock(dest):
+                    scm.checkout(url, self.get_build_dir(), update_existing=update_existing)
+                return dest
             else:
                 raise ValueError("Url '%s' not possible to check out" % url)
         
                 
-    def package(self, outfile, update=False, local=True, remote=True):
+    def package(self, outfile, update=False, local=True, remote=True, digest=None, inline=False):
         """
         Download all local resources required to build this service and write a tar stream to the output file.
+        If a digest is given, it is added as a label to the generated Dockerfile. With inline, files added from
+        HTTP(S) URLs are downloaded and packaged too (see _inline_downloads).
         """
         log.debug("Packaging and streaming %s" % self.name)
-        with TarPackaging(outfile) as tar:
-            self._build(tar, update, local, remote, True)
+        with TarPackaging(outfile, ignore=IgnoreRules.load(self.get_directory())) as tar:
+            self._build(tar, update, local, remote, True, digest=digest, inline=inline)
+        self._report_skipped(tar)
         log.debug("Packaged %s" % self.name)
         
+    def stage(self, host, path, update=False, local=True, remote=True, digest=None, compress=False, inline=False):
+        """
+        Synchronizes the build context of this service to a staging directory on the host,
+        transferring only the files (or blocks of large files) that changed since the last time.
+        """
+        log.debug("Staging %s to %s on %s" % (self.name, path, host.name))
+        packaging = ManifestPackaging(ignore=IgnoreRules.load(self.get_directory()))
+        self._build(packaging, update, local, remote, True, digest=digest, inline=inline)
+        self._report_skipped(packaging)
+        stats = sync.sync_context(host, packaging.entries, path, compress=compress)
+        log.info("Staged build context for '%s': sent %d of %d bytes, %d files unchanged" % (self.name, stats["sent_bytes"], stats["total_bytes"], stats["unchanged"]))
+        
+    def digest(self, builder=None, update=False, local=True, remote=True, inline=False, builder_version=None):
+        """
+        Computes a digest of the resolved specification, the Dockerfile and all files that would
+        be packaged for this service (and the builder used, with builder_version identifying its
+        image, see get_builder_version), without writing any output.
+        """
+        packaging = DigestPackaging(ignore=IgnoreRules.load(self.get_directory()))
+        if builder:
+            packaging.addstr("%s %s" % (builder, builder_version or ""), '.builder')
+        self._build(packaging, update, local, remote, True, inline=inline)
+        cache.save_file_digests()
+        return packaging.hexdigest()
+        
     def build(self, update=False, local=True, remote=True, write=False):
         """
         Download all local/remote resources required to build this service and generate build instructions.
         """
         log.debug("Building %s" % self.name)
         dockerfile = write and not os.path.exists(os.path.join(self.get_directory(), "Dockerfile"))
-        self._build(LocalPackaging(self.get_directory(), write), update, local, remote, dockerfile)
+        packaging = LocalPackaging(self.get_directory(), write, ignore=IgnoreRules.load(self.get_directory()))
+        self._build(packaging, update, local, remote, dockerfile)
+        self._report_skipped(packaging)
+        
+    def _report_skipped(self, packaging):
+        files, size = packaging.skipped
+        if files:
+            log.info("Excluded %d files (%d bytes) from the build context of '%s'" % (files, size, self.name))
         
-    def _build(self, packaging, update, local, remote, dockerfile):
+    def _build(self, packaging, update, local, remote, dockerfile, digest=None, inline=False):
         def should_handle(url):
             lcl = checkout.url_is_local(url)
             return lcl and local or not lcl and remote
         
         # Create mutable copy of service
-        resolved = dict(self.__root)
+        resolved = copy.deepcopy(self.__root)
         
         rootdir = os.path.dirname(self.project.filename)
         container = resolved.get("container")
+        checked_out = False
         
         if container:
             url = container.get("url")
             if url and should_handle(url):
                 dest = self.checkout(url)
+                checked_out = True
                 del container["url"]
+                for option in checkout.SCM_OPTIONS:
+                    container.pop(option, None)
                 if "subdirectory" in container:
                     dest = os.path.join(dest, container["subdirectory"])
                     del container["subdirectory"]
@@ -368,9 +647,23 @@ class Service(object):
             for name,src in container.get("files", dict()).items():
                 packaging.addmap(src, name)
         df = list(self.get_dockerfile(local, remote))
+        if inline and container and container.get("dockerfile"):
+            source = list(self.get_dockerfile(local, remote, path=container["dockerfile"]))
+            if checked_out and _adds_local_files(source):
+                # The files it adds are relative to the checkout, not to the root of the context
+                log.warn("Not inlining the downloads of %s, as it also adds local files" % container["dockerfile"])
+            else:
+                inlined = list(self._inline_downloads(source, packaging))
+                if inlined != source:
+                    # Build from the Dockerfile generated at the root of the context, which copies the downloads
+                    df = inlined
+                    container["dockerfile"] = "Dockerfile"
         if df and "dockerfile" in container:
+            if digest:
+                df.append('LABEL %s="%s"' % (DIGEST_LABEL, digest))
             packaging.addstr('\n'.join(df), 'Dockerfile')
             
+        # yaml.dump sorts mapping keys, so the generated file is stable
         packaging.addstr(yaml.dump({self.name:resolved}), 'services.yml')
 
         # Add locally cached artifacts, if any
@@ -402,41 +695,295 @@ class Service(object):
     def _fail(self, message):
         return self.project._fail(message)
 
+class EndpointRegistry(object):
+    """Maps endpoint names to the services implementing them: those of a set of projects and,
+    if a workspace catalog is given, those of the workspace"""
+    def __init__(self, services=(), workspace=None):
+        self.providers = {}
+        self.workspace = workspace
+        for service in services:
+            self.add(service)
+            
+    def add(self, service):
+        for endpoint in service.get_implements():
+            self.providers.setdefault(endpoint, []).append(service)
+            
+    def get_project_providers(self, endpoint):
+        "Returns the services of the registered projects implementing the endpoint"
+        return self.providers.get(endpoint, [])
+        
+    def get_providers(self, endpoint):
+        "Returns the services implementing the endpoint, from the registered projects or else from the workspace"
+        providers = self.get_project_providers(endpoint)
+        if providers or not self.workspace:
+            return providers
+        return [ Project(os.path.dirname(r["spec"]), workspace=self.workspace.root).get_service(r["name"]) for r in self.workspace.implementing(endpoint) ]
+        
+    def get_provider(self, endpoint, service=None):
+        "Returns the one service providing an endpoint (required by service, if given)"
+        providers = self.get_providers(endpoint)
+        if service and len(providers) > 1:
+            # Prefer providers of the same project
+            providers = [ p for p in providers if p.project is service.project ] or providers
+        if not providers:
+            raise ValueError("No service implements endpoint '%s'" % endpoint)
+        if len(providers) > 1:
+            raise ValueError("Endpoint '%s' is implemented by several services: %s" % (endpoint, ', '.join(p.qualified_name() for p in providers)))
+        return providers[0]
+        
+    def resolve(self, service, available=None):
+        """Returns the services providing what a service requires, recursively, with providers before the
+        services requiring them. Endpoints with a provider for which available(provider) is true are
+        considered satisfied, and their providers' requirements are not followed."""
+        resolved = []
+        seen = set([service.key()])
+        def visit(svc):
+            for endpoint in svc.get_requires():
+                if checkout.is_url_or_file(endpoint):
+                    provider = svc.resolve_reference(endpoint)
+                    if available and available(provider):
+                        continue
+                else:
+                    if available and any(available(p) for p in self.get_providers(endpoint)):
+                        continue
+                    provider = self.get_provider(endpoint, svc)
+                if provider.key() in seen:
+                    continue
+                seen.add(provider.key())
+                visit(provider)
+                resolved.append(provider)
+        visit(service)
+        return resolved
+        
 class LocalPackaging:
-    def __init__(self, root, write):
+    def __init__(self, root, write, ignore=None):
         self.root = root
         self.write = write
+        self.ignore = ignore
+        self.skipped = [0, 0]
     
     def addrel(self, filename, rootdir):
         arcname = os.path.relpath(filename, rootdir)
-        log.debug("[f] %s" % arcname)
+        for p, a in _walk(filename, arcname, self.ignore, self.skipped):
+            log.debug("[f] %s" % a)
         return arcname
         
     def addstr(self, string, filename):
         log.debug("[g] %s:\n  %s" % (filename, '\n  '.join(string.split('\n'))))
         
+    def addmap(self, src, arcname):
+        src = os.path.expandvars(src)
+        for p, a in _walk(src, arcname, self.ignore, self.skipped):
+            log.debug("[m] %s (%s)" % (a, p))
+        
 class TarPackaging(tarfile.TarFile):
-    def __init__(self, outfile):
+    """
+    Writes the packaged files as a tar stream. In deterministic mode (the default), members are
+    added in sorted order with normalized owners, permissions and modification times, so that
+    identical sources always give identical streams (and Docker's build cache stays valid).
+    The modification time used is taken from $SOURCE_DATE_EPOCH, if set.
+    Paths matching the ignore rules, if given, are left out.
+    """
+    deterministic = True
+    mtime = 0
+    def __init__(self, outfile, deterministic=True, ignore=None):
         tarfile.TarFile.__init__(self, fileobj=outfile, mode='w')
+        self.deterministic = deterministic
+        self.mtime = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+        self.ignore = ignore
+        self.skipped = [0, 0]
         
     def addrel(self, filename, rootdir):
         arcname = os.path.relpath(filename, rootdir)
-        self.add(filename, arcname=arcname)
+        self._addpath(filename, arcname)
         log.debug("[F] %s" % arcname)
         return arcname
         
     def addstr(self, string, filename):
         tarinfo = tarfile.TarInfo(name=filename)
         tarinfo.size = len(string)
-        tarinfo.mtime = time.time()
+        if self.deterministic:
+            self._normalize(tarinfo)
+        else:
+            tarinfo.mtime = time.time()
         self.addfile(tarinfo=tarinfo, fileobj=StringIO.StringIO(string))
         log.debug("[G] %s" % filename)
         
     def addmap(self, src, arcname):
         src = os.path.expandvars(src)
-        self.add(src, arcname=arcname)
+        self._addpath(src, arcname)
         log.debug("[M] %s (%s)" % (arcname, src))
         
+    def _addpath(self, path, arcname):
+        for p, a in _walk(path, arcname, self.ignore, self.skipped):
+            tarinfo = self.gettarinfo(p, a)
+            if tarinfo is None:
+                # Sockets and other unsupported file types
+                continue
+            if self.deterministic:
+                self._normalize(tarinfo)
+            if tarinfo.isreg():
+                with open(p, "rb") as f:
+                    self.addfile(tarinfo, f)
+            else:
+                self.addfile(tarinfo)
+                
+    def _normalize(self, tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        tarinfo.mtime = self.mtime
+        if tarinfo.isdir() or tarinfo.mode & 0o111:
+            tarinfo.mode = 0o755
+        else:
+            tarinfo.mode = 0o644
+        return tarinfo
+        
+class CompressedStream(object):
+    "Write-only file object that optionally compresses the data written to an underlying pipe"
+    method = None
+    def __init__(self, fo, method=None, level=6):
+        self.fo = fo
+        self.method = method
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if method == "gzip":
+            # zlib writes a gzip header when 16 is added to the window size
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif method == "bzip2":
+            self.compressor = bz2.BZ2Compressor(max(level, 1))
+        elif method is None:
+            self.compressor = None
+        else:
+            raise ValueError("Unsupported stream compression '%s'" % method)
+            
+    def tell(self):
+        # tarfile insists on calling 'tell'
+        return 0
+        
+    def write(self, data):
+        self.bytes_in += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self._write(data)
+        
+    def close(self):
+        "Flushes the compressor. Does not close the underlying pipe."
+        if self.compressor:
+            self._write(self.compressor.flush())
+            self.compressor = None
+            
+    def ratio(self):
+        if not self.bytes_out:
+            return 1.0
+        return float(self.bytes_in) / self.bytes_out
+        
+    def _write(self, data):
+        if data:
+            self.bytes_out += len(data)
+            self.fo.write(data)
+        
+class ManifestPackaging(object):
+    "Collects the files that would be packaged, for synchronizing them to a host (see sync.py)"
+    def __init__(self, ignore=None):
+        self.entries = {}
+        self.ignore = ignore
+        self.skipped = [0, 0]
+        
+    def addrel(self, filename, rootdir):
+        arcname = os.path.relpath(filename, rootdir)
+        self._addpath(filename, arcname)
+        log.debug("[S] %s" % arcname)
+        return arcname
+        
+    def addstr(self, string, filename):
+        self._add(filename, {"type": "f", "mode": 0o644, "data": string})
+        
+    def addmap(self, src, arcname):
+        src = os.path.expandvars(src)
+        self._addpath(src, arcname)
+        
+    def _addpath(self, path, arcname):
+        for p, a in _walk(path, arcname, self.ignore, self.skipped):
+            if os.path.islink(p):
+                self._add(a, {"type": "l", "target": os.readlink(p)})
+            elif os.path.isdir(p):
+                self._add(a, {"type": "d", "mode": 0o755})
+            elif os.path.isfile(p):
+                mode = 0o755 if os.stat(p).st_mode & 0o111 else 0o644
+                self._add(a, {"type": "f", "mode": mode, "path": p})
+                
+    def _add(self, arcname, entry):
+        arcname = os.path.normpath(arcname)
+        # Parent directories are implicit in tar streams, but not here
+        parent = os.path.dirname(arcname)
+        while parent and not parent in self.entries:
+            self.entries[parent] = {"type": "d", "mode": 0o755}
+            parent = os.path.dirname(parent)
+        self.entries[arcname] = entry
+        
+class DigestPackaging(object):
+    "Computes a content digest of the files that would be packaged, instead of writing them"
+    def __init__(self, ignore=None):
+        self.hash = hashlib.sha1()
+        self.ignore = ignore
+        self.skipped = [0, 0]
+        
+    def addrel(self, filename, rootdir):
+        arcname = os.path.relpath(filename, rootdir)
+        self._addpath(filename, arcname)
+        return arcname
+        
+    def addstr(self, string, filename):
+        self.hash.update("G %s %d\0" % (filename, len(string)))
+        self.hash.update(string)
+        
+    def addmap(self, src, arcname):
+        src = os.path.expandvars(src)
+        self._addpath(src, arcname)
+        
+    def hexdigest(self):
+        return self.hash.hexdigest()
+        
+    def _addpath(self, path, arcname):
+        for p, a in _walk(path, arcname, self.ignore, self.skipped):
+            if os.path.islink(p):
+                self.hash.update("L %s %s\0" % (a, os.readlink(p)))
+            elif os.path.isdir(p):
+                self.hash.update("D %s\0" % a)
+            elif os.path.isfile(p):
+                st = os.stat(p)
+                self.hash.update("F %s %o %d\0" % (a, st.st_mode & 0o111, st.st_size))
+                # Unchanged files are not read again, see cache.file_digest
+                self.hash.update(cache.file_digest(os.path.realpath(p)))
+        
+def _adds_local_files(dockerfile):
+    "Returns True if a Dockerfile adds files from the build context (relative to its own directory)"
+    for line in dockerfile:
+        args = shlex.split(line)
+        if args[0].lower() in ('add', 'copy'):
+            if any(not a.startswith('--') and not '://' in a for a in args[1:-1]):
+                return True
+    return False
+    
+def _walk(path, arcname, ignore=None, skipped=None):
+    """
+    Yields (path, arcname) for a file or a directory tree, in sorted order. Paths whose arcname is
+    excluded by the ignore rules are left out, and counted as [files, bytes] in skipped.
+    """
+    isdir = os.path.isdir(path) and not os.path.islink(path)
+    excluded = ignore is not None and ignore.excluded(arcname)
+    if excluded and not (isdir and ignore.has_exceptions):
+        if skipped is not None:
+            files, size = tree_size(path)
+            skipped[0] += files
+            skipped[1] += size
+        return
+    if not excluded:
+        yield path, arcname
+    if isdir:
+        for f in sorted(os.listdir(path)):
+            for entry in _walk(os.path.join(path, f), os.path.join(arcname, f), ignore, skipped):
+                yield entry
     
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+"""
+Delta synchronization of build contexts to a persistent staging directory on a host.
+
+The host is asked for a manifest of the staging directory, which is compared with the local
+context. Only new and changed files are then sent, and for large files only the changed
+blocks. Both steps run sync_agent.py on the host through HostProvider.popen, so all the host
+needs is a POSIX shell and Python.
+"""
+import os, json, hashlib, subprocess, pipes
+import logging
+log = logging.getLogger(__name__)
+
+AGENT = os.path.join(os.path.dirname(__file__), "sync_agent.py")
+DEFAULT_BLOCKSIZE = 1 << 20
+
+# Starts the agent with the host's Python. The agent source is sent on stdin (prefixed by its
+# length), ahead of any data for the agent itself.
+_BOOTSTRAP = """PY=$(command -v python3 || command -v python) ; $PY -c 'import sys;i=getattr(sys.stdin,"buffer",sys.stdin);exec(i.read(int(i.readline())))' %s %s %d"""
+
+def quote_path(path):
+    "Quotes a path on a host for the shell, leaving a leading ~/ (the home directory of the user on the host) unquoted"
+    if path.startswith("~/"):
+        return "~/" + pipes.quote(path[2:])
+    return pipes.quote(path)
+
+def _start_agent(host, command, path, blocksize, compress):
+    with open(AGENT) as f:
+        source = f.read()
+    proc = host.popen(_BOOTSTRAP % (command, quote_path(path), blocksize), stdin=subprocess.PIPE, stdout=subprocess.PIPE, compress=compress)
+    proc.stdin.write("%d\n%s" % (len(source), source))
+    return proc
+
+def _finish_agent(host, proc, what):
+    out,_ = proc.communicate()
+    if proc.returncode:
+        raise IOError("Failed to %s on %s. See errors above." % (what, host.name))
+    return json.loads(out)
+
+def get_remote_manifest(host, path, blocksize=DEFAULT_BLOCKSIZE, compress=False):
+    "Returns the manifest of a staging directory on a host (empty if it does not exist)"
+    proc = _start_agent(host, "manifest", path, blocksize, compress)
+    return _finish_agent(host, proc, "read the manifest of '%s'" % path)
+
+def _hash_entry(entry, blocksize):
+    "Computes (and caches) the size, SHA-1 and block hashes of a local file entry"
+    if not "sha1" in entry:
+        whole = hashlib.sha1()
+        blocks = []
+        size = 0
+        for buf in _read_blocks(entry, blocksize):
+            whole.update(buf)
+            blocks.append(hashlib.sha1(buf).hexdigest())
+            size += len(buf)
+        entry["sha1"] = whole.hexdigest()
+        entry["blocks"] = blocks
+        entry["size"] = size
+    return entry
+
+def _read_blocks(entry, blocksize):
+    if entry.get("data") is not None:
+        data = entry["data"]
+        for i in range(0, len(data), blocksize):
+            yield data[i:i+blocksize]
+    else:
+        with open(entry["path"], "rb") as f:
+            while True:
+                buf = f.read(blocksize)
+                if not buf: break
+                yield buf
+
+def sync_context(host, entries, path, blocksize=DEFAULT_BLOCKSIZE, compress=False):
+    """
+    Makes the staging directory path on the host identical to the context entries, as collected
+    by spec.ManifestPackaging, transferring only what changed. Returns a dictionary of statistics.
+    """
+    remote = get_remote_manifest(host, path, blocksize, compress)
+    stats = {"unchanged": 0, "total_bytes": 0, "sent_bytes": 0}
+
+    proc = _start_agent(host, "apply", path, blocksize, compress)
+    def record(**rec):
+        proc.stdin.write(json.dumps(rec) + "\n")
+
+    # Remove what no longer exists locally, deepest paths first
+    for arcname in sorted(remote, reverse=True):
+        entry = entries.get(arcname)
+        if not entry or entry["type"] != remote[arcname]["type"]:
+            record(op="delete", path=arcname)
+            remote.pop(arcname)
+
+    for arcname in sorted(entries):
+        entry = entries[arcname]
+        r = remote.get(arcname)
+        if entry["type"] == "d":
+            if not r:
+                record(op="dir", path=arcname, mode=entry["mode"])
+            elif r["mode"] != entry["mode"]:
+                record(op="mode", path=arcname, mode=entry["mode"])
+        elif entry["type"] == "l":
+            if not r or r["target"] != entry["target"]:
+                record(op="link", path=arcname, target=entry["target"])
+        else:
+            _hash_entry(entry, blocksize)
+            stats["total_bytes"] += entry["size"]
+            if r and r["sha1"] == entry["sha1"]:
+                stats["unchanged"] += 1
+                if r["mode"] != entry["mode"]:
+                    record(op="mode", path=arcname, mode=entry["mode"])
+            elif r and r.get("blocks") and entry["size"] > blocksize:
+                # Send only the blocks that differ from the staged copy
+                changed = []
+                for i, h in enumerate(entry["blocks"]):
+                    if i >= len(r["blocks"]) or r["blocks"][i] != h:
+                        changed.append(i)
+                lengths = [ min(blocksize, entry["size"] - i * blocksize) for i in changed ]
+                record(op="patch", path=arcname, mode=entry["mode"], size=entry["size"], blocks=list(zip(changed, lengths)))
+                changed = set(changed)
+                for i, buf in enumerate(_read_blocks(entry, blocksize)):
+                    if i in changed:
+                        proc.stdin.write(buf)
+                stats["sent_bytes"] += sum(lengths)
+            else:
+                record(op="file", path=arcname, mode=entry["mode"], size=entry["size"])
+                for buf in _read_blocks(entry, blocksize):
+                    proc.stdin.write(buf)
+                stats["sent_bytes"] += entry["size"]
+    record(op="end")
+    stats.update(_finish_agent(host, proc, "update '%s'" % path))
+    log.debug("Synchronized %s on %s: %r" % (path, host.name, stats))
+    return stats
@@ -0,0 +1,192 @@
+"""
+Remote side of the build context delta synchronization (see sync.py).
+
+This file is sent to the host and run by the host's Python interpreter (2 or 3), so it must
+only use the standard library. Usage:
+
+    sync_agent.py manifest DIR BLOCKSIZE   Prints a JSON manifest of the files in DIR
+    sync_agent.py apply DIR BLOCKSIZE      Applies a change stream read from stdin to DIR
+
+The manifest maps each relative path to an entry with the 'type' ('f', 'd' or 'l'), 'mode',
+'size', 'sha1' and, for files larger than BLOCKSIZE, the SHA-1 of each block in 'blocks'.
+Hashes are cached in a state file next to DIR and only recomputed for files whose inode,
+size or change time differ.
+
+The change stream is a sequence of records, each a JSON header line optionally followed by
+payload bytes:
+
+    {"op": "file", "path", "mode", "size"}      followed by the file contents
+    {"op": "patch", "path", "mode", "size", "blocks": [[index, length], ...]}
+                                                followed by the listed blocks; other blocks
+                                                are copied from the existing file
+    {"op": "dir", "path", "mode"}
+    {"op": "link", "path", "target"}
+    {"op": "mode", "path", "mode"}
+    {"op": "delete", "path"}
+    {"op": "end"}
+"""
+import sys, os, json, hashlib, shutil, tempfile
+
+def _state_file(root):
+    return root.rstrip("/") + ".manifest"
+
+def _load_state(root):
+    try:
+        with open(_state_file(root)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _save_state(root, state):
+    fn = _state_file(root)
+    with open(fn + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.rename(fn + ".tmp", fn)
+
+def _hash_file(path, blocksize):
+    whole = hashlib.sha1()
+    blocks = []
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            whole.update(buf)
+            blocks.append(hashlib.sha1(buf).hexdigest())
+    return whole.hexdigest(), blocks
+
+def scan(root, blocksize):
+    "Returns the manifest of a directory, reusing the cached hashes of unchanged files"
+    state = _load_state(root)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            mode = st.st_mode & 0o7777
+            if os.path.islink(path):
+                manifest[rel] = {"type": "l", "target": os.readlink(path)}
+            elif os.path.isdir(path):
+                manifest[rel] = {"type": "d", "mode": mode}
+            else:
+                key = [st.st_ino, st.st_size, st.st_ctime]
+                cached = state.get(rel)
+                if cached and cached.get("stat") == key:
+                    entry = cached
+                else:
+                    sha1, blocks = _hash_file(path, blocksize)
+                    entry = {"type": "f", "size": st.st_size, "sha1": sha1, "stat": key,
+                             "blocks": blocks if st.st_size > blocksize else None}
+                entry["mode"] = mode
+                manifest[rel] = entry
+    _save_state(root, manifest)
+    return manifest
+
+def _read_exact(stream, n):
+    chunks = []
+    while n > 0:
+        buf = stream.read(min(n, 65536))
+        if not buf:
+            raise IOError("Unexpected end of change stream")
+        chunks.append(buf)
+        n -= len(buf)
+    return b"".join(chunks)
+
+def _copy_exact(stream, out, n):
+    while n > 0:
+        buf = stream.read(min(n, 65536))
+        if not buf:
+            raise IOError("Unexpected end of change stream")
+        out.write(buf)
+        n -= len(buf)
+
+def _target(root, rel):
+    path = os.path.normpath(os.path.join(root, rel))
+    if not (path + "/").startswith(root.rstrip("/") + "/"):
+        raise ValueError("Path '%s' outside of staging directory" % rel)
+    return path
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def apply(root, blocksize, stream):
+    "Applies a change stream to a directory. Returns statistics."
+    stats = {"files": 0, "patched": 0, "deleted": 0, "bytes": 0}
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    while True:
+        line = stream.readline()
+        if not line:
+            raise IOError("Unexpected end of change stream")
+        rec = json.loads(line.decode("utf-8"))
+        op = rec["op"]
+        if op == "end":
+            break
+        path = _target(root, rec["path"])
+        if op != "delete" and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if op == "delete":
+            _remove(path)
+            stats["deleted"] += 1
+        elif op == "dir":
+            if not os.path.isdir(path) or os.path.islink(path):
+                _remove(path)
+                os.makedirs(path)
+            os.chmod(path, rec["mode"])
+        elif op == "link":
+            _remove(path)
+            os.symlink(rec["target"], path)
+        elif op == "mode":
+            os.chmod(path, rec["mode"])
+        elif op in ("file", "patch"):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".sync")
+            with os.fdopen(fd, "wb") as out:
+                if op == "file":
+                    _copy_exact(stream, out, rec["size"])
+                    stats["files"] += 1
+                    stats["bytes"] += rec["size"]
+                else:
+                    blocks = dict((i, n) for i, n in rec["blocks"])
+                    nblocks = (rec["size"] + blocksize - 1) // blocksize
+                    with open(path, "rb") as old:
+                        for i in range(nblocks):
+                            if i in blocks:
+                                out.write(_read_exact(stream, blocks[i]))
+                                stats["bytes"] += blocks[i]
+                            else:
+                                old.seek(i * blocksize)
+                                out.write(old.read(min(blocksize, rec["size"] - i * blocksize)))
+                    stats["patched"] += 1
+            os.chmod(tmp, rec["mode"])
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        else:
+            raise ValueError("Unknown operation '%s'" % op)
+    return stats
+
+def main(args):
+    cmd, root, blocksize = args[0], os.path.abspath(args[1]), int(args[2])
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    if cmd == "manifest":
+        if os.path.isdir(root):
+            manifest = scan(root, blocksize)
+        else:
+            manifest = {}
+        for entry in manifest.values():
+            entry.pop("stat", None)
+        json.dump(manifest, sys.stdout)
+    elif cmd == "apply":
+        stats = apply(root, blocksize, stdin)
+        scan(root, blocksize)
+        json.dump(stats, sys.stdout)
+    else:
+        raise ValueError("Unknown command '%s'" % cmd)
+    sys.stdout.flush()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
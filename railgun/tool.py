@@ -1,7 +1,7 @@
 from __future__ import print_function
-import sys, os
+import sys, os, time
 import cmdln
-from . import spec, site
+from . import spec, site, parallel, distribute, catalog, proxy
 import logging
 log = logging.getLogger(__name__)
 
@@ -21,6 +21,7 @@ def global_options(func):
 _dopt_site = cmdln.option("-s","--site", help="Use the specified site. If not set, expects a 'site.yml' in the current directory.")
 _dopt_host = cmdln.option("-H","--host", help="Consider only the specified host.")
 _dopt_dry = cmdln.option("-n","--dry-run", action="store_true", help="Does not perform any changes, but prints the actions.")
+_dopt_workspace = cmdln.option("-W","--workspace", metavar="DIR", help="Also resolve services from the catalog of the workspace DIR (default: $RAILGUN_WORKSPACE).")
 
 class Tool(cmdln.Cmdln):
     """Usage:
@@ -42,6 +43,8 @@ class Tool(cmdln.Cmdln):
     @cmdln.option("-u","--scm-update", action="store_true", help="Updates SCM repositories to the latest version")
     @cmdln.option("--reboot", action="store_true", help="Allows actions that requires the reboot of a host")
     @cmdln.option("-U", "--force-rebuild", action="store_true", help="Forces rebuild of build containers")
+    @cmdln.option("-j", "--parallel", type="int", metavar="N", help="Update at most N hosts at a time (default %d)." % site.DEFAULT_UPDATE_WORKERS)
+    @cmdln.option("--timeout", type="float", metavar="SECONDS", help="Maximum time allowed per host.")
     @global_options
     def do_site(self, subcmd, opts):
         """${cmd_name}: Create or update a site based on the specified site configuration.
@@ -49,6 +52,9 @@ class Tool(cmdln.Cmdln):
         This involves creating virtual machines, if needed. Physical and remote hosts are
         never managed, but containers on them are.
         
+        Hosts are updated concurrently (see -j). Each host is reported as it finishes,
+        followed by a summary.
+        
         Usage: ${cmd_usage}
         
         ${cmd_option_list}
@@ -57,8 +63,11 @@ class Tool(cmdln.Cmdln):
             hosts = None
             if opts.host: hosts = [opts.host]
             sitespec = site.SiteSpec(opts.site)
-            sitespec.update(hosts=hosts, dryrun=bool(opts.dry_run), scm_update=bool(opts.scm_update), reboot=opts.reboot)
-            return 0
+            results = sitespec.update(hosts=hosts, dryrun=bool(opts.dry_run), scm_update=bool(opts.scm_update), reboot=opts.reboot,
+                workers=opts.parallel or site.DEFAULT_UPDATE_WORKERS, timeout=opts.timeout, callback=parallel.print_result)
+            if parallel.print_summary(results, "Site update summary"):
+                return 0
+            return 1
         except:
             print(sys.exc_info()[1], file=sys.stderr)
             return 255
@@ -66,25 +75,105 @@ class Tool(cmdln.Cmdln):
     @_dopt_host
     @_dopt_site
     @_dopt_dry
+    @_dopt_workspace
     @cmdln.option("-c","--service", help="Push only the specified service.")
-    @cmdln.option("-r","--recursive", help="Push service dependencies recursively.")
+    @cmdln.option("-r","--recursive", action="store_true", help="Push service dependencies recursively.")
     @cmdln.option("-U", "--update", action="store_true", help="Forces update of build containers (and dependencies if -r specified)")
     @cmdln.option("--no-cache", action="store_true", help="Disabled Docker caching")
+    @cmdln.option("--sync", action="store_true", help="Synchronize a staged copy of the build context on the host, sending only changes")
+    @cmdln.option("-A", "--all-hosts", action="store_true", help="Push to all hosts and cluster instances of the site.")
+    @cmdln.option("-j", "--parallel", type="int", metavar="N", help="Push to at most N hosts at a time (default 4).")
+    @cmdln.option("-J", "--max-builds", type="int", metavar="N", help="Build at most N independent services of the project at a time on each host (default 4).")
+    @cmdln.option("--timeout", type="float", metavar="SECONDS", help="Maximum time allowed per host.")
+    @cmdln.option("-D", "--distribute", action="store_true", help="Build only once, on the origin host, and send the images to the other hosts.")
+    @cmdln.option("--origin", metavar="HOST", help="The host to build on with -D (default: the local machine).")
+    @cmdln.option("--fanout", type="int", metavar="N", help="With -D, the number of hosts each host sends images to at a time (default 2).")
+    @cmdln.option("--layers", action="store_true", help="With -D, send each host only the image layers it does not already have.")
     @global_options
     def do_push(self, subcmd, opts, source=None):
         """${cmd_name}: Push a service to a destination site.
         
+        With -A, or when the host is a cluster, the push runs concurrently on all hosts
+        (see -j), and a summary of the outcome on each host is printed.
+        
+        With -D, the services are built once on the origin host, and the images are then
+        relayed from host to host.
+        
         ${cmd_usage}
         
         ${cmd_option_list}
         """
         try:
-            project = spec.Project(source)
-            host = site.SiteSpec(opts.site).provider(opts.host)
-            if opts.service:
-                project.get_service(opts.service).push_to(host, force_update=opts.update, no_cache=opts.no_cache)
+            project = spec.Project(source, workspace=opts.workspace)
+            sitespec = site.SiteSpec(opts.site)
+            if opts.all_hosts:
+                providers = sitespec.get_providers()
             else:
-                project.push_to(host, force_update=opts.update, no_cache=opts.no_cache)
+                providers = [sitespec.provider(opts.host)]
+            hosts = []
+            for provider in providers:
+                hosts += provider.get_instance_providers()
+            if not opts.dry_run:
+                # Clone the repositories the services need concurrently, instead of one at a time while building
+                services = [project.get_service(opts.service)] if opts.service else None
+                project.prefetch(workers=opts.max_builds or 4, update=opts.update, services=services, dependencies=opts.recursive)
+            
+            def push(host):
+                if opts.sync:
+                    host.push_mode = "sync"
+                if opts.service:
+                    project.get_service(opts.service).push_to(host, None, opts.recursive, force_update=opts.update, no_cache=opts.no_cache)
+                else:
+                    project.push_to(host, opts.recursive, force_update=opts.update, no_cache=opts.no_cache, max_builds=opts.max_builds or 4)
+                    
+            if opts.distribute:
+                if opts.origin and opts.origin != "local":
+                    origin = sitespec.provider(opts.origin)
+                else:
+                    origin = sitespec.local_provider()
+                push(origin)
+                if opts.service:
+                    services = [project.get_service(opts.service)]
+                else:
+                    services = project.services
+                targets = [ h for h in hosts if h.name != origin.name ]
+                ok = True
+                for service in services:
+                    name = service.container_name()
+                    transfer = [distribute.transfer_image, distribute.transfer_image_layers][bool(opts.layers)]
+                    results = distribute.distribute_image(name, origin, targets, fanout=opts.fanout or 2, transfer=transfer)
+                    ok = parallel.print_summary(results, "Distribution of '%s'" % name) and ok
+                return [1, 0][ok]
+            if len(hosts) == 1 and not opts.all_hosts:
+                push(hosts[0])
+                return 0
+            results = parallel.run_on_hosts(hosts, push, workers=opts.parallel or 4, timeout=opts.timeout)
+            if parallel.print_summary(results, "Push summary"):
+                return 0
+            return 1
+        except:
+            print(sys.exc_info()[1], file=sys.stderr)
+            return 255
+        
+    @_dopt_host
+    @_dopt_site
+    @cmdln.option("-f","--from", dest="source", metavar="HOST", help="The host to copy the image from (default: the local machine).")
+    @cmdln.alias("image-sync")
+    @global_options
+    def do_image_sync(self, subcmd, opts, image):
+        """${cmd_name}: Copy an image to a host, sending only the layers missing on the host.
+        
+        ${cmd_usage}
+        
+        ${cmd_option_list}
+        """
+        try:
+            sitespec = site.SiteSpec(opts.site)
+            if opts.source and opts.source != "local":
+                source = sitespec.provider(opts.source)
+            else:
+                source = sitespec.local_provider()
+            distribute.sync_image(image, source, sitespec.provider(opts.host))
             return 0
         except:
             print(sys.exc_info()[1], file=sys.stderr)
@@ -130,6 +219,7 @@ class Tool(cmdln.Cmdln):
     @_dopt_host
     @_dopt_site
     @cmdln.option("-c","--service", help="Print status about the specified service.")
+    @cmdln.option("--refresh", action="store_true", help="Discover cluster instances anew instead of using cached results.")
     @global_options
     def do_status(self, subcmd, opts):
         """${cmd_name}: Prints status information about the specified site, host or service.
@@ -143,6 +233,7 @@ class Tool(cmdln.Cmdln):
             s = site.SiteSpec(opts.site)
             for h in s.get_providers(opts.host and [opts.host]):
                 print("%r:" % h)
+                h.refresh_discovery = bool(opts.refresh)
                 for inst in h.get_instances():
                     print("  %-20s %s" % inst)
         except:
@@ -154,9 +245,13 @@ class Tool(cmdln.Cmdln):
     @cmdln.option("-p","--project", help="Specify project.")
     @cmdln.option("-c","--service", help="Print status about the specified service.")
     @cmdln.option("-n","--names-only", action="store_true", help="Print only the names.")
+    @cmdln.option("-b","--builtins", action="store_true", help="List the built-in builders and services.")
+    @_dopt_workspace
     @global_options
     def do_info(self, subcmd, opts):
-        """${cmd_name}: Display information about a project (-p) or site (-s)
+        """${cmd_name}: Display information about a project (-p), site (-s) or built-in service (-c, -b)
+        
+        With -W, services not found among the built-ins (-c) are looked up in the workspace catalog.
         
         ${cmd_usage}
         
@@ -164,7 +259,7 @@ class Tool(cmdln.Cmdln):
         """
         try:
             if opts.project:
-                project = spec.Project(opts.project)
+                project = spec.Project(opts.project, workspace=opts.workspace)
                 if opts.service:
                     if opts.names_only:
                         print(project.get_service(opts.service).qualified_name())
@@ -176,6 +271,19 @@ class Tool(cmdln.Cmdln):
                             print(serv.qualified_name())
                     else:
                         print(project)
+            elif opts.builtins:
+                for dirname in (spec.get_builders_dir(), spec.get_services_dir()):
+                    if os.path.isdir(dirname):
+                        for name in spec.get_index(dirname).names():
+                            print(name)
+            elif opts.service:
+                service = spec.find_builtin_service(opts.service) or spec.find_workspace_service(opts.service, opts.workspace)
+                if not service:
+                    raise KeyError("Service '%s' not defined" % opts.service)
+                if opts.names_only:
+                    print(service.qualified_name())
+                else:
+                    print(service)
             else:
                 print("Expected one of -p or -s", file=sys.stderr)
                 self.do_help(("help","info"))
@@ -184,6 +292,89 @@ class Tool(cmdln.Cmdln):
             print(sys.exc_info()[1], file=sys.stderr)
             return 255
         
+    @cmdln.option("-n","--names-only", action="store_true", help="Print only the qualified names.")
+    @cmdln.option("-e","--endpoint", help="List only the services implementing the endpoint.")
+    @cmdln.option("--rescan", action="store_true", help="Parse all specs again, not only the changed ones.")
+    @cmdln.option("-j", "--parallel", type="int", metavar="N", help="Scan with N threads (default %d)." % catalog.DEFAULT_WORKERS)
+    @global_options
+    def do_catalog(self, subcmd, opts, workspace=None):
+        """${cmd_name}: List the services of all projects in a workspace directory tree.
+        
+        The workspace defaults to $RAILGUN_WORKSPACE, or else the current directory. The
+        catalog is kept between runs, and only specs changed since the last run are parsed.
+        
+        ${cmd_usage}
+        
+        ${cmd_option_list}
+        """
+        try:
+            workspace = workspace or os.environ.get("RAILGUN_WORKSPACE") or "."
+            cat = catalog.Catalog(workspace, workers=opts.parallel or catalog.DEFAULT_WORKERS)
+            cat.update(rescan=opts.rescan)
+            if opts.endpoint:
+                records = cat.implementing(opts.endpoint)
+            else:
+                records = cat.services()
+            for r in records:
+                if opts.names_only:
+                    print(r["qualified_name"])
+                else:
+                    print("%-32s %-8s %-24s %-24s %s" % (r["qualified_name"], r["type"], r["builder"] or "-",
+                        ','.join(r["implements"]) or "-", os.path.relpath(r["spec"])))
+            return 0
+        except:
+            print(sys.exc_info()[1], file=sys.stderr)
+            return 255
+        
+    @cmdln.option("-b","--bind", metavar="ADDRESS", default="", help="Listen on ADDRESS (default: all interfaces).")
+    @cmdln.option("-p","--port", type="int", default=proxy.DEFAULT_PORT, help="Listen on PORT (default %d)." % proxy.DEFAULT_PORT)
+    @cmdln.option("--max-age", type="float", metavar="SECONDS", default=proxy.DEFAULT_MAX_AGE,
+        help="Revalidate cached files last validated more than SECONDS ago (default %d)." % proxy.DEFAULT_MAX_AGE)
+    @cmdln.option("--report", type="float", metavar="SECONDS", default=300, help="Log statistics every SECONDS (default 300, 0 to disable).")
+    @cmdln.option("--allow", metavar="NETWORK", action="append",
+        help="Serve clients in NETWORK, such as 10.1.12.0/24 (may be repeated; default: loopback and private networks).")
+    @cmdln.option("--stats", metavar="URL", help="Print the statistics of the proxy running at URL, and exit.")
+    @global_options
+    def do_proxy(self, subcmd, opts):
+        """${cmd_name}: Run a caching HTTP proxy for the builds on the hosts of a site.
+        
+        Files downloaded during builds on hosts configured to use the proxy (the 'proxy'
+        attribute of the site or a host, such as http://10.1.12.1:3142) are fetched once
+        and then served from Railgun's download cache. Only clients in the allowed networks
+        are served, and HTTPS is tunneled to port 443 only. The proxy runs until
+        interrupted, and then prints its cache hit rate and the number of bytes saved.
+        
+        Only RUN instructions use the proxy: the Docker daemon downloads the files ADD
+        takes from URLs, and the base images, itself.
+        
+        ${cmd_usage}
+        
+        ${cmd_option_list}
+        """
+        try:
+            if opts.stats:
+                print(proxy.format_stats(proxy.get_stats(opts.stats)))
+                return 0
+            server = proxy.ProxyServer(opts.bind, opts.port, max_age=opts.max_age, allow=opts.allow or proxy.DEFAULT_ALLOW)
+            log.info("Proxy listening on %s" % server.get_url())
+            server.start()
+            requests = 0
+            try:
+                while True:
+                    time.sleep(opts.report or 3600)
+                    stats = server.stats.as_dict()
+                    if opts.report and stats["requests"] != requests:
+                        log.info(proxy.format_stats(stats))
+                        requests = stats["requests"]
+            except KeyboardInterrupt:
+                pass
+            server.shutdown()
+            print(proxy.format_stats(server.stats.as_dict()))
+            return 0
+        except:
+            print(sys.exc_info()[1], file=sys.stderr)
+            return 255
+        
     @cmdln.option("--no-cache", action="store_true", help="Disabled Docker caching")
     @cmdln.option("-c","--service", help="Print status about the specified service.")
     @global_options
@@ -216,14 +407,9 @@ class Tool(cmdln.Cmdln):
                 from . import build
                 if not source: source = '.'
                 project = spec.Project(source)
-                if opts.service:
-                    svc = project.get_service(opts.service)
-                    build.build_container(svc.build(write=True))
-                else:
-                    if len(project.services) != 1:
-                        raise Exception("Must specify service")
-                    project.services[0].build(write=True)
-                    build.build_container(project.services[0])
+                svc = build.get_service(project, opts.service)
+                svc.build(write=True)
+                build.build_container(svc, nocache=opts.no_cache)
                 print(project)
             except:
                 print(sys.exc_info()[1], file=sys.stderr)
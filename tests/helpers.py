@@ -0,0 +1,69 @@
+"Helpers shared by the tests: a temporary cache directory, local HTTP servers and git repositories"
+import os, shutil, tempfile, threading, subprocess, unittest
+import BaseHTTPServer
+from railgun import checkout
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "A request handler that does not log requests"
+    def log_message(self, format, *args):
+        pass
+
+class CacheTestCase(unittest.TestCase):
+    """Runs each test with an empty temporary cache directory ($RAILGUN_CACHE) under self.tempdir, restoring
+    the environment afterwards. Downloads are validated again in each test."""
+    def setUp(self):
+        # Cleanups run last registered first, so servers stop before the directory is removed
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.addCleanup(self._restore_environ, dict(os.environ))
+        os.environ["RAILGUN_CACHE"] = os.path.join(self.tempdir, "cache")
+        checkout._validated.clear()
+
+    def _restore_environ(self, environ):
+        os.environ.clear()
+        os.environ.update(environ)
+
+    def start_server(self, handler, **attributes):
+        """Starts an HTTP server on a local port, serving requests with the handler on a thread until the test
+        ends. The attributes are set on the server, for the handler to use."""
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), handler)
+        for name, value in attributes.items():
+            setattr(server, name, value)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+def server_url(server, path=""):
+    "Returns the URL of a path on a local server"
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+def git(*args, **kwargs):
+    "Runs git with a fixed identity, returning its output"
+    cmd = ["git", "-c", "user.name=Railgun", "-c", "user.email=railgun@example.com", "-c", "init.defaultBranch=master"]
+    with open(os.devnull, "w") as null:
+        return subprocess.check_output(cmd + list(args), stderr=null, **kwargs).strip()
+
+class GitRemote(object):
+    "A local bare repository to check out from, with a clone for committing to it"
+    def __init__(self, dirname, name):
+        self.path = os.path.join(dirname, name + ".git")
+        self.clone = os.path.join(dirname, name + ".clone")
+        # A URL that is not a local file to Railgun, so that it is checked out
+        self.url = "git+file://" + self.path
+        git("init", "-q", "--bare", self.path)
+        # Serve partial clones
+        git("config", "uploadpack.allowFilter", "true", cwd=self.path)
+        git("clone", "-q", self.path, self.clone)
+
+    def commit(self, filename, content, branch="master"):
+        "Commits a file to a branch of the repository, returning the commit"
+        git("checkout", "-q", "-B", branch, cwd=self.clone)
+        with open(os.path.join(self.clone, filename), "w") as f:
+            f.write(content)
+        git("add", filename, cwd=self.clone)
+        git("commit", "-q", "-m", "Update %s" % filename, cwd=self.clone)
+        git("push", "-q", "origin", branch, cwd=self.clone)
+        return git("rev-parse", "HEAD", cwd=self.clone)
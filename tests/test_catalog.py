@@ -0,0 +1,49 @@
+"Tests of the workspace catalog (catalog.Catalog) and the lookups resolving references from it"
+import os, unittest
+from railgun import catalog, spec
+from helpers import CacheTestCase
+
+class CatalogTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.workspace = os.path.join(self.tempdir, "workspace")
+        self.write("db/services.yml", "postgres:\n  implements: db\nmysql:\n  implements: [db, sql]\n")
+        self.write("app/services.yml", "web:\n  requires: sql\n")
+        self.write("tools/lint/Dockerfile", "FROM scratch\n")
+
+    def write(self, name, content):
+        path = os.path.join(self.workspace, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_lookups(self):
+        cat = catalog.Catalog(self.workspace)
+        self.assertEqual(cat.update(), 3)
+        self.assertEqual(sorted(r["name"] for r in cat.services()), ["lint", "mysql", "postgres", "web"])
+        self.assertEqual([r["name"] for r in cat.find("web")], ["web"])
+        self.assertEqual(cat.find("missing"), [])
+        self.assertEqual(sorted(r["name"] for r in cat.implementing("db")), ["mysql", "postgres"])
+        self.assertEqual([r["spec"] for r in cat.implementing("sql")], [os.path.join(cat.root, "db", "services.yml")])
+        self.assertEqual(cat.get_service("web").name, "web")
+
+    def test_persisted(self):
+        catalog.Catalog(self.workspace).update()
+        # Read from the cache, without scanning
+        cat = catalog.Catalog(self.workspace)
+        self.assertEqual([r["name"] for r in cat.implementing("sql")], ["mysql"])
+        self.assertFalse(cat.scanned)
+        # Changed specs are parsed again, and the lookups follow
+        self.write("app/services.yml", "web:\n  implements: http\n")
+        self.assertEqual(cat.update(), 1)
+        self.assertEqual([r["name"] for r in cat.implementing("http")], ["web"])
+
+    def test_endpoint_registry(self):
+        project = spec.Project(os.path.join(self.workspace, "app"), workspace=self.workspace)
+        registry = project.get_endpoint_registry()
+        self.assertEqual([s.name for s in registry.get_providers("sql")], ["mysql"])
+        self.assertEqual(registry.get_providers("missing"), [])
+
+if __name__ == "__main__":
+    unittest.main()
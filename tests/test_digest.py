@@ -0,0 +1,40 @@
+"Tests of the digest of the sources of a service (Service.digest), which decides whether pushes rebuild it"
+import os, unittest
+from railgun import spec
+from railgun.host_providers.local import LocalHostProvider
+from helpers import CacheTestCase
+
+class _Host(LocalHostProvider):
+    "A host with a fixed list of images"
+    images = []
+    def _list_images(self):
+        return iter(self.images)
+
+class DigestTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.project = os.path.join(self.tempdir, "project")
+        os.mkdir(self.project)
+        with open(os.path.join(self.project, "services.yml"), "w") as f:
+            f.write("web:\n  builder: builder.none\n")
+        with open(os.path.join(self.project, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\n")
+        self.service = spec.Project(self.project).get_service("web")
+
+    def test_builder_version(self):
+        digest = self.service.digest("builder.base", builder_version="1234")
+        self.assertEqual(self.service.digest("builder.base", builder_version="1234"), digest)
+        self.assertNotEqual(self.service.digest("builder.base", builder_version="5678"), digest)
+        self.assertNotEqual(self.service.digest("builder.other", builder_version="1234"), digest)
+
+    def test_get_builder_version(self):
+        host = _Host("local", None, {}, None, None)
+        host.images = [("sha256:" + "ab" * 32, ["builder.base:latest"], {spec.DIGEST_LABEL: "1234"}),
+                       ("sha256:" + "cd" * 32, ["builder.plain:latest"], {})]
+        self.assertEqual(self.service.get_builder_version(host, "builder.base"), "1234")
+        self.assertEqual(self.service.get_builder_version(host, "builder.plain"), "sha256:" + "cd" * 32)
+        self.assertEqual(self.service.get_builder_version(host, "builder.missing"), None)
+        self.assertEqual(self.service.get_builder_version(host, "builder.none"), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"Tests of the HTTP download cache (checkout.download), against a local HTTP server"
+import os, hashlib, tarfile, StringIO, unittest
+from railgun import checkout
+from helpers import CacheTestCase, QuietHandler, server_url
+
+class _Handler(QuietHandler):
+    "Serves the files of server.files, with an ETag, answering conditional requests with 304"
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.server.log.append((404, self.path))
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.server.log.append((304, self.path))
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.log.append((200, self.path))
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class DownloadTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        os.environ.pop("RAILGUN_DOWNLOAD_CACHE_SIZE", None)
+        self.server = self.start_server(_Handler, files={"/a": "a" * 1000, "/b": "b" * 1000}, log=[])
+
+    def url(self, path):
+        return server_url(self.server, path)
+
+    def test_download_then_revalidate(self):
+        path = checkout.download(self.url("/a"))
+        self.assertEqual(open(path).read(), "a" * 1000)
+        self.assertEqual(os.path.basename(path), hashlib.sha256("a" * 1000).hexdigest())
+        # Validated once per command
+        self.assertEqual(checkout.download(self.url("/a")), path)
+        self.assertEqual(self.server.log, [(200, "/a")])
+        # The next command revalidates
+        checkout._validated.clear()
+        self.assertEqual(checkout.download(self.url("/a")), path)
+        self.assertEqual(self.server.log, [(200, "/a"), (304, "/a")])
+
+    def test_changed_file_is_downloaded_again(self):
+        old = checkout.download(self.url("/a"))
+        checkout._validated.clear()
+        self.server.files["/a"] = "c" * 1000
+        new = checkout.download(self.url("/a"))
+        self.assertNotEqual(new, old)
+        self.assertEqual(open(new).read(), "c" * 1000)
+
+    def test_fetch_status(self):
+        self.assertEqual(checkout.fetch(self.url("/a"), max_age=60)[2], "miss")
+        self.assertEqual(checkout.fetch(self.url("/a"), max_age=60)[2], "hit")
+        self.assertEqual(checkout.fetch(self.url("/a"), max_age=0)[2], "revalidated")
+
+    def test_eviction(self):
+        os.environ["RAILGUN_DOWNLOAD_CACHE_SIZE"] = "0"
+        a = checkout.download(self.url("/a"))
+        b = checkout.download(self.url("/b"))
+        # The least recently used file is evicted, but not the one just downloaded
+        self.assertFalse(os.path.exists(a))
+        self.assertTrue(os.path.exists(b))
+        checkout._validated.clear()
+        self.assertEqual(checkout.download(self.url("/a")), a)
+        self.assertEqual(self.server.log, [(200, "/a"), (200, "/b"), (200, "/a")])
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, checkout.download, self.url("/missing"))
+
+    def archive(self, path, *members):
+        "Serves a tar archive of members, given as (name, data) for files or (name, None, link target) for symlinks"
+        buf = StringIO.StringIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for member in members:
+                info = tarfile.TarInfo(member[0])
+                if member[1] is None:
+                    info.type, info.linkname = tarfile.SYMTYPE, member[2]
+                    tar.addfile(info)
+                else:
+                    info.size = len(member[1])
+                    tar.addfile(info, StringIO.StringIO(member[1]))
+        self.server.files[path] = buf.getvalue()
+        return self.url(path)
+
+    def test_archive_checkout(self):
+        url = self.archive("/app.tar", ("Dockerfile", "FROM x\n"), ("src/main.c", "int main;"), ("src/link", None, "main.c"))
+        dest = checkout.HttpResource().checkout(url, self.tempdir)
+        self.assertEqual(dest, os.path.join(self.tempdir, "app"))
+        self.assertEqual(open(os.path.join(dest, "src", "link")).read(), "int main;")
+
+    def test_archive_outside_destination(self):
+        for members in ([("../evil", "x")], [("/tmp/evil", "x")], [("a/../../evil", "x")], [("a/../../other", "x")],
+                [("link", None, "../..")], [("link", None, "/etc/passwd")], [("sub/link", None, "../../x")]):
+            checkout._validated.clear()
+            url = self.archive("/evil.tar", *members)
+            self.assertRaises(IOError, checkout.HttpResource().checkout, url, os.path.join(self.tempdir, "checkouts"))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "evil")))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "checkouts", "other")))
+
+if __name__ == "__main__":
+    unittest.main()
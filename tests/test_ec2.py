@@ -0,0 +1,117 @@
+"Tests of the EC2 discovery cache (EC2HostProvider.get_instances), against a local stub of the EC2 API"
+import os, time, urlparse, unittest
+from railgun import cache
+from helpers import CacheTestCase, QuietHandler, server_url
+try:
+    from railgun.host_providers import ec2
+except ImportError:
+    # boto is not installed
+    ec2 = None
+
+_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">
+  <requestId>stub</requestId>
+  <reservationSet>
+    <item>
+      <reservationId>r-stub</reservationId>
+      <ownerId>0</ownerId>
+      <groupSet/>
+      <instancesSet>%s</instancesSet>
+    </item>
+  </reservationSet>
+</DescribeInstancesResponse>"""
+
+_INSTANCE = """
+        <item>
+          <instanceId>%s</instanceId>
+          <instanceState><code>16</code><name>running</name></instanceState>
+          <ipAddress>%s</ipAddress>
+        </item>"""
+
+class _EC2Stub(QuietHandler):
+    "Answers DescribeInstances with the instances of server.instances, recording the actions requested"
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._answer(urlparse.parse_qs(body))
+
+    def do_GET(self):
+        self._answer(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+
+    def _answer(self, params):
+        self.server.actions.append(params.get("Action", [None])[0])
+        body = _RESPONSE % ''.join(_INSTANCE % i for i in self.server.instances)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@unittest.skipIf(ec2 is None, "boto is not installed")
+class DiscoveryTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        os.environ["AWS_ACCESS_KEY_ID"] = "stub"
+        os.environ["AWS_SECRET_ACCESS_KEY"] = "stub"
+        self.server = self.start_server(_EC2Stub, instances=[("i-1", "10.0.0.1")], actions=[])
+        self.root = {"endpoint": server_url(self.server, "/"), "discovery_ttl": 60}
+
+    def provider(self):
+        return ec2.EC2HostProvider("cluster", True, dict(self.root), None, None)
+
+    def age(self, provider, seconds):
+        "Makes the discovery cache of a provider older"
+        filename = provider._get_discovery_file()
+        cached = cache.load_json(filename)
+        cached["time"] -= seconds
+        cache.save_json(filename, cached)
+
+    def test_lazy_connection(self):
+        provider = self.provider()
+        self.assertEqual(provider.conn, None)
+        self.assertEqual(self.server.actions, [])
+        self.assertEqual(list(provider.get_instances()), [("i-1", "10.0.0.1")])
+        self.assertEqual(self.server.actions, ["DescribeInstances"])
+
+    def test_cached_within_ttl(self):
+        list(self.provider().get_instances())
+        self.server.instances = [("i-2", "10.0.0.2")]
+        provider = self.provider()
+        self.assertEqual(list(provider.get_instances()), [("i-1", "10.0.0.1")])
+        self.assertEqual(self.server.actions, ["DescribeInstances"])
+        self.assertEqual(provider.conn, None)
+
+    def test_refreshed_in_background_after_ttl(self):
+        provider = self.provider()
+        list(provider.get_instances())
+        self.age(provider, 61)
+        self.server.instances = [("i-2", "10.0.0.2")]
+        # The cached membership is still used, while it is refreshed
+        self.assertEqual(list(self.provider().get_instances()), [("i-1", "10.0.0.1")])
+        ec2._refreshes[-1].join(10)
+        self.assertEqual(self.server.actions, ["DescribeInstances"] * 2)
+        self.assertEqual(list(self.provider().get_instances()), [("i-2", "10.0.0.2")])
+        self.assertEqual(len(self.server.actions), 2)
+
+    def test_too_old(self):
+        provider = self.provider()
+        list(provider.get_instances())
+        self.age(provider, 60 * ec2.MAX_STALENESS + 1)
+        self.server.instances = [("i-2", "10.0.0.2")]
+        self.assertEqual(list(self.provider().get_instances()), [("i-2", "10.0.0.2")])
+        self.assertEqual(len(self.server.actions), 2)
+
+    def test_refresh_discovery(self):
+        list(self.provider().get_instances())
+        self.server.instances = [("i-2", "10.0.0.2")]
+        provider = self.provider()
+        provider.refresh_discovery = True
+        self.assertEqual(list(provider.get_instances()), [("i-2", "10.0.0.2")])
+
+    def test_instance_providers(self):
+        self.root["user"] = "admin"
+        self.server.instances = [("i-1", "10.0.0.1"), ("i-2", "10.0.0.2")]
+        hosts = self.provider().get_instance_providers()
+        self.assertEqual([(h.name, h.hostname) for h in hosts], [("cluster/i-1", "admin@10.0.0.1"), ("cluster/i-2", "admin@10.0.0.2")])
+
+if __name__ == "__main__":
+    unittest.main()
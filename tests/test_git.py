@@ -0,0 +1,74 @@
+"Tests of git checkouts (checkout.GitRepository): shared mirrors, worktrees, shallow and pinned checkouts"
+import os, unittest
+from railgun import checkout
+from helpers import CacheTestCase, GitRemote, git
+
+class GitRepositoryTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        checkout._remote_heads.clear()
+        self.remote = GitRemote(self.tempdir, "app")
+        self.first = self.remote.commit("Dockerfile", "FROM scratch\n")
+        self.second = self.remote.commit("Dockerfile", "FROM busybox\n")
+
+    def checkout(self, dirname, update=False, **options):
+        "Checks out the remote into a directory of the test, returning the commit checked out"
+        repository = checkout.GitRepository(**options)
+        local_path = os.path.join(self.tempdir, dirname)
+        if not os.path.isdir(local_path):
+            os.mkdir(local_path)
+        dest = repository.checkout(self.remote.url, local_path, update_existing=update)
+        self.assertEqual(dest, os.path.join(self.tempdir, dirname, "app"))
+        return checkout.read_head(dest)
+
+    def mirror(self, **options):
+        return checkout.GitRepository(**options).get_mirror_dir(self.remote.url)
+
+    def test_worktrees_share_a_mirror(self):
+        self.assertEqual(self.checkout("one"), self.second)
+        self.assertEqual(self.checkout("two"), self.second)
+        # Checkouts are worktrees of the mirror, which holds the objects
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir, "one", "app", ".git")))
+        self.assertTrue(os.path.isdir(self.mirror()))
+        self.assertEqual(len(git("worktree", "list", cwd=self.mirror()).splitlines()), 3)
+        self.assertEqual(os.listdir(os.path.dirname(self.mirror())), [os.path.basename(self.mirror())])
+
+    def test_update(self):
+        self.checkout("one")
+        third = self.remote.commit("Dockerfile", "FROM alpine\n")
+        self.assertEqual(self.checkout("one", update=True), third)
+        with open(os.path.join(self.tempdir, "one", "app", "Dockerfile")) as f:
+            self.assertEqual(f.read(), "FROM alpine\n")
+
+    def test_branch(self):
+        dev = self.remote.commit("Makefile", "all:\n", branch="dev")
+        self.assertEqual(self.checkout("dev", ref="dev"), dev)
+        self.assertEqual(self.checkout("master"), self.second)
+
+    def test_pinned(self):
+        self.assertEqual(self.checkout("pinned", ref=self.first), self.first)
+        self.remote.commit("Dockerfile", "FROM alpine\n")
+        checkout._remote_heads.clear()
+        self.assertEqual(self.checkout("pinned", update=True, ref=self.first), self.first)
+        # Pinned checkouts are up to date without asking the remote
+        self.assertEqual(checkout._remote_heads, {})
+
+    def test_depth_and_filter(self):
+        self.assertEqual(self.checkout("shallow", depth=1), self.second)
+        self.assertEqual(self.checkout("partial", filter="blob:none"), self.second)
+        self.assertEqual(self.checkout("full"), self.second)
+        # Each set of options has its own mirror, as a shallow or partial mirror cannot serve the others
+        mirrors = set([self.mirror(depth=1), self.mirror(filter="blob:none"), self.mirror()])
+        self.assertEqual(len(mirrors), 3)
+        self.assertTrue(os.path.exists(os.path.join(self.mirror(depth=1), "shallow")))
+        self.assertFalse(os.path.exists(os.path.join(self.mirror(), "shallow")))
+        self.assertEqual(git("rev-list", "--count", "HEAD", cwd=self.mirror()), "2")
+        self.assertEqual(git("config", "remote.origin.promisor", cwd=self.mirror(filter="blob:none")), "true")
+
+    def test_without_mirror(self):
+        self.assertEqual(self.checkout("clone", mirror=False), self.second)
+        self.assertTrue(os.path.isdir(os.path.join(self.tempdir, "clone", "app", ".git")))
+        self.assertFalse(os.path.exists(self.mirror()))
+
+if __name__ == "__main__":
+    unittest.main()
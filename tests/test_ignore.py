@@ -0,0 +1,55 @@
+"Tests of .railgunignore pattern matching (ignore.IgnoreRules)"
+import os, shutil, tempfile, unittest
+from railgun.ignore import IgnoreRules, IGNORE_FILE
+
+class IgnoreRulesTest(unittest.TestCase):
+    def test_wildcards(self):
+        rules = IgnoreRules(["*.pyc", "doc/?.txt", "build/**/*.o"], defaults=False)
+        self.assertTrue(rules.excluded("a.pyc"))
+        # '*' does not match '/'
+        self.assertFalse(rules.excluded("src/a.pyc"))
+        self.assertTrue(rules.excluded("doc/a.txt"))
+        self.assertFalse(rules.excluded("doc/ab.txt"))
+        # '**' matches any number of directories, none included
+        self.assertTrue(rules.excluded("build/a.o"))
+        self.assertTrue(rules.excluded("build/x/y/a.o"))
+        self.assertFalse(rules.excluded("src/a.o"))
+
+    def test_parent_directories(self):
+        rules = IgnoreRules(["logs", "/tmp/"], defaults=False)
+        self.assertTrue(rules.excluded("logs/2016/today.log"))
+        self.assertTrue(rules.excluded("tmp/x"))
+        self.assertFalse(rules.excluded("src/logs"))
+
+    def test_exceptions(self):
+        rules = IgnoreRules(["*.md", "!README.md", "docs", "!docs/keep"], defaults=False)
+        self.assertTrue(rules.has_exceptions)
+        self.assertTrue(rules.excluded("CHANGES.md"))
+        self.assertFalse(rules.excluded("README.md"))
+        self.assertTrue(rules.excluded("docs/other"))
+        self.assertFalse(rules.excluded("docs/keep"))
+        # The last matching pattern wins
+        rules = IgnoreRules(["!README.md", "*.md"], defaults=False)
+        self.assertTrue(rules.excluded("README.md"))
+
+    def test_defaults(self):
+        rules = IgnoreRules()
+        self.assertTrue(rules.excluded(".git/config"))
+        self.assertTrue(rules.excluded("vendor/lib/.hg/store"))
+        self.assertFalse(rules.excluded("src/main.c"))
+        self.assertFalse(IgnoreRules(defaults=False).excluded(".git/config"))
+
+    def test_load(self):
+        rootdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(rootdir, IGNORE_FILE), "w") as f:
+                f.write("# Comment\n\n*.log\n")
+            rules = IgnoreRules.load(rootdir)
+            self.assertTrue(rules.excluded("debug.log"))
+            self.assertFalse(rules.excluded("# Comment"))
+            self.assertTrue(rules.excluded(".svn/entries"))
+        finally:
+            shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    unittest.main()
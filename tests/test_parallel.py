@@ -0,0 +1,56 @@
+"Tests of the concurrent execution of dependency graphs (parallel.run_dag)"
+import threading, time, unittest
+from railgun import parallel
+
+class RunDagTest(unittest.TestCase):
+    def run_dag(self, deps, fail=(), workers=4):
+        "Runs a graph whose nodes record when they start and finish, returning (errors, events)"
+        events = []
+        lock = threading.Lock()
+        def func(node):
+            with lock:
+                events.append(("start", node))
+            time.sleep(0.01)
+            with lock:
+                events.append(("end", node))
+            if node in fail:
+                raise ValueError(node)
+        return parallel.run_dag(deps, func, workers=workers), events
+
+    def assertBefore(self, events, first, then):
+        self.assertTrue(events.index(("end", first)) < events.index(("start", then)), "%s started before %s finished" % (then, first))
+
+    def test_order(self):
+        deps = {"base": [], "lib": ["base"], "tool": ["base"], "app": ["lib", "tool"]}
+        errors, events = self.run_dag(deps)
+        self.assertEqual(errors, {})
+        self.assertEqual(sorted(n for e, n in events if e == "end"), sorted(deps))
+        for node, prerequisites in deps.items():
+            for prerequisite in prerequisites:
+                self.assertBefore(events, prerequisite, node)
+
+    def test_concurrency(self):
+        deps = dict(("n%d" % i, []) for i in range(6))
+        errors, events = self.run_dag(deps, workers=2)
+        running = peak = 0
+        for event, node in events:
+            running += 1 if event == "start" else -1
+            peak = max(peak, running)
+        self.assertEqual(peak, 2)
+
+    def test_failure_skips_dependents(self):
+        deps = {"a": [], "b": ["a"], "c": ["b"], "d": []}
+        errors, events = self.run_dag(deps, fail=("a",))
+        self.assertEqual(sorted(errors), ["a", "b", "c"])
+        self.assertTrue(isinstance(errors["a"], ValueError))
+        self.assertEqual(errors["c"], "Prerequisite 'a' failed")
+        self.assertTrue(("end", "d") in events)
+        self.assertFalse(("start", "b") in events)
+
+    def test_unresolvable(self):
+        errors, events = self.run_dag({"a": ["b"], "b": ["a"], "c": []})
+        self.assertEqual(errors, {"a": "Unresolvable dependencies", "b": "Unresolvable dependencies"})
+        self.assertEqual(events, [("start", "c"), ("end", "c")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+"Tests of the prefetching of the repositories of a project (Project.prefetch), from local bare repositories"
+import os, unittest
+from railgun import checkout, spec
+from helpers import CacheTestCase, GitRemote
+
+class PrefetchTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        checkout._remote_heads.clear()
+        self.remotes = [ GitRemote(self.tempdir, name) for name in ("a", "b") ]
+        self.heads = [ remote.commit("Dockerfile", "FROM scratch\n") for remote in self.remotes ]
+        self.project = os.path.join(self.tempdir, "project")
+        os.mkdir(self.project)
+        with open(os.path.join(self.project, "services.yml"), "w") as f:
+            for name, remote in zip(("a", "b"), self.remotes):
+                f.write("%s:\n  container:\n    url: %s\n" % (name, remote.url))
+        # Record the remote lookups and the checkouts, in order
+        self.events = []
+        ls_remote, git_checkout = checkout._ls_remote, checkout.GitRepository.checkout
+        def _ls_remote(url, ref):
+            self.events.append("probe")
+            return ls_remote(url, ref)
+        def _checkout(repository, url, *args, **kwargs):
+            self.events.append("checkout")
+            return git_checkout(repository, url, *args, **kwargs)
+        checkout._ls_remote = _ls_remote
+        checkout.GitRepository.checkout = _checkout
+        self.addCleanup(setattr, checkout, "_ls_remote", ls_remote)
+        self.addCleanup(setattr, checkout.GitRepository, "checkout", git_checkout)
+
+    def head(self, project, name):
+        return checkout.read_head(os.path.join(project.get_service(name).get_build_dir(), name))
+
+    def test_probes_before_checkouts(self):
+        project = spec.Project(self.project)
+        project.prefetch()
+        self.assertEqual(self.events, ["checkout", "checkout"])
+        head = self.remotes[0].commit("Dockerfile", "FROM busybox\n")
+        del self.events[:]
+        project.prefetch(update=True)
+        # One lookup per repository, all of them before any checkout is updated
+        self.assertEqual(self.events, ["probe", "probe", "checkout", "checkout"])
+        self.assertEqual(self.head(project, "a"), head)
+        self.assertEqual(self.head(project, "b"), self.heads[1])
+
+if __name__ == "__main__":
+    unittest.main()
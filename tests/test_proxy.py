@@ -0,0 +1,89 @@
+"Tests of the caching HTTP proxy (proxy.ProxyServer), between urllib2 and a local origin server"
+import hashlib, socket, unittest, logging
+import urllib2
+from railgun import proxy
+from helpers import CacheTestCase, QuietHandler, server_url
+
+class _Origin(QuietHandler):
+    "Serves /public with an ETag, and /private marked as such"
+    def do_GET(self):
+        self.server.log.append(self.path)
+        body = "%s %d" % (self.path, len(self.server.log))
+        etag = '"%s"' % hashlib.sha1(self.path).hexdigest()
+        if self.path == "/public" and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        if self.path == "/private":
+            self.send_header("Cache-Control", "private")
+        else:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+class ProxyTest(CacheTestCase):
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        self.origin = self.start_server(_Origin, log=[])
+        self.proxy = proxy.ProxyServer("127.0.0.1", 0)
+        self.proxy.start()
+        self.addCleanup(self.proxy.server_close)
+        self.addCleanup(self.proxy.shutdown)
+        self.opener = urllib2.build_opener(urllib2.ProxyHandler({"http": self.proxy.get_url()}))
+
+    def get(self, path, headers={}):
+        url = server_url(self.origin, path)
+        response = self.opener.open(urllib2.Request(url, headers=headers))
+        try:
+            return response.info(), response.read()
+        finally:
+            response.close()
+
+    def test_miss_then_hit(self):
+        headers, body = self.get("/public")
+        self.assertEqual(headers["X-Cache"], "MISS")
+        self.assertEqual(headers["Content-Type"], "text/plain")
+        self.assertEqual(body, "/public 1")
+        headers, body = self.get("/public")
+        self.assertEqual(headers["X-Cache"], "HIT")
+        self.assertEqual(body, "/public 1")
+        self.assertEqual(self.origin.log, ["/public"])
+        stats = proxy.get_stats(self.proxy.get_url())
+        self.assertEqual((stats["requests"], stats["hits"], stats["misses"]), (2, 1, 1))
+        self.assertEqual(stats["bytes_saved"], len(body))
+
+    def test_not_cached(self):
+        # Private responses, and requests with cookies, are forwarded every time
+        self.assertEqual(self.get("/private")[1], "/private 1")
+        self.assertEqual(self.get("/private")[1], "/private 2")
+        self.get("/public", {"Cookie": "session=1"})
+        headers, body = self.get("/public", {"Cookie": "session=1"})
+        self.assertFalse("X-Cache" in headers)
+        self.assertEqual(body, "/public 4")
+        self.assertEqual(proxy.get_stats(self.proxy.get_url())["forwarded"], 4)
+
+    def test_connect_ports(self):
+        s = socket.create_connection(self.proxy.server_address[:2])
+        try:
+            s.sendall("CONNECT 127.0.0.1:22 HTTP/1.0\r\n\r\n")
+            # Read the whole answer, so that the proxy does not write to a closed connection
+            self.assertTrue(s.makefile().read().startswith("HTTP/1.0 403"))
+        finally:
+            s.close()
+
+    def test_allow(self):
+        refused = proxy.ProxyServer("127.0.0.1", 0, allow=["10.0.0.0/8"])
+        # Refusals are logged as warnings
+        logging.disable(logging.WARNING)
+        try:
+            self.assertFalse(refused.verify_request(None, ("127.0.0.1", 1234)))
+            self.assertTrue(refused.verify_request(None, ("10.1.2.3", 1234)))
+        finally:
+            logging.disable(logging.NOTSET)
+            refused.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+"Tests of the image inventory of hosts (HostProvider.get_image)"
+import unittest
+from railgun.host_providers.local import LocalHostProvider
+
+class _Host(LocalHostProvider):
+    "A host with a fixed list of images"
+    images = [
+        ("sha256:" + "ab12" * 16, ["builder.base.acme:latest"], {"railgun.digest": "1234"}),
+        ("sha256:" + "cd34" * 16, ["web:1.0", "web:latest"], None),
+    ]
+    def _list_images(self):
+        return iter(self.images)
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        self.host = _Host("local", None, {}, None, None)
+
+    def test_tags(self):
+        self.assertEqual(self.host.get_image("web:1.0")["id"], "sha256:" + "cd34" * 16)
+        self.assertEqual(self.host.get_image("web")["id"], "sha256:" + "cd34" * 16)
+        self.assertEqual(self.host.get_image_label("builder.base.acme", "railgun.digest"), "1234")
+        self.assertEqual(self.host.get_image_label("web", "railgun.digest"), None)
+
+    def test_tags_are_not_prefixes(self):
+        self.assertFalse(self.host.check_container_exists("builder.base"))
+        self.assertFalse(self.host.check_container_exists("builder.base.ac"))
+        self.assertTrue(self.host.check_container_exists("builder.base.acme"))
+
+    def test_abbreviated_ids(self):
+        self.assertEqual(self.host.get_image("ab12ab12ab12")["id"], "sha256:" + "ab12" * 16)
+        self.assertEqual(self.host.get_image("sha256:cd34cd34cd34")["id"], "sha256:" + "cd34" * 16)
+        self.assertEqual(self.host.get_image("ab12ab12"), None)
+        self.assertEqual(self.host.get_image("ef56ef56ef56"), None)
+
+if __name__ == "__main__":
+    unittest.main()
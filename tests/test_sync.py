@@ -0,0 +1,60 @@
+"Tests of the delta synchronization of build contexts (sync.sync_context), to a local staging directory"
+import os, shutil, tempfile, unittest
+from railgun import sync
+from railgun.host_providers.local import LocalHostProvider
+
+BLOCKSIZE = 16
+
+def _file(data, mode=0o644):
+    return {"type": "f", "mode": mode, "data": data}
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.staged = os.path.join(self.tempdir, "staged")
+        self.host = LocalHostProvider("local", None, {}, None, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def sync(self, entries):
+        return sync.sync_context(self.host, entries, self.staged, BLOCKSIZE)
+
+    def read(self, name):
+        with open(os.path.join(self.staged, name)) as f:
+            return f.read()
+
+    def test_hash_entry(self):
+        entry = sync._hash_entry(_file("a" * BLOCKSIZE + "b" * 4), BLOCKSIZE)
+        self.assertEqual(entry["size"], BLOCKSIZE + 4)
+        self.assertEqual(len(entry["blocks"]), 2)
+        self.assertEqual(entry["blocks"][0], sync._hash_entry(_file("a" * BLOCKSIZE), BLOCKSIZE)["sha1"])
+
+    def test_initial_sync(self):
+        stats = self.sync({"src": {"type": "d", "mode": 0o755}, "src/a": _file("hello"), "Dockerfile": _file("FROM x\n")})
+        self.assertEqual(self.read("src/a"), "hello")
+        self.assertEqual(self.read("Dockerfile"), "FROM x\n")
+        self.assertEqual(stats["sent_bytes"], stats["total_bytes"])
+        self.assertEqual(stats["unchanged"], 0)
+
+    def test_changed_blocks(self):
+        big = "".join(c * BLOCKSIZE for c in "abcd")
+        self.sync({"big": _file(big), "small": _file("x")})
+        # Only the changed block of the large file is sent, and unchanged files not at all
+        changed = big[:BLOCKSIZE] + "B" * BLOCKSIZE + big[2*BLOCKSIZE:] + "e"
+        stats = self.sync({"big": _file(changed), "small": _file("x")})
+        self.assertEqual(self.read("big"), changed)
+        self.assertEqual(stats["unchanged"], 1)
+        self.assertEqual(stats["sent_bytes"], BLOCKSIZE + 1)
+        stats = self.sync({"big": _file(changed), "small": _file("x")})
+        self.assertEqual(stats["sent_bytes"], 0)
+        self.assertEqual(stats["unchanged"], 2)
+
+    def test_deletes_and_modes(self):
+        self.sync({"a": _file("a"), "d": {"type": "d", "mode": 0o755}, "d/b": _file("b")})
+        self.sync({"a": _file("a", 0o755)})
+        self.assertFalse(os.path.exists(os.path.join(self.staged, "d")))
+        self.assertEqual(os.stat(os.path.join(self.staged, "a")).st_mode & 0o777, 0o755)
+
+if __name__ == "__main__":
+    unittest.main()